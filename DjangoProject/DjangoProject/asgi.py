@@ -3,6 +3,9 @@ ASGI config for DjangoProject project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+The async survey endpoints (submit-async, save-progress-async) only pay off
+when served from here, e.g. ``uvicorn DjangoProject.asgi:application``.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
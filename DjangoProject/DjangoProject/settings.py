@@ -148,4 +148,78 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Paramètres pour l'application de sondage
 SURVEY_PAGINATION_SIZE = 10
 LOGIN_URL = '/admin/login/'
-LOGIN_REDIRECT_URL = '/'
\ No newline at end of file
+LOGIN_REDIRECT_URL = '/'
+
+# Schémas d'enquête compilés (cache partagé et cache local au processus)
+SURVEY_SCHEMA_CACHE_TIMEOUT = 3600
+SURVEY_SCHEMA_LOCAL_CACHE_SIZE = 128
+
+# Fragments HTML des questions, mis en cache par version de question et langue
+SURVEY_FRAGMENT_CACHE_TIMEOUT = 24 * 3600
+
+# API de tendance: nombre maximal de périodes par requête
+SURVEY_TREND_MAX_PERIODS = 2000
+
+# Analyse croisée: nombre maximal de cellules du tableau de contingence
+SURVEY_CROSSTAB_MAX_CELLS = 100000
+
+# Cubes de réponses en colonnes (NumPy) pour les résultats, persistés en fichiers mappés en mémoire
+SURVEY_CUBE_ENABLED = True
+SURVEY_CUBE_DIR = os.path.join(BASE_DIR, 'var', 'cubes')
+SURVEY_CUBE_MEMORY_BUDGET = 256 * 1024 * 1024  # octets, par processus
+SURVEY_CUBE_REFRESH_SECONDS = 5
+SURVEY_CUBE_PERSIST_SECONDS = 60
+SURVEY_CUBE_LAG_SECONDS = 60  # marge de relecture des réponses modifiées
+
+# Segments de réponses: nombre maximal de termes d'une expression
+SURVEY_SEGMENT_MAX_TERMS = 64
+
+# Esquisses numériques (t-digest): compression, environ le double du nombre de centroïdes gardés
+SURVEY_SKETCH_COMPRESSION = 100
+
+# API JSON des résultats filtrés: durée du cache par filtre et état des réponses (secondes)
+SURVEY_RESULTS_CACHE_TIMEOUT = 300
+
+# Exports: nombre de réponses lues par tranche (deux requêtes par tranche)
+SURVEY_EXPORT_CHUNK_SIZE = 2000
+
+# Cache disque des exports (répertoire partagé entre processus) et sa taille maximale, en octets:
+# les fichiers les moins récemment servis sont supprimés au-delà
+SURVEY_EXPORT_DIR = os.path.join(BASE_DIR, 'var', 'exports')
+SURVEY_EXPORT_CACHE_BYTES = 1024 * 1024 * 1024
+
+# Exports en tâche de fond: threads par processus, durée de conservation de l'état des tâches,
+# délai sans avancement au-delà duquel une tâche est perdue (secondes)
+SURVEY_EXPORT_WORKERS = 2
+SURVEY_EXPORT_JOB_TTL = 3600
+SURVEY_EXPORT_STALE_SECONDS = 300
+
+# Exports Parquet: nombre de réponses par groupe de lignes (mémoire maximale de l'export)
+SURVEY_EXPORT_ROW_GROUP_SIZE = 50000
+
+# Flux NDJSON des réponses: taille maximale d'une page, délai avant qu'une réponse mise à jour
+# y apparaisse (ses transactions en cours ont eu le temps d'être validées, en secondes)
+SURVEY_FEED_PAGE_SIZE = 1000
+SURVEY_FEED_SETTLE_SECONDS = 10
+
+# Statistiques, cumuls horaires, index des textes et esquisses: mises à jour appliquées à chaque
+# transaction (0), ou regroupées par processus et appliquées toutes les N secondes; regroupées,
+# elles sont perdues si le processus s'arrête, et les commandes de reconstruction ne sont exactes
+# qu'une fois les tampons vidés
+SURVEY_AGGREGATE_FLUSH_INTERVAL = 0
+
+# Vues asynchrones: nombre de threads d'écriture (et donc de connexions) partagés
+SURVEY_ASYNC_WRITE_WORKERS = 4
+
+# Écriture différée des réponses complètes (journal sur disque + vidage par lots)
+SURVEY_WRITE_BEHIND = False
+SURVEY_WRITE_BEHIND_DIR = os.path.join(BASE_DIR, 'var', 'journal')
+SURVEY_WRITE_BEHIND_BATCH_SIZE = 200
+SURVEY_WRITE_BEHIND_FLUSH_INTERVAL = 1.0  # secondes
+SURVEY_WRITE_BEHIND_FSYNC = True
+
+# Durée de validité des jetons signés des réponses non encore créées (secondes)
+SURVEY_RESPONSE_TOKEN_MAX_AGE = 7 * 24 * 3600
+
+# Sauvegarde automatique: fenêtre de regroupement des sauvegardes d'une même réponse (secondes)
+SURVEY_AUTOSAVE_COALESCE_SECONDS = 2
@@ -0,0 +1,99 @@
+"""
+Maintenance of the aggregates of written responses.
+
+The tables maintained incrementally as responses are written (survey
+statistics, hourly rollups, text index, sketches) each have a hot row per
+survey, hour or day. By default, the deltas of a transaction are applied
+in one update per row once it commits.
+
+Setting SURVEY_AGGREGATE_FLUSH_INTERVAL opts into coalescing: writers
+queue their deltas in a buffer of the process once their transaction
+commits, and a background thread applies the buffer every interval, with
+one call per row for all the deltas queued since, so a survey's rows are
+locked by each process at most once per interval however many responses
+complete. Deltas still queued when a process dies are lost, and the
+reconcile_statistics, backfill_rollups, rebuild_text_index and
+rebuild_sketches commands, which recompute from the database, are only
+exact while no process has deltas queued: deltas of responses they already
+counted would be added again when flushed.
+"""
+
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+
+def _interval():
+    return getattr(settings, 'SURVEY_AGGREGATE_FLUSH_INTERVAL', 0)
+
+
+class AggregateBuffer:
+    """Deltas queued by this process, grouped by apply function and key"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._thread = None
+
+    def add(self, apply, key, items):
+        with self._lock:
+            self._pending.setdefault((apply, key), []).extend(items)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='survey-aggregates', daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self):
+        while True:
+            time.sleep(max(_interval(), 0.1))
+            close_old_connections()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+    def flush(self):
+        """Apply the queued deltas, one call per apply function and key"""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            for (apply, key), items in pending.items():
+                try:
+                    apply(*key, items)
+                except Exception:
+                    logger.exception("Applying %s queued deltas with %s%s failed", len(items), apply.__qualname__, key)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(items) for items in self._pending.values())
+
+
+_buffer = AggregateBuffer()
+
+
+def record(apply, key, items):
+    """
+    Queue items for apply(*key, items) once the caller's transaction commits.
+
+    Items queued with the same apply function and key are applied together,
+    apply receiving the list of all of them.
+    """
+    items = list(items)
+    if not items:
+        return
+    if _interval():
+        transaction.on_commit(lambda: _buffer.add(apply, key, items), robust=True)
+    else:
+        transaction.on_commit(lambda: apply(*key, items), robust=True)
+
+
+def flush():
+    """Apply the deltas queued by this process now"""
+    _buffer.flush()
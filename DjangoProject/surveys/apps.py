@@ -1,4 +1,6 @@
 # surveys/apps.py
+import logging
+
 from django.apps import AppConfig
 
 class SurveysConfig(AppConfig):
@@ -6,6 +8,15 @@ class SurveysConfig(AppConfig):
     name = 'surveys'
     
     def ready(self):
+        from . import signals  # noqa: F401
+        from . import writebehind
+
+        # Rejouer les journaux d'écriture différée laissés par des processus arrêtés, même désactivée
+        try:
+            writebehind.replay_at_startup()
+        except Exception:
+            logging.getLogger(__name__).exception("Impossible de rejouer les journaux d'écriture différée")
+
         # Modifié pour éviter l'erreur de table inexistante
         try:
             # Vérifier si la table existe avant d'appeler get_default_types
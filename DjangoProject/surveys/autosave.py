@@ -0,0 +1,320 @@
+"""
+Incremental autosave of partial responses.
+
+Clients send only the answers that changed. The stored state of those
+answers is read with one query, compared with the patch, and only the real
+differences are written, with bulk operations. Autosaves arriving in quick
+succession for the same response are coalesced: within
+SURVEY_AUTOSAVE_COALESCE_SECONDS of a write, patches are merged in the
+cache, under a short lock so concurrent autosaves never lose changes, and
+written together once the window is over, by a background thread of the
+process that queued them, by the next autosave, by one sent with
+``flush``, or before a submission.
+"""
+
+import heapq
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from functools import reduce
+from operator import or_
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils.translation import gettext as _
+
+from .ingest import answer_rows, ensure_response
+from .models import Answer, Response
+from .schema import get_survey_schema
+
+logger = logging.getLogger(__name__)
+
+# Longest time a merge holds its lock; a lock left by a dead process expires after it
+LOCK_TIMEOUT = 5
+
+
+def _window():
+    return getattr(settings, 'SURVEY_AUTOSAVE_COALESCE_SECONDS', 2)
+
+
+def _normalize(question, value):
+    """Bring a JSON value to the shape of a form post, None when the answer is cleared"""
+    if value is None or value == '' or value == []:
+        return None
+    if question.question_type.has_options and question.question_type.has_multiple_answers:
+        values = value if isinstance(value, list) else [value]
+        return [str(item) for item in values]
+    if isinstance(value, (list, dict)):
+        return value
+    return str(value).strip() or None
+
+
+def validate_patch(schema, answers):
+    """
+    Validate a patch of answers against the survey's compiled schema.
+
+    Returns (changes, errors): changes maps question ids to the cleaned
+    answer, or to None for answers to clear; errors maps the rejected keys
+    to messages. Required questions may be cleared, the response is partial.
+    """
+    changes = {}
+    errors = {}
+    for key, value in answers.items():
+        question = schema.get(key)
+        if question is None:
+            errors[str(key)] = _("Unknown question")
+            continue
+        value = _normalize(question, value)
+        if value is not None:
+            is_valid, message = question.validate_answer(value)
+            if not is_valid:
+                errors[str(key)] = str(message)
+                continue
+        changes[question.id] = value
+    return changes, errors
+
+
+def load_answer_state(response, question_ids):
+    """
+    Read the stored answers of some questions in one query.
+
+    Returns a dict mapping question ids to (answer_id, data, option_ids).
+    """
+    state = {}
+    rows = Answer.objects.filter(response=response, question_id__in=question_ids).values_list(
+        'id', 'question_id', 'data', 'selected_options'
+    )
+    for answer_id, question_id, data, option_id in rows:
+        entry = state.setdefault(question_id, (answer_id, data, set()))
+        if option_id is not None:
+            entry[2].add(option_id)
+    return state
+
+
+def apply_patch(response, schema, changes):
+    """
+    Write the differences between a validated patch and the stored answers.
+
+    Unchanged answers are skipped, cleared answers are deleted, new answers
+    are bulk created, changed answers are bulk updated and only the option
+    links that differ are added or removed. Returns the number of created,
+    updated, deleted and unchanged answers.
+    """
+    stats = {'created': 0, 'updated': 0, 'deleted': 0, 'unchanged': 0}
+    with transaction.atomic():
+        ensure_response(response)
+        state = load_answer_state(response, list(changes))
+        rows = {
+            question_id: (data, set(option_ids))
+            for question_id, data, option_ids in answer_rows(
+                schema.by_id, {question_id: value for question_id, value in changes.items() if value is not None}
+            )
+        }
+
+        to_delete = []
+        to_create = []
+        to_update = []
+        links_to_add = []
+        links_to_remove = []
+        for question_id in changes:
+            stored = state.get(question_id)
+            if question_id not in rows:
+                if stored:
+                    to_delete.append(stored[0])
+                else:
+                    stats['unchanged'] += 1
+                continue
+            data, option_ids = rows[question_id]
+            if stored is None:
+                to_create.append((question_id, data, option_ids))
+                continue
+            answer_id, stored_data, stored_options = stored
+            if stored_data == data and stored_options == option_ids:
+                stats['unchanged'] += 1
+                continue
+            if stored_data != data:
+                to_update.append(Answer(id=answer_id, data=data))
+            links_to_add.extend((answer_id, option_id) for option_id in option_ids - stored_options)
+            links_to_remove.extend((answer_id, option_id) for option_id in stored_options - option_ids)
+            stats['updated'] += 1
+
+        Through = Answer.selected_options.through
+        if to_delete:
+            Answer.objects.filter(id__in=to_delete).delete()
+            stats['deleted'] = len(to_delete)
+        if to_update:
+            Answer.objects.bulk_update(to_update, ['data'])
+        if links_to_remove:
+            Through.objects.filter(reduce(or_, (
+                Q(answer_id=answer_id, questionoption_id=option_id) for answer_id, option_id in links_to_remove
+            ))).delete()
+        if to_create:
+            Answer.objects.bulk_create([
+                Answer(response=response, question_id=question_id, data=data)
+                for question_id, data, option_ids in to_create
+            ])
+            created_ids = dict(Answer.objects.filter(
+                response=response, question_id__in=[question_id for question_id, data, option_ids in to_create]
+            ).values_list('question_id', 'id'))
+            links_to_add.extend(
+                (created_ids[question_id], option_id)
+                for question_id, data, option_ids in to_create
+                for option_id in option_ids
+            )
+            stats['created'] = len(to_create)
+        if links_to_add:
+            Through.objects.bulk_create([
+                Through(answer_id=answer_id, questionoption_id=option_id) for answer_id, option_id in links_to_add
+            ])
+        if stats['created'] or stats['updated'] or stats['deleted']:
+            response.save(update_fields=['updated_at'])
+    return stats
+
+
+def _pending_key(response_id):
+    return f"surveys:autosave:pending:{response_id}"
+
+
+def _window_key(response_id):
+    return f"surveys:autosave:window:{response_id}"
+
+
+def _lock_key(response_id):
+    return f"surveys:autosave:lock:{response_id}"
+
+
+class MergeLockTimeout(Exception):
+    """The pending autosaves of a response stayed locked for LOCK_TIMEOUT seconds"""
+
+
+@contextmanager
+def _merge_lock(response_id):
+    """
+    Serialize the read-merge-write of a response's pending autosaves across processes.
+
+    Raises MergeLockTimeout when the lock cannot be taken within
+    LOCK_TIMEOUT; the lock is only released by the holder that took it.
+    """
+    key = _lock_key(response_id)
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    while not cache.add(key, token, LOCK_TIMEOUT):
+        if time.monotonic() >= deadline:
+            raise MergeLockTimeout(response_id)
+        time.sleep(0.005)
+    try:
+        yield
+    finally:
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+def coalesce(response, changes, flush=False):
+    """
+    Merge a patch with the autosaves still pending for the response.
+
+    Returns the changes to write now, or None when the patch was queued
+    because the response was written less than a window ago; queued patches
+    are written once the window is over. Responses that do not exist yet
+    are always written at once, as are patches whose merge could not be
+    locked.
+    """
+    if response.pk is None:
+        return changes
+    try:
+        with _merge_lock(response.pk):
+            pending = cache.get(_pending_key(response.pk)) or {}
+            first_queued = not pending
+            pending.update(changes)
+            if flush or cache.add(_window_key(response.pk), True, _window()):
+                cache.delete(_pending_key(response.pk))
+                return pending
+            cache.set(_pending_key(response.pk), pending, 24 * 3600)
+    except MergeLockTimeout:
+        logger.warning("Autosaves of response %s are locked, writing a patch without coalescing", response.pk)
+        return changes
+    if first_queued:
+        _flusher.schedule(response.pk, _window())
+    return None
+
+
+def take_pending(response_id):
+    """
+    Remove and return the autosaves queued for a response, an empty dict when there are none.
+
+    Raises MergeLockTimeout when they stay locked.
+    """
+    with _merge_lock(response_id):
+        pending = cache.get(_pending_key(response_id)) or {}
+        cache.delete(_pending_key(response_id))
+    return pending
+
+
+def flush_pending(response_id):
+    """
+    Write the autosaves queued for a response.
+
+    Nothing is written to a response that was completed or deleted since.
+    Returns the counts of apply_patch, None when nothing was written. When
+    the queued autosaves are locked, they are left queued and the flush is
+    retried once a window is over.
+    """
+    try:
+        pending = take_pending(response_id)
+    except MergeLockTimeout:
+        logger.warning("Autosaves of response %s are locked, retrying their write later", response_id)
+        _flusher.schedule(response_id, _window())
+        return None
+    if not pending:
+        return None
+    response = Response.objects.filter(pk=response_id, is_complete=False).select_related('survey').first()
+    if response is None:
+        return None
+    schema = get_survey_schema(response.survey)
+    # Questions deleted since the patches were validated
+    changes = {question_id: value for question_id, value in pending.items() if question_id in schema.by_id}
+    return apply_patch(response, schema, changes)
+
+
+class PendingFlusher:
+    """Thread writing the autosaves queued by this process once their window is over"""
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._due = []
+        self._thread = None
+
+    def schedule(self, response_id, delay):
+        with self._condition:
+            heapq.heappush(self._due, (time.monotonic() + delay, response_id))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='survey-autosave', daemon=True)
+                self._thread.start()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._due or self._due[0][0] > time.monotonic():
+                    self._condition.wait(self._due[0][0] - time.monotonic() if self._due else None)
+                due, response_id = heapq.heappop(self._due)
+            close_old_connections()
+            try:
+                flush_pending(response_id)
+            except Exception:
+                logger.exception("Writing the queued autosaves of response %s failed", response_id)
+            finally:
+                close_old_connections()
+
+
+_flusher = PendingFlusher()
+
+
+def discard_pending(response):
+    """Drop queued autosaves, once a full submission has replaced them"""
+    if response.pk is not None:
+        cache.delete(_pending_key(response.pk))
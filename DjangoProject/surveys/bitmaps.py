@@ -0,0 +1,225 @@
+"""
+Compressed bitmaps of response cube rows.
+
+Bitmaps follow the Roaring layout: the row space is cut into chunks of
+65536 rows, and each non-empty chunk is stored either as a sorted array of
+16-bit offsets, while it holds at most 4096 rows, or as 1024 64-bit words.
+Sparse selections stay small and dense ones cost 8 KiB per chunk at most;
+AND, OR and NOT work chunk by chunk with vectorised NumPy operations.
+
+BitmapIndex keeps one bitmap per option of a cube's option questions, one
+per answered question and one of the complete responses, so that segments
+(see segments.py) resolve without scanning the cube's columns.
+"""
+
+import numpy as np
+
+CHUNK_BITS = 16
+CHUNK_SIZE = 1 << CHUNK_BITS
+ARRAY_MAX = 4096
+
+
+def _dense(container):
+    """Chunk as 1024 uint64 words"""
+    if container.dtype == np.uint64:
+        return container
+    bits = np.zeros(CHUNK_SIZE, dtype=bool)
+    bits[container] = True
+    return np.packbits(bits, bitorder='little').view(np.uint64)
+
+
+def _compact(words):
+    """Smallest container for a chunk given as words, None when empty"""
+    count = int(np.bitwise_count(words).sum())
+    if count == 0:
+        return None
+    if count <= ARRAY_MAX:
+        return np.flatnonzero(np.unpackbits(words.view(np.uint8), bitorder='little')).astype(np.uint16)
+    return words
+
+
+def _from_offsets(offsets):
+    if len(offsets) <= ARRAY_MAX:
+        return offsets.astype(np.uint16)
+    return _dense(offsets)
+
+
+class Bitmap:
+    """Immutable compressed set of row numbers"""
+
+    __slots__ = ('containers',)
+
+    def __init__(self, containers=None):
+        # Chunk number -> uint16 offsets or uint64 words
+        self.containers = containers or {}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Bitmap of an array of row numbers"""
+        rows = np.unique(np.asarray(rows, dtype=np.int64))
+        chunks = rows >> CHUNK_BITS
+        bounds = np.flatnonzero(np.diff(chunks)) + 1
+        return cls({
+            int(part[0] >> CHUNK_BITS): _from_offsets(part & (CHUNK_SIZE - 1))
+            for part in np.split(rows, bounds) if len(part)
+        })
+
+    @classmethod
+    def from_mask(cls, mask):
+        """Bitmap of the true entries of a boolean array"""
+        containers = {}
+        for chunk, start in enumerate(range(0, len(mask), CHUNK_SIZE)):
+            part = np.asarray(mask[start:start + CHUNK_SIZE], dtype=bool)
+            if len(part) < CHUNK_SIZE:
+                part = np.concatenate([part, np.zeros(CHUNK_SIZE - len(part), dtype=bool)])
+            container = _compact(np.packbits(part, bitorder='little').view(np.uint64))
+            if container is not None:
+                containers[chunk] = container
+        return cls(containers)
+
+    @classmethod
+    def full(cls, size):
+        """Bitmap of the rows 0 to size - 1"""
+        return cls.from_mask(np.ones(size, dtype=bool))
+
+    def __len__(self):
+        return sum(
+            int(np.bitwise_count(container).sum()) if container.dtype == np.uint64 else len(container)
+            for container in self.containers.values()
+        )
+
+    def __bool__(self):
+        return bool(self.containers)
+
+    @property
+    def nbytes(self):
+        return sum(container.nbytes for container in self.containers.values())
+
+    def to_rows(self):
+        """Sorted array of the row numbers"""
+        parts = []
+        for chunk in sorted(self.containers):
+            container = self.containers[chunk]
+            if container.dtype == np.uint64:
+                container = np.flatnonzero(np.unpackbits(container.view(np.uint8), bitorder='little'))
+            parts.append(container.astype(np.int64) + (chunk << CHUNK_BITS))
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+    def to_mask(self, size):
+        """Boolean array of size entries, true for the rows of the bitmap"""
+        mask = np.zeros(size, dtype=bool)
+        for chunk, container in self.containers.items():
+            start = chunk << CHUNK_BITS
+            if container.dtype == np.uint64:
+                bits = np.unpackbits(container.view(np.uint8), bitorder='little').view(bool)
+                mask[start:start + CHUNK_SIZE] = bits[:max(0, size - start)]
+            else:
+                offsets = container.astype(np.int64) + start
+                mask[offsets[offsets < size]] = True
+        return mask
+
+    def __and__(self, other):
+        containers = {}
+        for chunk in self.containers.keys() & other.containers.keys():
+            left, right = self.containers[chunk], other.containers[chunk]
+            if left.dtype == np.uint16 and right.dtype == np.uint16:
+                container = np.intersect1d(left, right, assume_unique=True)
+                container = container if len(container) else None
+            elif left.dtype == np.uint16 or right.dtype == np.uint16:
+                # Keep the offsets whose bit is set in the other chunk's words
+                offsets, words = (left, right) if left.dtype == np.uint16 else (right, left)
+                bits = np.unpackbits(words.view(np.uint8), bitorder='little')
+                container = offsets[bits[offsets] == 1]
+                container = container if len(container) else None
+            else:
+                container = _compact(left & right)
+            if container is not None:
+                containers[chunk] = container
+        return Bitmap(containers)
+
+    def __or__(self, other):
+        containers = dict(self.containers)
+        for chunk, right in other.containers.items():
+            left = containers.get(chunk)
+            if left is None:
+                containers[chunk] = right
+            elif left.dtype == np.uint16 and right.dtype == np.uint16 and len(left) + len(right) <= ARRAY_MAX:
+                containers[chunk] = np.union1d(left, right)
+            else:
+                containers[chunk] = _compact(_dense(left) | _dense(right))
+        return Bitmap(containers)
+
+    def __sub__(self, other):
+        containers = {}
+        for chunk, left in self.containers.items():
+            right = other.containers.get(chunk)
+            if right is None:
+                containers[chunk] = left
+                continue
+            if left.dtype == np.uint16:
+                if right.dtype == np.uint16:
+                    container = np.setdiff1d(left, right, assume_unique=True)
+                else:
+                    bits = np.unpackbits(right.view(np.uint8), bitorder='little')
+                    container = left[bits[left] == 0]
+                container = container if len(container) else None
+            else:
+                container = _compact(left & ~_dense(right))
+            if container is not None:
+                containers[chunk] = container
+        return Bitmap(containers)
+
+    def invert(self, size):
+        """Complement within the rows 0 to size - 1"""
+        return Bitmap.full(size) - self
+
+
+class BitmapIndex:
+    """
+    Bitmaps of a response cube's rows: per option, per answered question,
+    and of the complete responses.
+    """
+
+    def __init__(self, options, answered, complete):
+        self.options = options
+        self.answered = answered
+        self.complete = complete
+
+    @classmethod
+    def build(cls, cube, schema):
+        rows = np.arange(len(cube), dtype=np.int64)
+        return cls(*cls._bitmaps(cube, schema, rows))
+
+    @staticmethod
+    def _bitmaps(cube, schema, rows):
+        """Bitmaps of some rows of a cube, as (options, answered, complete)"""
+        options = {}
+        answered = {}
+        for question in schema:
+            answered[question.id] = Bitmap.from_rows(rows[np.asarray(cube.answered(question))[rows]])
+            if not question.question_type.has_options:
+                continue
+            for position, option in enumerate(question.get_options()):
+                options[option.id] = Bitmap.from_rows(rows[cube.selected(question, position)[rows]])
+        complete = Bitmap.from_rows(rows[np.asarray(cube.columns['complete'])[rows]])
+        return options, answered, complete
+
+    def updated(self, cube, schema, rows):
+        """
+        Index of a cube whose rows changed, or were appended, at some row numbers.
+
+        Other rows must have kept their row number.
+        """
+        stale = Bitmap.from_rows(rows)
+        options, answered, complete = self._bitmaps(cube, schema, rows)
+        return BitmapIndex(
+            {key: (self.options.get(key, Bitmap()) - stale) | bitmap for key, bitmap in options.items()},
+            {key: (self.answered.get(key, Bitmap()) - stale) | bitmap for key, bitmap in answered.items()},
+            (self.complete - stale) | complete,
+        )
+
+    @property
+    def nbytes(self):
+        return sum(
+            bitmap.nbytes for bitmap in [*self.options.values(), *self.answered.values(), self.complete]
+        )
@@ -0,0 +1,224 @@
+"""
+N-way cross-tabulation of option questions.
+
+The (response, option) incidence rows of the selected questions are read
+with one query into NumPy arrays. The contingency table is then built in
+one vectorised pass: the rows of each question are joined on the response
+id, which also handles multiple-choice questions, and every combination is
+encoded as a flat cell index counted with a single bincount. Any number of
+questions can be crossed.
+"""
+
+import math
+from functools import reduce
+from itertools import chain
+
+import numpy as np
+from django.conf import settings
+
+from .models import Answer
+
+
+def _upper_gamma_q(a, x):
+    """Regularised upper incomplete gamma function Q(a, x)"""
+    if x <= 0:
+        return 1.0
+    log_prefix = -x + a * math.log(x) - math.lgamma(a)
+    if x < a + 1:
+        # Series expansion of P(a, x)
+        term = total = 1.0 / a
+        n = a
+        for _ in range(10000):
+            n += 1
+            term *= x / n
+            total += term
+            if abs(term) < abs(total) * 1e-15:
+                break
+        return max(0.0, 1.0 - total * math.exp(log_prefix))
+    # Continued fraction for Q(a, x), modified Lentz's method
+    tiny = 1e-300
+    b = x + 1 - a
+    c = 1 / tiny
+    d = 1 / b
+    h = d
+    for i in range(1, 10000):
+        an = -i * (i - a)
+        b += 2
+        d = an * d + b
+        d = tiny if abs(d) < tiny else d
+        c = b + an / c
+        c = tiny if abs(c) < tiny else c
+        d = 1 / d
+        delta = d * c
+        h *= delta
+        if abs(delta - 1) < 1e-15:
+            break
+    return math.exp(log_prefix) * h
+
+
+def chi2_sf(statistic, dof):
+    """Survival function of the chi-square distribution: the test's p-value"""
+    return _upper_gamma_q(dof / 2, statistic / 2)
+
+
+def _join(left_responses, left_codes, right_responses, right_positions, size):
+    """
+    Join two sets of (response, code) rows on the response.
+
+    Every pair of rows of the same response yields one row whose code is
+    left_code * size + right_position. Rows must be unique per side.
+    """
+    order = np.argsort(right_responses, kind='stable')
+    right_responses = right_responses[order]
+    right_positions = right_positions[order]
+    starts = np.searchsorted(right_responses, left_responses, side='left')
+    counts = np.searchsorted(right_responses, left_responses, side='right') - starts
+    left = np.repeat(np.arange(len(left_responses)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    right = np.repeat(starts, counts) + offsets
+    return left_responses[left], left_codes[left] * size + right_positions[right]
+
+
+def load_incidence(question_ids, responses):
+    """
+    Read the selected options of some questions, for a set of responses.
+
+    Returns an (n, 2) int64 array of (response id, option id) rows.
+    """
+    Through = Answer.selected_options.through
+    rows = Through.objects.filter(
+        answer__question_id__in=question_ids, answer__response__in=responses
+    ).values_list('answer__response_id', 'questionoption_id')
+    return np.fromiter(chain.from_iterable(rows.iterator(chunk_size=10000)), dtype=np.int64).reshape(-1, 2)
+
+
+class CrossTab:
+    """Contingency table of some option questions, one axis per question in option order"""
+
+    def __init__(self, questions, table):
+        self.questions = list(questions)
+        self.table = table
+
+    @property
+    def total(self):
+        return int(self.table.sum())
+
+    def _percentages(self, axis):
+        sums = self.table.sum(axis=axis, keepdims=True)
+        percentages = np.divide(self.table * 100.0, sums, out=np.zeros(self.table.shape), where=sums > 0)
+        return np.round(percentages, 1)
+
+    def row_percentages(self):
+        """Share of each cell in its row (first axis), per layer of the further axes"""
+        return self._percentages(axis=1)
+
+    def column_percentages(self):
+        """Share of each cell in its column (second axis), per layer of the further axes"""
+        return self._percentages(axis=0)
+
+    def chi_square(self):
+        """
+        Pearson's chi-square test of mutual independence of the questions.
+
+        Returns a dict with the statistic, the degrees of freedom and the
+        p-value, or None when the table is empty or has a single dimension.
+        Options nobody selected are left out of the degrees of freedom.
+        Answers to multiple-choice questions are not independent
+        observations, so the test is only indicative for them.
+        """
+        observed = self.table.astype(float)
+        total = observed.sum()
+        if total == 0 or observed.ndim < 2:
+            return None
+        axes = range(observed.ndim)
+        marginals = [observed.sum(axis=tuple(other for other in axes if other != axis)) for axis in axes]
+        expected = total * reduce(np.multiply.outer, [marginal / total for marginal in marginals])
+        mask = expected > 0
+        statistic = float((((observed - expected) ** 2)[mask] / expected[mask]).sum())
+        levels = [int((marginal > 0).sum()) for marginal in marginals]
+        dof = math.prod(levels) - 1 - sum(level - 1 for level in levels)
+        return {
+            'statistic': round(statistic, 4),
+            'dof': dof,
+            'p_value': chi2_sf(statistic, dof) if dof > 0 else None,
+        }
+
+    def as_dict(self):
+        return {
+            'questions': [
+                {
+                    'id': question.id,
+                    'text': question.text,
+                    'options': [{'id': option.id, 'text': option.text} for option in question.get_options()],
+                }
+                for question in self.questions
+            ],
+            'total': self.total,
+            'table': self.table.tolist(),
+            'row_percentages': self.row_percentages().tolist(),
+            'column_percentages': self.column_percentages().tolist(),
+            'chi_square': self.chi_square(),
+        }
+
+
+def check_shape(questions):
+    """Shape of the table crossing some questions, ValueError when it cannot be built"""
+    if len({question.id for question in questions}) != len(questions):
+        raise ValueError("A question can only be crossed once")
+    shape = tuple(len(question.get_options()) for question in questions)
+    if math.prod(shape) > getattr(settings, 'SURVEY_CROSSTAB_MAX_CELLS', 100000):
+        raise ValueError("Cross-tabulation too large")
+    return shape
+
+
+def build_crosstab(questions, incidence):
+    """
+    Build the contingency table of some compiled option questions from incidence rows.
+
+    Pure NumPy, no database access: incidence is an (n, 2) array of unique
+    (response id, option id) rows, as returned by load_incidence. A
+    response counts once in each combination of options it selected.
+    """
+    questions = list(questions)
+    shape = check_shape(questions)
+
+    # Lookup arrays from option id to dimension and to position within it
+    size = max([option.id for question in questions for option in question.get_options()], default=0) + 1
+    dimension_of = np.full(size, -1, dtype=np.int64)
+    position_of = np.full(size, -1, dtype=np.int64)
+    for dimension, question in enumerate(questions):
+        for position, option in enumerate(question.get_options()):
+            dimension_of[option.id] = dimension
+            position_of[option.id] = position
+
+    responses = incidence[:, 0]
+    option_ids = incidence[:, 1]
+    # Options added after the schema was compiled are ignored
+    known = option_ids < size
+    responses, option_ids = responses[known], option_ids[known]
+    dimensions = dimension_of[option_ids]
+    positions = position_of[option_ids]
+    return CrossTab(questions, build_table(shape, [
+        (responses[dimensions == dimension], positions[dimensions == dimension])
+        for dimension in range(len(questions))
+    ]))
+
+
+def build_table(shape, dimensions):
+    """
+    Count every combination of positions across dimensions.
+
+    dimensions holds one (keys, positions) pair of arrays per axis, with
+    unique rows: a key (a response) counts once in each combination of the
+    positions it has on every axis.
+    """
+    keys, codes = dimensions[0]
+    for dimension in range(1, len(dimensions)):
+        keys, codes = _join(keys, codes, *dimensions[dimension], shape[dimension])
+    return np.bincount(codes.astype(np.int64), minlength=math.prod(shape)).reshape(shape)
+
+
+def crosstab(questions, responses):
+    """Cross-tabulate some compiled option questions over a Response queryset"""
+    questions = list(questions)
+    return build_crosstab(questions, load_incidence([question.id for question in questions], responses))
@@ -0,0 +1,440 @@
+"""
+Columnar response cubes.
+
+A cube holds the responses of one survey as NumPy columns, one row per
+response in id order: creation and completion times, the completion flag,
+whether the respondent was logged in, whether each question was answered, the option position chosen for each
+single-choice question (-1 when none) and a bitset of the options selected
+for each multiple-choice question. Results, filters and cross-tabs then run
+as vectorised operations over the columns instead of joins over the
+Response, Answer and selected-options tables.
+
+A cube is built lazily, with three streamed queries, the first time a
+survey's results are read. Later reads catch up with the responses updated
+since the cube's watermark (every write to a response touches its
+updated_at), at most once every SURVEY_CUBE_REFRESH_SECONDS; a new schema
+version, or responses deleted since, rebuild it. Cubes are persisted as
+one .npy file per column and loaded back memory-mapped, so a restarted or
+sibling process picks them up without querying the answers. The process
+keeps its cubes in an LRU bounded by SURVEY_CUBE_MEMORY_BUDGET bytes.
+
+Cubes are immutable: catching up builds a new cube, so readers holding a
+cube never see it change under them.
+"""
+
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone as dt_timezone
+from itertools import chain
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from .bitmaps import BitmapIndex
+from .crosstab import CrossTab, build_table, check_shape
+from .models import Answer, Response
+
+logger = logging.getLogger(__name__)
+
+# Bump when the layout of the persisted columns changes
+CUBE_FORMAT = 2
+
+WORD_BITS = 64
+
+
+def _setting(name, default):
+    return getattr(settings, f'SURVEY_CUBE_{name}', default)
+
+
+def _epoch(moment):
+    return moment.timestamp() if moment is not None else np.nan
+
+
+def _words(options):
+    return max(1, -(-len(options) // WORD_BITS))
+
+
+def _column_names(schema):
+    """Names of the columns of a schema's cubes, in the order load_columns makes them"""
+    return [
+        'id', 'created', 'updated', 'completion', 'complete', 'authenticated',
+        *[f'answered_{question.id}' for question in schema],
+        *[f'options_{question.id}' for question in schema if question.question_type.has_options],
+    ]
+
+
+class ResponseCube:
+    """Columns of a survey's responses, as of a watermark"""
+
+    def __init__(self, survey_id, version, watermark, columns):
+        self.survey_id = survey_id
+        self.version = version
+        # Latest updated_at seen, as an epoch timestamp
+        self.watermark = watermark
+        self.columns = columns
+        self.refreshed = time.monotonic()
+        self.persisted = 0.0
+        self._index = None
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    @property
+    def nbytes(self):
+        index = self._index.nbytes if self._index is not None else 0
+        return sum(column.nbytes for column in self.columns.values()) + index
+
+    # Masks
+
+    def mask(self, complete=True, start=None, end=None):
+        """Rows of the (complete) responses created between start and end, both optional"""
+        mask = np.ones(len(self), dtype=bool)
+        start = timezone.make_aware(start) if start is not None and timezone.is_naive(start) else start
+        end = timezone.make_aware(end) if end is not None and timezone.is_naive(end) else end
+        if complete:
+            mask &= self.columns['complete']
+        if start is not None:
+            mask &= self.columns['created'] >= start.timestamp()
+        if end is not None:
+            mask &= self.columns['created'] <= end.timestamp()
+        return mask
+
+    def answered(self, question):
+        return self.columns[f'answered_{question.id}']
+
+    def selected(self, question, position):
+        """Rows of the responses that selected the option at a position of an option question"""
+        column = self.columns[f'options_{question.id}']
+        if column.ndim == 1:
+            return column == position
+        word, bit = divmod(position, WORD_BITS)
+        return (column[:, word] >> np.uint64(bit)) & np.uint64(1) == 1
+
+    def moments(self):
+        """Start and completion moments of every row, as epoch timestamps (nan when not complete)"""
+        return self.columns['created'], self.columns['created'] + self.columns['completion']
+
+    def response_ids(self, mask):
+        return self.columns['id'][mask]
+
+    def index(self, schema):
+        """Bitmap index of the cube's rows, built on first use"""
+        if self._index is None:
+            self._index = BitmapIndex.build(self, schema)
+        return self._index
+
+    # Aggregates
+
+    def count_answers(self, schema, mask):
+        """Same result as results.count_answers, for the rows of a mask"""
+        answer_counts = {}
+        option_counts = {}
+        for question in schema:
+            answer_counts[question.id] = int(np.count_nonzero(self.answered(question) & mask))
+            if not question.question_type.has_options:
+                continue
+            column = self.columns[f'options_{question.id}']
+            options = question.get_options()
+            if column.ndim == 1:
+                counts = np.bincount(column[mask & (column >= 0)], minlength=len(options))
+            else:
+                counts = [np.count_nonzero(self.selected(question, position) & mask) for position in range(len(options))]
+            for option, count in zip(options, counts):
+                option_counts[option.id] = int(count)
+        return answer_counts, option_counts
+
+    def crosstab(self, questions, mask):
+        """Same result as crosstab.crosstab, for the rows of a mask"""
+        questions = list(questions)
+        shape = check_shape(questions)
+        dimensions = []
+        for question in questions:
+            column = self.columns[f'options_{question.id}']
+            if column.ndim == 1:
+                rows = np.flatnonzero(mask & (column >= 0))
+                dimensions.append((rows, column[rows].astype(np.int64)))
+                continue
+            keys, positions = [], []
+            for position in range(len(question.get_options())):
+                rows = np.flatnonzero(self.selected(question, position) & mask)
+                keys.append(rows)
+                positions.append(np.full(len(rows), position, dtype=np.int64))
+            dimensions.append((np.concatenate(keys), np.concatenate(positions)))
+        return CrossTab(questions, build_table(shape, dimensions))
+
+
+def load_columns(schema, responses):
+    """
+    Read the columns of a set of responses, with three streamed queries.
+
+    responses is a Response queryset. Returns the columns, in id order, and
+    the latest updated_at of the responses read (None when there are none).
+    """
+    rows = responses.order_by('id').values_list(
+        'id', 'created_at', 'updated_at', 'completion_time', 'is_complete', 'respondent_id'
+    )
+    ids, created, updated, completion, complete, authenticated = [], [], [], [], [], []
+    for response_id, created_at, updated_at, completion_time, is_complete, respondent_id in rows.iterator(chunk_size=10000):
+        ids.append(response_id)
+        created.append(_epoch(created_at))
+        updated.append(_epoch(updated_at))
+        completion.append(completion_time.total_seconds() if completion_time is not None else np.nan)
+        complete.append(is_complete)
+        authenticated.append(respondent_id is not None)
+    columns = {
+        'id': np.array(ids, dtype=np.int64),
+        'created': np.array(created, dtype=np.float64),
+        'updated': np.array(updated, dtype=np.float64),
+        'completion': np.array(completion, dtype=np.float64),
+        'complete': np.array(complete, dtype=bool),
+        'authenticated': np.array(authenticated, dtype=bool),
+    }
+    watermark = float(columns['updated'].max()) if ids else None
+    ids = columns['id']
+
+    # Answered questions
+    answers = Answer.objects.filter(response__in=responses).values_list('response_id', 'question_id')
+    answers = np.fromiter(chain.from_iterable(answers.iterator(chunk_size=10000)), dtype=np.int64).reshape(-1, 2)
+    # Responses created after the first query are left to the next catch-up
+    answers = answers[np.isin(answers[:, 0], ids)]
+    answer_rows = np.searchsorted(ids, answers[:, 0])
+    for question in schema:
+        column = np.zeros(len(ids), dtype=bool)
+        column[answer_rows[answers[:, 1] == question.id]] = True
+        columns[f'answered_{question.id}'] = column
+
+    # Selected options, as positions within their question
+    Through = Answer.selected_options.through
+    links = Through.objects.filter(answer__response__in=responses).values_list('answer__response_id', 'questionoption_id')
+    links = np.fromiter(chain.from_iterable(links.iterator(chunk_size=10000)), dtype=np.int64).reshape(-1, 2)
+    option_questions = [question for question in schema if question.question_type.has_options]
+    size = max([option.id for question in option_questions for option in question.get_options()], default=0) + 1
+    question_of = np.full(size, -1, dtype=np.int64)
+    position_of = np.full(size, -1, dtype=np.int64)
+    for question in option_questions:
+        for position, option in enumerate(question.get_options()):
+            question_of[option.id] = question.id
+            position_of[option.id] = position
+    # Options added after the schema was compiled are ignored
+    links = links[(links[:, 1] < size) & np.isin(links[:, 0], ids)]
+    link_rows = np.searchsorted(ids, links[:, 0])
+    link_questions = question_of[links[:, 1]]
+    link_positions = position_of[links[:, 1]]
+    for question in option_questions:
+        selected = link_questions == question.id
+        rows, positions = link_rows[selected], link_positions[selected]
+        if question.question_type.has_multiple_answers:
+            column = np.zeros((len(ids), _words(question.get_options())), dtype=np.uint64)
+            np.bitwise_or.at(
+                column, (rows, positions // WORD_BITS),
+                np.left_shift(np.uint64(1), (positions % WORD_BITS).astype(np.uint64)),
+            )
+        else:
+            column = np.full(len(ids), -1, dtype=np.int16)
+            column[rows] = positions
+        columns[f'options_{question.id}'] = column
+    return columns, watermark
+
+
+def build_cube(survey, schema):
+    """Build the cube of a survey's responses from the database"""
+    columns, watermark = load_columns(schema, Response.objects.filter(survey_id=survey.pk))
+    return ResponseCube(survey.pk, schema.version, watermark, columns)
+
+
+def catch_up(cube, survey, schema):
+    """
+    Get a cube that includes the responses updated since a cube's watermark.
+
+    Returns the cube itself when nothing changed, None when it must be
+    rebuilt because responses were deleted since it was built. Rows of
+    responses updated again are replaced.
+    """
+    survey_responses = Response.objects.filter(survey_id=survey.pk)
+    changed = survey_responses
+    if cube.watermark is not None:
+        # Responses written by transactions still open when the cube was read
+        # carry an updated_at older than the watermark: go back by a margin
+        since = cube.watermark - _setting('LAG_SECONDS', 60)
+        changed = changed.filter(updated_at__gte=datetime.fromtimestamp(since, tz=dt_timezone.utc))
+    columns, watermark = load_columns(schema, changed)
+
+    if not len(columns['id']):
+        merged = cube
+    else:
+        # Rows already in the cube are replaced, unless re-read unchanged
+        known = np.isin(columns['id'], cube.columns['id'])
+        unchanged = known.all() and np.array_equal(
+            columns['updated'], cube.columns['updated'][np.searchsorted(cube.columns['id'], columns['id'])]
+        )
+        if unchanged:
+            merged = cube
+        else:
+            kept = ~np.isin(cube.columns['id'], columns['id'])
+            order = np.argsort(np.concatenate([cube.columns['id'][kept], columns['id']]), kind='stable')
+            merged = ResponseCube(
+                cube.survey_id,
+                cube.version,
+                max(watermark, cube.watermark or watermark),
+                {name: np.concatenate([column[kept], columns[name]])[order] for name, column in cube.columns.items()},
+            )
+            merged.persisted = cube.persisted
+            # New responses usually come after the others: existing rows keep
+            # their number, and the bitmap index is patched instead of rebuilt
+            appended = columns['id'][~known]
+            if cube._index is not None and (not len(appended) or not len(cube) or appended.min() > cube.columns['id'][-1]):
+                rows = np.searchsorted(merged.columns['id'], columns['id'])
+                merged._index = cube._index.updated(merged, schema, rows)
+    # Deleted responses leave rows behind: compare with the responses up to the
+    # last id loaded, those completed since are read by the next catch-up
+    if len(merged):
+        survey_responses = survey_responses.filter(id__lte=int(merged.columns['id'][-1]))
+    if len(merged) != survey_responses.count():
+        return None
+    merged.refreshed = time.monotonic()
+    return merged
+
+
+# Persistence
+
+def _cube_dir(survey_id):
+    return os.path.join(
+        _setting('DIR', os.path.join(settings.BASE_DIR, 'var', 'cubes')), str(CUBE_FORMAT), str(survey_id)
+    )
+
+
+def save_cube(cube):
+    """
+    Write a cube to disk, one .npy file per column.
+
+    Each save goes to a new generation directory; the pointer to the
+    current generation is then swapped atomically and older generations
+    removed, so concurrent readers only ever load a complete cube.
+    """
+    directory = _cube_dir(cube.survey_id)
+    generation = uuid.uuid4().hex
+    path = os.path.join(directory, generation)
+    os.makedirs(path)
+    for name, column in cube.columns.items():
+        np.save(os.path.join(path, f'{name}.npy'), column)
+    pointer = os.path.join(directory, 'current.json')
+    with open(pointer + '.tmp', 'w') as stream:
+        json.dump({
+            'generation': generation,
+            'version': cube.version,
+            'watermark': cube.watermark,
+            'columns': list(cube.columns),
+        }, stream)
+    os.replace(pointer + '.tmp', pointer)
+    for entry in os.listdir(directory):
+        if entry != generation and os.path.isdir(os.path.join(directory, entry)):
+            shutil.rmtree(os.path.join(directory, entry), ignore_errors=True)
+
+
+def load_cube(survey, schema):
+    """Load a survey's persisted cube memory-mapped, None when absent or not of the schema's version"""
+    directory = _cube_dir(survey.pk)
+    try:
+        with open(os.path.join(directory, 'current.json')) as stream:
+            meta = json.load(stream)
+        if meta['version'] != schema.version or meta['columns'] != _column_names(schema):
+            return None
+        path = os.path.join(directory, meta['generation'])
+        columns = {
+            name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in meta['columns']
+        }
+    except (OSError, ValueError, KeyError):
+        return None
+    cube = ResponseCube(survey.pk, meta['version'], meta['watermark'], columns)
+    # Catch up on first use
+    cube.refreshed = float('-inf')
+    cube.persisted = time.time()
+    return cube
+
+
+def _persist(cube):
+    try:
+        save_cube(cube)
+    except OSError:
+        logger.exception("Could not persist the response cube of survey %s", cube.survey_id)
+
+
+# Process registry
+
+_cubes = OrderedDict()
+_cubes_lock = threading.Lock()
+_survey_locks = {}
+
+
+def _survey_lock(survey_id):
+    with _cubes_lock:
+        return _survey_locks.setdefault(survey_id, threading.Lock())
+
+
+def _register(cube):
+    budget = _setting('MEMORY_BUDGET', 256 * 1024 * 1024)
+    with _cubes_lock:
+        _cubes[cube.survey_id] = cube
+        _cubes.move_to_end(cube.survey_id)
+        total = sum(other.nbytes for other in _cubes.values())
+        while total > budget and len(_cubes) > 1:
+            survey_id, evicted = _cubes.popitem(last=False)
+            total -= evicted.nbytes
+
+
+def evict_cube(survey_id):
+    with _cubes_lock:
+        _cubes.pop(survey_id, None)
+
+
+def response_watermark(survey):
+    """
+    Cheap stamp of the state of a survey's responses, with one indexed query.
+
+    Changes whenever a response is created, updated or deleted.
+    """
+    stamp = Response.objects.filter(survey_id=survey.pk).aggregate(last_update=Max('updated_at'), count=Count('id'))
+    last_update = stamp['last_update'].timestamp() if stamp['last_update'] else 0
+    return f"{last_update}:{stamp['count']}"
+
+
+def get_cube(survey, schema, refresh=False):
+    """
+    Get the up-to-date cube of a survey, for a compiled schema of its current version.
+
+    Uses the cube held by the process, else the persisted one, else builds
+    it, then catches up with the responses updated since, unless it did
+    less than SURVEY_CUBE_REFRESH_SECONDS ago and refresh is false. Persists
+    the cube when it was built, and after catching up at most once every
+    SURVEY_CUBE_PERSIST_SECONDS.
+    """
+    with _survey_lock(survey.pk):
+        with _cubes_lock:
+            cube = _cubes.get(survey.pk)
+        if cube is not None and cube.version != schema.version:
+            cube = None
+        if cube is None:
+            cube = load_cube(survey, schema)
+
+        persist = False
+        if cube is not None and (refresh or time.monotonic() - cube.refreshed >= _setting('REFRESH_SECONDS', 5)):
+            updated = catch_up(cube, survey, schema)
+            if updated is not None and updated is not cube:
+                persist = time.time() - updated.persisted >= _setting('PERSIST_SECONDS', 60)
+            cube = updated
+        if cube is None:
+            cube = build_cube(survey, schema)
+            persist = True
+        if persist:
+            _persist(cube)
+            cube.persisted = time.time()
+        _register(cube)
+        return cube
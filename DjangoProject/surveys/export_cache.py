@@ -0,0 +1,141 @@
+"""
+On-disk cache of export files.
+
+Exports are stored in SURVEY_EXPORT_DIR under a key made of the survey,
+the format, the filter parameters, the schema version and the watermark of
+the survey's complete responses (latest update and count). While no
+response completes, changes or is deleted, the same export is served from
+its file, with its Content-Length and the key as ETag, instead of being
+generated again.
+
+Files are written under a temporary name and renamed once complete.
+Serving a file refreshes its modification time, and the least recently
+used files are removed once the directory exceeds
+SURVEY_EXPORT_CACHE_BYTES.
+"""
+
+import hashlib
+import json
+import os
+import time
+import uuid
+
+from django.conf import settings
+from django.db.models import Count, Max
+from django.http import FileResponse, HttpResponseNotModified
+
+from .models import Response
+
+PARTIAL_SUFFIX = '.tmp'
+
+
+def directory():
+    return getattr(settings, 'SURVEY_EXPORT_DIR', os.path.join(settings.BASE_DIR, 'var', 'exports'))
+
+
+def completed_watermark(survey):
+    """Stamp of the state of a survey's complete responses, with one indexed query"""
+    stamp = Response.objects.filter(survey_id=survey.pk, is_complete=True).aggregate(
+        last_update=Max('updated_at'), count=Count('id')
+    )
+    last_update = stamp['last_update'].timestamp() if stamp['last_update'] else 0
+    return f"{last_update}:{stamp['count']}"
+
+
+def export_key(survey, schema, export_format, params):
+    """Cache key of an export; params holds the filter parameters"""
+    stamp = json.dumps(
+        [survey.pk, export_format, schema.version, completed_watermark(survey), params],
+        sort_keys=True, default=str,
+    )
+    return hashlib.sha1(stamp.encode()).hexdigest()
+
+
+def cache_path(key, export_format):
+    return os.path.join(directory(), f"{key}.{export_format}")
+
+
+def partial_path(path):
+    """Temporary name to write a file under before store()"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return f"{path}.{uuid.uuid4().hex[:8]}{PARTIAL_SUFFIX}"
+
+
+def lookup(path):
+    """Open a cached file, marking it as recently used; None when it is not cached"""
+    try:
+        os.utime(path)
+        return open(path, 'rb')
+    except OSError:
+        return None
+
+
+def store(partial, path):
+    """Move a completely written file into the cache, then keep the cache within its budget"""
+    os.replace(partial, path)
+    evict()
+
+
+def evict():
+    """Remove the least recently used files beyond SURVEY_EXPORT_CACHE_BYTES, and abandoned partial files"""
+    budget = getattr(settings, 'SURVEY_EXPORT_CACHE_BYTES', 1024 ** 3)
+    abandoned = time.time() - getattr(settings, 'SURVEY_EXPORT_JOB_TTL', 3600)
+    files = []
+    try:
+        names = os.listdir(directory())
+    except FileNotFoundError:
+        return
+    for name in names:
+        path = os.path.join(directory(), name)
+        try:
+            stat = os.stat(path)
+            if name.endswith(PARTIAL_SUFFIX):
+                # Being written, unless its writer stopped long ago
+                if stat.st_mtime < abandoned:
+                    os.remove(path)
+                continue
+        except OSError:
+            # Removed by another process meanwhile
+            continue
+        files.append((stat.st_mtime, stat.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= budget:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def tee(chunks, path):
+    """
+    Pass the byte or text chunks of a streamed export through, storing them in the cache.
+
+    The file is only stored when the stream was consumed entirely; an
+    interrupted download leaves nothing behind.
+    """
+    partial = partial_path(path)
+    try:
+        with open(partial, 'wb') as output:
+            for chunk in chunks:
+                output.write(chunk.encode() if isinstance(chunk, str) else chunk)
+                yield chunk
+        store(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+
+def serve(request, cached, key, filename, content_type):
+    """Response serving a file opened by lookup(), or 304 when the client holds it already"""
+    etag = f'"{key}"'
+    if request.headers.get('If-None-Match') == etag:
+        cached.close()
+        response = HttpResponseNotModified()
+    else:
+        response = FileResponse(cached, as_attachment=True, filename=filename, content_type=content_type)
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,152 @@
+"""
+Background export jobs.
+
+Large exports are written outside the request cycle, by a small pool of
+threads of the process that accepted the request, into the export cache
+(see export_cache.py). The state of each job (status, progress, size) is
+kept in the shared cache, so any process can report it and serve the
+finished file from the shared directory. An export already in the export
+cache makes a job that is done from the start.
+
+Requests for the same export (survey, format, filter, schema version and
+state of the complete responses) are de-duplicated: the first one creates
+the job with an atomic cache.add, the others follow it. A job whose state
+has not moved for SURVEY_EXPORT_STALE_SECONDS is taken for dead (its
+process stopped) and replaced by the next identical request; jobs waiting
+for a thread of the pool are kept alive by the progress of the running
+ones.
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections
+from django.utils.translation import gettext as _
+
+from . import export_cache
+
+logger = logging.getLogger(__name__)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+
+def _setting(name, default):
+    return getattr(settings, f'SURVEY_EXPORT_{name}', default)
+
+
+def _job_key(job_id):
+    return f"surveys:export:job:{job_id}"
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Jobs submitted to this process's pool and not started yet, by id
+_queued = {}
+_queued_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=_setting('WORKERS', 2), thread_name_prefix='survey-exports')
+        return _executor
+
+
+def get_job(job_id):
+    """State of a job as a dict, None when unknown or expired; dead jobs are reported failed"""
+    job = cache.get(_job_key(job_id))
+    if job and job['status'] in (QUEUED, RUNNING) and time.time() - job['updated_at'] > _setting('STALE_SECONDS', 300):
+        job = dict(job, status=FAILED, error=_("The export was interrupted, please try again."))
+    return job
+
+
+def _save_job(job, **changes):
+    job.update(changes, updated_at=time.time())
+    cache.set(_job_key(job['id']), job, _setting('JOB_TTL', 3600))
+
+
+def _heartbeat_queued():
+    """Refresh the state of the jobs waiting in this process's pool, so they are not taken for dead"""
+    with _queued_lock:
+        jobs = list(_queued.values())
+    for job in jobs:
+        _save_job(job)
+
+
+def job_path(job):
+    return export_cache.cache_path(job['key'], job['format'])
+
+
+def start_export(survey, schema, export_format, responses, params, writer):
+    """
+    Start an export job, or join the identical one already started.
+
+    writer(path, schema, responses, progress) writes the file, calling
+    progress(done, total) as it goes. params holds the filter parameters
+    that responses was built from. Returns the job's state.
+    """
+    export_key = export_cache.export_key(survey, schema, export_format, params)
+    job = {
+        'id': uuid.uuid4().hex, 'key': export_key, 'survey_id': survey.pk, 'format': export_format,
+        'status': QUEUED, 'done': 0, 'total': None, 'size': None, 'error': '',
+    }
+    cached = export_cache.lookup(job_path(job))
+    if cached is not None:
+        with cached:
+            _save_job(job, status=DONE, size=os.fstat(cached.fileno()).st_size)
+        return job
+
+    key = f"surveys:export:request:{export_key}"
+    for attempt in range(2):
+        if cache.add(key, job['id'], _setting('JOB_TTL', 3600)):
+            _save_job(job)
+            with _queued_lock:
+                _queued[job['id']] = job
+            _get_executor().submit(_run, job, schema, responses, writer)
+            return job
+        existing = get_job(cache.get(key))
+        if existing is not None and existing['status'] in (QUEUED, RUNNING):
+            return existing
+        # The identical job failed, expired or its file was evicted, start over
+        cache.delete(key)
+    raise RuntimeError("Could not start the export job")
+
+
+def _run(job, schema, responses, writer):
+    # Pool threads live outside the request cycle, recycle their connections here
+    close_old_connections()
+    with _queued_lock:
+        _queued.pop(job['id'], None)
+    path = job_path(job)
+    partial = export_cache.partial_path(path)
+    try:
+        _save_job(job, status=RUNNING)
+
+        def progress(done, total):
+            _save_job(job, done=done, total=total)
+            _heartbeat_queued()
+
+        writer(partial, schema, responses, progress)
+        size = os.path.getsize(partial)
+        export_cache.store(partial, path)
+        _save_job(job, status=DONE, size=size)
+    except Exception:
+        # The details go to the logs only
+        logger.exception("Export job %s failed", job['id'])
+        _save_job(job, status=FAILED, error=_("The export failed, please try again."))
+        if os.path.exists(partial):
+            os.remove(partial)
+    finally:
+        close_old_connections()
+
@@ -0,0 +1,94 @@
+"""
+Chunked reading of survey responses for exports.
+
+Responses are read in keyset-paginated chunks (id greater than the last id
+of the previous chunk), and each chunk's answers are fetched together with
+their selected options in one query. Option texts come from the compiled
+schema, so an export costs two queries per chunk whatever the number of
+questions, and holds a single chunk in memory at a time.
+"""
+
+from collections import namedtuple
+
+from django.conf import settings
+from django.utils.translation import gettext as _
+
+from .models import Answer
+
+# A response as read for exports; answers maps question ids to (data, option_ids),
+# option_ids being the set of the selected options' ids
+ExportResponse = namedtuple(
+    'ExportResponse', ['id', 'created_at', 'updated_at', 'completion_time', 'respondent_id', 'answers']
+)
+
+
+def chunk_size():
+    return getattr(settings, 'SURVEY_EXPORT_CHUNK_SIZE', 2000)
+
+
+def fetch_answers(response_ids, question_ids=None):
+    """
+    Answers of some responses with their selected options, in one query.
+
+    Returns a dict mapping response ids to dicts mapping question ids to
+    (data, option_ids). question_ids optionally limits the questions read.
+    """
+    rows = Answer.objects.filter(response_id__in=list(response_ids))
+    if question_ids is not None:
+        rows = rows.filter(question_id__in=list(question_ids))
+    answers = {}
+    for response_id, question_id, data, option_id in rows.values_list(
+        'response_id', 'question_id', 'data', 'selected_options'
+    ):
+        entry = answers.setdefault(response_id, {}).setdefault(question_id, (data, set()))
+        if option_id is not None:
+            entry[1].add(option_id)
+    return answers
+
+
+def export_chunks(schema, responses, size=None):
+    """
+    Iterate over a set of responses in id order, as lists of ExportResponse.
+
+    responses is a Response queryset; its ordering is ignored.
+    """
+    size = size or chunk_size()
+    question_ids = [question.id for question in schema]
+    last_id = 0
+    while True:
+        rows = list(
+            responses.filter(id__gt=last_id).order_by('id').values_list(
+                'id', 'created_at', 'updated_at', 'completion_time', 'respondent_id'
+            )[:size]
+        )
+        if not rows:
+            return
+        ids = [row[0] for row in rows]
+        answers = fetch_answers(ids, question_ids)
+        yield [ExportResponse(*row, answers.get(row[0], {})) for row in rows]
+        if len(rows) < size:
+            return
+        last_id = ids[-1]
+
+
+def export_header(schema):
+    """Column titles of the flat exports (CSV, Excel)"""
+    return [_('Respondent ID'), _('Date')] + [question.text for question in schema]
+
+
+def answer_text(question, answer):
+    """
+    Text of an answer in the flat exports: the selected options' texts in
+    option order for questions with options, the stored data otherwise.
+    """
+    if answer is None:
+        return ""
+    data, option_ids = answer
+    if question.question_type.has_options:
+        return ", ".join(option.text for option in question.get_options() if option.id in option_ids)
+    return data or ""
+
+
+def export_cells(schema, response):
+    """Answer cells of a response in the flat exports, one per question"""
+    return [answer_text(question, response.answers.get(question.id)) for question in schema]
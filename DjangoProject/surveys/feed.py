@@ -0,0 +1,97 @@
+"""
+Incremental feed of a survey's complete responses.
+
+Responses are paged in (updated_at, id) order, and a page ends with a
+cursor holding the last (updated_at, id) served: passing it back as
+``since`` returns only the responses completed or changed after it, so
+consumers pull deltas instead of full exports. A response changed after it
+was served comes back with its new state; consumers upsert by id.
+
+Responses updated during the last SURVEY_FEED_SETTLE_SECONDS are held
+back: their updated_at is set before their transaction commits, and a
+cursor must not move past a response that is not visible yet.
+
+Each page is one query for the responses and one for their answers with
+their selected options (see exports.fetch_answers), serialized as one JSON
+object per line (NDJSON).
+"""
+
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils import timezone
+
+from .exports import fetch_answers
+from .models import Response
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+class CursorError(ValueError):
+    """Malformed feed cursor"""
+
+
+def encode_cursor(updated_at, response_id):
+    """Opaque cursor of a position in the feed: microseconds since the epoch and id"""
+    micros = (updated_at - _EPOCH) // timedelta(microseconds=1)
+    return f"{micros}-{response_id}"
+
+
+def decode_cursor(cursor):
+    """(updated_at, id) of a cursor; raises CursorError"""
+    try:
+        micros, response_id = (int(part) for part in cursor.split('-'))
+        return _EPOCH + timedelta(microseconds=micros), response_id
+    except (AttributeError, ValueError, OverflowError):
+        raise CursorError(cursor)
+
+
+def page_size(limit=None):
+    maximum = getattr(settings, 'SURVEY_FEED_PAGE_SIZE', 1000)
+    return min(limit, maximum) if limit else maximum
+
+
+def feed_page(survey_id, since=None, limit=None):
+    """
+    One page of the feed of a survey, after the position of cursor since (from the start when None).
+
+    Returns (lines, next_cursor, has_more): lines is the NDJSON text of
+    the page, next_cursor the cursor to pass for the next page (since
+    itself when the page is empty).
+    """
+    size = page_size(limit)
+    settled = timezone.now() - timedelta(seconds=getattr(settings, 'SURVEY_FEED_SETTLE_SECONDS', 10))
+    responses = Response.objects.filter(survey_id=survey_id, is_complete=True, updated_at__lte=settled)
+    if since is not None:
+        updated_at, response_id = decode_cursor(since)
+        responses = responses.filter(Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, id__gt=response_id))
+    rows = list(
+        responses.order_by('updated_at', 'id').values_list(
+            'id', 'respondent_id', 'created_at', 'updated_at', 'completion_time'
+        )[:size + 1]
+    )
+    has_more = len(rows) > size
+    rows = rows[:size]
+    if not rows:
+        return '', since, False
+
+    answers = fetch_answers([row[0] for row in rows])
+    lines = []
+    for response_id, respondent_id, created_at, updated_at, completion_time in rows:
+        lines.append(json.dumps({
+            'id': response_id,
+            'survey_id': survey_id,
+            'respondent_id': respondent_id,
+            'created_at': created_at,
+            'updated_at': updated_at,
+            'completion_seconds': completion_time.total_seconds() if completion_time is not None else None,
+            'answers': [
+                {'question_id': question_id, 'data': data, 'option_ids': sorted(option_ids)}
+                for question_id, (data, option_ids) in sorted(answers.get(response_id, {}).items())
+            ],
+        }, cls=DjangoJSONEncoder, separators=(',', ':')))
+    last_id, last_updated_at = rows[-1][0], rows[-1][3]
+    return '\n'.join(lines) + '\n', encode_cursor(last_updated_at, last_id), has_more
@@ -0,0 +1,63 @@
+"""
+Cached HTML fragments of survey questions.
+
+The markup of a question and its options only depends on the question, so
+it is rendered once per question version and language, and kept in the
+shared cache. A question's updated_at changes whenever it is saved or one
+of its options is saved or deleted (see signals.py), which invalidates its
+fragments. Questions rendered with a respondent's prefilled answer are not
+cached.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.template.loader import render_to_string
+from django.utils import translation
+
+# Bump when the question_types templates change
+FRAGMENT_FORMAT = 1
+
+
+def question_template_name(question):
+    """Template of a question's input, as take_survey.html used to include it"""
+    return 'surveys/question_types/' + question.question_type.template_name.replace('questions/', '')
+
+
+def _fragment_key(question):
+    return (
+        f"surveys:fragment:{FRAGMENT_FORMAT}:{question.id}:"
+        f"{question.updated_at.timestamp()}:{translation.get_language()}"
+    )
+
+
+def _render(question, answer=''):
+    return render_to_string(question_template_name(question), {'question': question, 'answer': answer})
+
+
+def render_question(question, answer=None):
+    """Render a question's input, from the cache when there is no prefilled answer"""
+    if answer:
+        return _render(question, answer)
+    key = _fragment_key(question)
+    html = cache.get(key)
+    if html is None:
+        html = _render(question)
+        cache.set(key, html, getattr(settings, 'SURVEY_FRAGMENT_CACHE_TIMEOUT', 24 * 3600))
+    return html
+
+
+def prefetch_fragments(questions):
+    """
+    Get the cached fragments of several questions with one cache lookup.
+
+    Missing fragments are rendered and stored with one cache write. Returns
+    a dict mapping question ids to HTML, meant to be passed to templates as
+    ``question_fragments``.
+    """
+    keys = {_fragment_key(question): question for question in questions}
+    cached = cache.get_many(list(keys))
+    missing = {key: _render(question) for key, question in keys.items() if key not in cached}
+    if missing:
+        cache.set_many(missing, getattr(settings, 'SURVEY_FRAGMENT_CACHE_TIMEOUT', 24 * 3600))
+        cached.update(missing)
+    return {question.id: cached[key] for key, question in keys.items()}
@@ -0,0 +1,243 @@
+"""
+Bulk ingestion of survey submissions.
+
+A submission is validated entirely in memory against its compiled schema
+(see validation.py), then every Answer row and every Answer.selected_options
+row is written with a handful of bulk statements inside a single
+transaction.
+"""
+
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from . import sketches, text
+from .models import Answer, Response, ResponseRollup, SurveyCounter, SurveyStatistics
+from .validation import validate_post
+
+
+def answer_rows(questions_by_id, cleaned):
+    """
+    Turn cleaned answers into storable rows.
+
+    Yields (question_id, data, option_ids) tuples, where data is the value
+    stored in Answer.data and option_ids the deduplicated selected options.
+    """
+    for question_id, answer_data in cleaned.items():
+        data = json.dumps(answer_data) if isinstance(answer_data, (dict, list)) else answer_data
+        option_ids = []
+        if questions_by_id[question_id].question_type.has_options:
+            values = answer_data if isinstance(answer_data, list) else [answer_data]
+            option_ids = list(dict.fromkeys(int(value) for value in values))
+        yield question_id, data, option_ids
+
+
+def write_answers(response, questions, cleaned):
+    """
+    Replace the answers of the given questions with the cleaned answers.
+
+    Existing answers are deleted with one statement, new Answer rows are
+    created with one bulk insert, and their selected options with a second
+    one on the through table. Must be called inside a transaction.
+    """
+    questions_by_id = {question.id: question for question in questions}
+    Answer.objects.filter(response=response, question_id__in=list(questions_by_id)).delete()
+    if not cleaned:
+        return
+
+    rows = list(answer_rows(questions_by_id, cleaned))
+    Answer.objects.bulk_create([
+        Answer(response=response, question_id=question_id, data=data)
+        for question_id, data, option_ids in rows
+    ])
+
+    # MySQL does not return primary keys from bulk inserts, fetch them back
+    answer_ids = dict(
+        Answer.objects.filter(response=response, question_id__in=list(cleaned))
+        .values_list('question_id', 'id')
+    )
+
+    Through = Answer.selected_options.through
+    links = [
+        Through(answer_id=answer_ids[question_id], questionoption_id=option_id)
+        for question_id, data, option_ids in rows
+        for option_id in option_ids
+    ]
+    if links:
+        Through.objects.bulk_create(links)
+
+
+def ensure_response(response):
+    """
+    Insert a response that was started from a signed token (see tokens.py).
+
+    Such responses only exist in memory until their first write; their
+    created_at holds the start time carried by the token, which is kept.
+    """
+    if response.pk is not None:
+        return
+    started_at = response.created_at
+    response.save()
+    if started_at:
+        Response.objects.filter(pk=response.pk).update(created_at=started_at)
+        response.created_at = started_at
+    SurveyStatistics.record_started(response.survey_id)
+    ResponseRollup.record(response.survey_id, response.created_at, started=1)
+
+
+def mark_complete(response):
+    """
+    Mark a response complete and commit its quota reservation.
+
+    Must be called inside the transaction that writes the answers. The
+    counter and the statistics only move when the response was not already
+    complete.
+    """
+    now = timezone.now()
+    response.completion_time = now - response.created_at
+    newly_completed = Response.objects.filter(pk=response.pk, is_complete=False).update(
+        is_complete=True, completion_time=response.completion_time, updated_at=now
+    )
+    response.is_complete = True
+    SurveyCounter.commit(response.survey_id, completed=newly_completed)
+    if newly_completed:
+        SurveyStatistics.record_completions(response.survey_id, [(response.pk, response.completion_time)])
+        text.record_completions([response.pk])
+        sketches.record_completions(response.survey_id, [response.pk])
+        ResponseRollup.record(response.survey_id, now, completed=1)
+
+
+def missing_required(response, questions):
+    """
+    Required questions among some compiled questions that a response has not answered.
+
+    Reads the stored answers with one query. Returns a dict mapping the
+    missing questions' ids to an error message, as validate_post does.
+    """
+    required = [question.id for question in questions if question.required]
+    answered = set()
+    if response.pk is not None and required:
+        answered = set(Answer.objects.filter(response=response, question_id__in=required).values_list(
+            'question_id', flat=True
+        ))
+    return {
+        question_id: _("Veuillez répondre à toutes les questions obligatoires.")
+        for question_id in required
+        if question_id not in answered
+    }
+
+
+def store_submission(response, questions, cleaned, complete=True):
+    """
+    Write validated answers, and optionally complete the response, in one transaction.
+
+    Completing requires a quota slot reserved with SurveyCounter.reserve.
+    """
+    with transaction.atomic():
+        ensure_response(response)
+        write_answers(response, questions, cleaned)
+        if complete:
+            mark_complete(response)
+
+
+def complete_submission(response, schema, cleaned):
+    """
+    Store a validated, completed submission within the survey's response quota.
+
+    Goes through the write-behind buffer when it is enabled, which commits
+    the reservation when it flushes. Returns False, without writing
+    anything, when the survey is full.
+    """
+    from . import writebehind
+
+    if not SurveyCounter.reserve(schema.survey_id, schema.max_responses):
+        return False
+    try:
+        if writebehind.is_enabled():
+            writebehind.get_buffer().append(response, schema, cleaned)
+        else:
+            store_submission(response, schema, cleaned)
+    except Exception:
+        SurveyCounter.release(schema.survey_id)
+        raise
+    return True
+
+
+def complete_response(response, max_responses):
+    """Complete a response whose answers are already stored, False when the survey is full"""
+    if not SurveyCounter.reserve(response.survey_id, max_responses):
+        return False
+    try:
+        with transaction.atomic():
+            ensure_response(response)
+            mark_complete(response)
+    except Exception:
+        SurveyCounter.release(response.survey_id)
+        raise
+    return True
+
+
+def ingest_submission(response, schema, post_data, complete=True):
+    """
+    Validate and store a whole submission against the survey's compiled schema.
+
+    Nothing is written when any answer is invalid. Otherwise all answers are
+    written, and the response is optionally marked complete, in one
+    transaction. Returns a dict mapping question ids to error messages,
+    empty on success; a full survey is reported under the None key.
+    """
+    cleaned, errors = validate_post(schema, post_data)
+    if errors:
+        return errors
+    if not complete:
+        store_submission(response, schema, cleaned, complete=False)
+    elif not complete_submission(response, schema, cleaned):
+        errors[None] = _("This survey has reached its maximum number of responses.")
+    return errors
+
+
+_write_executor = None
+_write_executor_lock = threading.Lock()
+
+
+def _get_write_executor():
+    global _write_executor
+    with _write_executor_lock:
+        if _write_executor is None:
+            _write_executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'SURVEY_ASYNC_WRITE_WORKERS', 4),
+                thread_name_prefix='survey-writes',
+            )
+        return _write_executor
+
+
+def _store_in_worker(response, questions, cleaned, complete):
+    # Pool threads live outside the request cycle, recycle their connections here
+    close_old_connections()
+    try:
+        if complete:
+            return complete_submission(response, questions, cleaned)
+        store_submission(response, questions, cleaned, complete=False)
+        return True
+    finally:
+        close_old_connections()
+
+
+async def astore_submission(response, questions, cleaned, complete=True):
+    """
+    Async counterpart of complete_submission, or of store_submission when
+    complete is False. Returns False when the survey is full.
+
+    The transaction runs on a bounded pool of writer threads, so the number
+    of database connections used by async views stays capped at
+    SURVEY_ASYNC_WRITE_WORKERS however many requests are in flight.
+    """
+    return await sync_to_async(
+        _store_in_worker, thread_sensitive=False, executor=_get_write_executor()
+    )(response, questions, cleaned, complete)
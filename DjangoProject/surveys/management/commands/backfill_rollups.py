@@ -0,0 +1,47 @@
+from collections import Counter
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from surveys.models import Response, ResponseRollup, Survey
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the hourly response rollups used by trend charts from the responses table. "
+        "Run it once after deploying rollups, or to repair them; submissions written while "
+        "a survey is being rebuilt may be missed until the next run. "
+        "Only exact when SURVEY_AGGREGATE_FLUSH_INTERVAL is 0 or no process has deltas queued."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey_ids', nargs='*', type=int, help="Surveys to rebuild, all by default")
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        survey_ids = options['survey_ids'] or Survey.objects.values_list('pk', flat=True)
+        for survey_id in survey_ids:
+            started = Counter()
+            completed = Counter()
+            rows = Response.objects.filter(survey_id=survey_id).values_list(
+                'created_at', 'is_complete', 'completion_time', 'updated_at'
+            )
+            for created_at, is_complete, completion_time, updated_at in rows.iterator(chunk_size=options['batch_size']):
+                started[ResponseRollup.bucket_for(created_at)] += 1
+                if is_complete:
+                    # Completion moment: start plus duration, or the last update when unknown
+                    completed_at = created_at + completion_time if completion_time is not None else updated_at
+                    completed[ResponseRollup.bucket_for(completed_at)] += 1
+
+            with transaction.atomic():
+                ResponseRollup.objects.filter(survey_id=survey_id).delete()
+                ResponseRollup.objects.bulk_create(
+                    [
+                        ResponseRollup(survey_id=survey_id, bucket=bucket, started=started[bucket], completed=completed[bucket])
+                        for bucket in sorted(set(started) | set(completed))
+                    ],
+                    batch_size=options['batch_size'],
+                )
+            self.stdout.write(
+                f"Survey {survey_id}: {sum(started.values())} started, {sum(completed.values())} completed responses"
+            )
@@ -0,0 +1,69 @@
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Exists, F, OuterRef
+from django.utils import timezone
+
+from surveys.models import Answer, Response, ResponseRollup, SurveyStatistics
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete abandoned incomplete responses in batches. Rows are deleted with "
+        "plain DELETE statements on their ids, without loading them as objects."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=7,
+                            help="Only delete responses untouched for this many days (default: 7)")
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--include-partial', action='store_true',
+                            help="Also delete incomplete responses that have saved answers")
+        parser.add_argument('--dry-run', action='store_true', help="Only count the matching responses")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        abandoned = Response.objects.filter(is_complete=False, updated_at__lt=cutoff)
+        if not options['include_partial']:
+            abandoned = abandoned.filter(~Exists(Answer.objects.filter(response=OuterRef('pk'))))
+
+        if options['dry_run']:
+            self.stdout.write(f"{abandoned.count()} abandoned responses would be deleted")
+            return
+
+        through_table = Answer.selected_options.through._meta.db_table
+        answer_table = Answer._meta.db_table
+        response_table = Response._meta.db_table
+        deleted = 0
+        while True:
+            rows = list(abandoned.order_by('pk').values_list('pk', 'survey_id', 'created_at')[:options['batch_size']])
+            if not rows:
+                break
+            ids = [pk for pk, survey_id, created_at in rows]
+            placeholders = ', '.join(['%s'] * len(ids))
+            with transaction.atomic(), connection.cursor() as cursor:
+                if options['include_partial']:
+                    cursor.execute(
+                        f"DELETE FROM {through_table} WHERE answer_id IN "
+                        f"(SELECT id FROM {answer_table} WHERE response_id IN ({placeholders}))",
+                        ids,
+                    )
+                    cursor.execute(f"DELETE FROM {answer_table} WHERE response_id IN ({placeholders})", ids)
+                cursor.execute(f"DELETE FROM {response_table} WHERE id IN ({placeholders})", ids)
+                # Unsigned column: leave any inconsistency to reconcile_statistics rather than underflow
+                for survey_id, count in Counter(survey_id for pk, survey_id, created_at in rows).items():
+                    SurveyStatistics.objects.filter(survey_id=survey_id, total_responses__gte=count).update(
+                        total_responses=F('total_responses') - count
+                    )
+                # The responses were counted as started in the bucket of their start time
+                buckets = Counter(
+                    (survey_id, ResponseRollup.bucket_for(created_at)) for pk, survey_id, created_at in rows
+                )
+                for (survey_id, bucket), count in buckets.items():
+                    ResponseRollup.objects.filter(survey_id=survey_id, bucket=bucket, started__gte=count).update(
+                        started=F('started') - count
+                    )
+            deleted += len(ids)
+        self.stdout.write(self.style.SUCCESS(f"Deleted {deleted} abandoned responses"))
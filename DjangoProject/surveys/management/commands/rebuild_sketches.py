@@ -0,0 +1,77 @@
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from surveys.models import Answer, Response, Survey, SurveySketch
+from surveys.sketches import (
+    answer_values, day_of, distinct_values, numeric_questions, sketch_respondents, sketch_text_values,
+    sketch_values, text_questions, text_values,
+)
+
+
+def completed_at(created_at, completion_time, updated_at):
+    """Completion moment: start plus duration, or the last update when unknown"""
+    return created_at + completion_time if completion_time is not None else updated_at
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the daily sketches (numeric questions, distinct respondents, frequent text "
+        "values) from the complete responses. Run it once after deploying sketches, after "
+        "changing the bounds or options of numeric questions, or to repair them. "
+        "Only exact when SURVEY_AGGREGATE_FLUSH_INTERVAL is 0 or no process has deltas queued."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey_ids', nargs='*', type=int, help="Surveys to rebuild, all by default")
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        survey_ids = options['survey_ids'] or Survey.objects.values_list('pk', flat=True)
+        for survey_id in survey_ids:
+            questions = numeric_questions(survey_id)
+            text_ids = text_questions(survey_id)
+            days = defaultdict(lambda: {'numeric': {}, 'respondents': {}, 'text_values': {}})
+
+            def fold_in(rows, field, sketch):
+                """Group rows by day of completion and merge them into the days' sketches in batches"""
+                pending = defaultdict(list)
+                for count, (*row, created_at, completion_time, updated_at) in enumerate(
+                    rows.iterator(chunk_size=batch_size), 1
+                ):
+                    pending[day_of(completed_at(created_at, completion_time, updated_at))].append(row)
+                    if count % batch_size == 0:
+                        for day, day_rows in pending.items():
+                            days[day][field] = sketch(days[day][field], day_rows)
+                        pending.clear()
+                for day, day_rows in pending.items():
+                    days[day][field] = sketch(days[day][field], day_rows)
+
+            moments = ('response__created_at', 'response__completion_time', 'response__updated_at')
+            answers = Answer.objects.filter(response__survey_id=survey_id, response__is_complete=True)
+            fold_in(
+                answers.filter(question_id__in=list(questions)).values_list('question_id', 'data', 'selected_options', *moments),
+                'numeric', lambda numeric, rows: sketch_values(questions, numeric, answer_values(questions, rows)),
+            )
+            fold_in(
+                answers.filter(question_id__in=text_ids).values_list('question_id', 'data', *moments),
+                'text_values', lambda sketches, rows: sketch_text_values(sketches, text_values(rows)),
+            )
+            fold_in(
+                Response.objects.filter(survey_id=survey_id, is_complete=True).values_list(
+                    'ip_address', 'session_key', 'respondent_id', 'created_at', 'completion_time', 'updated_at'
+                ),
+                'respondents', lambda respondents, rows: sketch_respondents(respondents, distinct_values(rows)),
+            )
+
+            with transaction.atomic():
+                SurveySketch.objects.filter(survey_id=survey_id).delete()
+                SurveySketch.objects.bulk_create(
+                    [SurveySketch(survey_id=survey_id, day=day, **fields) for day, fields in sorted(days.items())],
+                    batch_size=500,
+                )
+            self.stdout.write(
+                f"Survey {survey_id}: {len(questions)} numeric and {len(text_ids)} text questions over {len(days)} days"
+            )
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+
+from surveys.models import Question, TextTerm
+from surveys.text import TEXT_TYPES, rebuild_index
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild the term frequency tables and the inverted index of text questions from "
+        "the answers of complete responses. Run it once after deploying text analytics, or "
+        "to repair counts after answers of complete responses were edited or deleted. "
+        "Only exact when SURVEY_AGGREGATE_FLUSH_INTERVAL is 0 or no process has deltas queued."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey_ids', nargs='*', type=int, help="Surveys to rebuild, all by default")
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def handle(self, *args, **options):
+        questions = Question.objects.filter(question_type__name__in=TEXT_TYPES)
+        if options['survey_ids']:
+            questions = questions.filter(survey_id__in=options['survey_ids'])
+        for question_id, survey_id in questions.values_list('pk', 'survey_id').order_by('survey_id', 'pk'):
+            rebuild_index([question_id], batch_size=options['batch_size'])
+            self.stdout.write(
+                f"Survey {survey_id}, question {question_id}: "
+                f"{TextTerm.objects.filter(question_id=question_id).count()} terms"
+            )
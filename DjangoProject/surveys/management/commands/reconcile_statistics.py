@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from surveys.models import Survey, SurveyStatistics
+
+FIELDS = (
+    'total_responses', 'complete_responses', 'completion_time_total',
+    'completion_time_count', 'average_completion_time', 'question_stats',
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute the incrementally maintained survey statistics and repair any drift. "
+        "Only exact when SURVEY_AGGREGATE_FLUSH_INTERVAL is 0 or no process has deltas queued."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey_ids', nargs='*', type=int, help="Surveys to reconcile, all by default")
+        parser.add_argument('--dry-run', action='store_true', help="Report drift without repairing it")
+
+    def handle(self, *args, **options):
+        survey_ids = options['survey_ids'] or Survey.objects.values_list('pk', flat=True)
+        drifted = 0
+        for survey_id in survey_ids:
+            with transaction.atomic():
+                stats, created = SurveyStatistics.objects.select_for_update().get_or_create(survey_id=survey_id)
+                expected = stats.compute()
+                changed = [field for field in FIELDS if getattr(stats, field) != expected[field]]
+                if changed and not created:
+                    drifted += 1
+                    self.stdout.write(f"Survey {survey_id}: drift in {', '.join(changed)}")
+                if not options['dry_run']:
+                    stats.update(expected)
+        self.stdout.write(f"{drifted} surveys with drifted statistics")
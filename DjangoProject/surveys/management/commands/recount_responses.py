@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from surveys.models import Survey, SurveyCounter
+
+
+class Command(BaseCommand):
+    help = "Rebuild the completed-response counters used to enforce max_responses"
+
+    def add_arguments(self, parser):
+        parser.add_argument('survey_ids', nargs='*', type=int, help="Surveys to recount, all by default")
+
+    def handle(self, *args, **options):
+        survey_ids = options['survey_ids'] or Survey.objects.values_list('pk', flat=True)
+        for survey_id in survey_ids:
+            completed = SurveyCounter.recount(survey_id)
+            self.stdout.write(f"Survey {survey_id}: {completed} completed responses")
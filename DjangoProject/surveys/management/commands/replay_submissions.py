@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from surveys import writebehind
+
+
+class Command(BaseCommand):
+    help = "Flush the write-behind journals left by stopped processes into the database"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dir', help="Journal directory, defaults to SURVEY_WRITE_BEHIND_DIR")
+
+    def handle(self, *args, **options):
+        replayed = writebehind.replay_orphan_journals(options['dir'])
+        self.stdout.write(self.style.SUCCESS(f"Replayed {replayed} buffered submissions"))
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.1 on 2026-10-18 06:13
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+def create_counters(apps, schema_editor):
+    Survey = apps.get_model('surveys', 'Survey')
+    SurveyCounter = apps.get_model('surveys', 'SurveyCounter')
+    surveys = Survey.objects.annotate(completed=Count('responses', filter=Q(responses__is_complete=True)))
+    SurveyCounter.objects.bulk_create(
+        [SurveyCounter(survey_id=survey.pk, completed=survey.completed) for survey in surveys.iterator()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SurveyCounter',
+            fields=[
+                ('survey', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='counter', serialize=False, to='surveys.survey')),
+                ('completed', models.IntegerField(default=0)),
+                ('reserved', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.1 on 2026-10-18 06:24
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0002_survey_counter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='surveystatistics',
+            name='completion_time_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='surveystatistics',
+            name='completion_time_total',
+            field=models.DurationField(default=datetime.timedelta),
+        ),
+        migrations.AddField(
+            model_name='surveystatistics',
+            name='reconciled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-18 06:27
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0003_statistics_incremental'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResponseRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateTimeField()),
+                ('started', models.IntegerField(default=0)),
+                ('completed', models.IntegerField(default=0)),
+                ('survey', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='surveys.survey')),
+            ],
+            options={
+                'unique_together': {('survey', 'bucket')},
+            },
+        ),
+    ]
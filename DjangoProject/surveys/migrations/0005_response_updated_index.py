@@ -0,0 +1,17 @@
+# Generated by Django 5.2.1 on 2026-10-18 06:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0004_response_rollup'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='response',
+            index=models.Index(fields=['survey', 'updated_at'], name='surveys_response_updated'),
+        ),
+    ]
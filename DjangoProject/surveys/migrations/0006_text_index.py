@@ -0,0 +1,46 @@
+# Generated by Django 5.2.1 on 2026-10-18 06:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0005_response_updated_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TextTerm',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=100)),
+                ('is_bigram', models.BooleanField(default=False)),
+                ('answer_count', models.IntegerField(default=0)),
+                ('occurrences', models.IntegerField(default=0)),
+                ('question', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='text_terms', to='surveys.question')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TextPosting',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('occurrences', models.PositiveSmallIntegerField(default=1)),
+                ('answer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='text_postings', to='surveys.answer')),
+                ('term', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='postings', to='surveys.textterm')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='textterm',
+            index=models.Index(fields=['question', 'is_bigram', '-answer_count'], name='surveys_textterm_top'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='textterm',
+            unique_together={('question', 'term')},
+        ),
+        migrations.AlterUniqueTogether(
+            name='textposting',
+            unique_together={('term', 'answer')},
+        ),
+    ]
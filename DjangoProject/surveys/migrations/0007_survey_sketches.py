@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-18 06:42
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0006_text_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SurveySketch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('numeric', models.JSONField(default=dict)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('survey', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='sketches', to='surveys.survey')),
+            ],
+            options={
+                'unique_together': {('survey', 'day')},
+            },
+        ),
+    ]
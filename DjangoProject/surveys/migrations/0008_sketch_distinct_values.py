@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-18 06:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('surveys', '0007_survey_sketches'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='surveysketch',
+            name='respondents',
+            field=models.JSONField(default=dict),
+        ),
+        migrations.AddField(
+            model_name='surveysketch',
+            name='text_values',
+            field=models.JSONField(default=dict),
+        ),
+    ]
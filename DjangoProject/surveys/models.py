@@ -1,12 +1,21 @@
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.contrib.auth.models import User
 from django.utils.translation import gettext_lazy as _
 from django.utils import timezone
 from django.urls import reverse
 from django.core.exceptions import ValidationError
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import Greatest
+from collections import Counter
+from datetime import timedelta
+import logging
 import uuid
 import json
-import re
+
+from . import aggregates
+from .schema import CompiledQuestion
+
+logger = logging.getLogger(__name__)
 
 class TimeStampedModel(models.Model):
     """Base model with created and modified timestamps"""
@@ -123,14 +132,29 @@ class Survey(TimeStampedModel):
             return False
         if now < self.start_date:
             return False
-        if self.max_responses and self.response_count >= self.max_responses:
+        if self.is_full():
             return False
         return True
     
+    def is_full(self):
+        """Whether max_responses is reached, an O(1) read of the survey's counter"""
+        return bool(self.max_responses) and self.completed_response_count >= self.max_responses
+    
+    async def ais_full(self):
+        if not self.max_responses:
+            return False
+        completed = await SurveyCounter.objects.filter(survey_id=self.pk).values_list('completed', flat=True).afirst()
+        return (completed or 0) >= self.max_responses
+    
     @property
     def response_count(self):
         return self.responses.count()
     
+    @property
+    def completed_response_count(self):
+        """Number of completed responses, read from the survey's counter"""
+        return SurveyCounter.objects.filter(survey_id=self.pk).values_list('completed', flat=True).first() or 0
+    
     @property
     def completion_rate(self):
         """Calculate the completion rate of the survey"""
@@ -152,6 +176,56 @@ class Survey(TimeStampedModel):
         if self.end_date and self.end_date < self.start_date:
             raise ValidationError(_("End date cannot be before start date"))
 
+class SurveyCounter(models.Model):
+    """
+    Per-survey counter of completed responses.
+    
+    Submissions reserve a slot before writing and commit it in the same
+    transaction that completes the response, or release it on failure.
+    Every change is a single conditional UPDATE with F() expressions, so
+    max_responses holds exactly under concurrency without locking the survey.
+    """
+    survey = models.OneToOneField(Survey, on_delete=models.CASCADE, primary_key=True, related_name='counter')
+    completed = models.IntegerField(default=0)
+    reserved = models.IntegerField(default=0)
+    
+    def __str__(self):
+        return f"Counter for survey {self.survey_id}"
+    
+    @classmethod
+    def reserve(cls, survey_id, max_responses=None):
+        """Reserve a slot for a completing response, False if the survey is full"""
+        queryset = cls.objects.filter(survey_id=survey_id)
+        if max_responses:
+            queryset = queryset.filter(reserved__lt=max_responses - models.F('completed'))
+        if queryset.update(reserved=models.F('reserved') + 1):
+            return True
+        if cls.objects.filter(survey_id=survey_id).exists():
+            return False
+        # Counter missing (e.g. created outside the ORM), rebuild it and retry once
+        cls.recount(survey_id)
+        return bool(queryset.update(reserved=models.F('reserved') + 1))
+    
+    @classmethod
+    def commit(cls, survey_id, completed=1, reserved=1):
+        """Turn reservations into completed responses, within the caller's transaction"""
+        cls.objects.filter(survey_id=survey_id).update(
+            completed=models.F('completed') + completed,
+            reserved=Greatest(models.F('reserved') - reserved, 0),
+        )
+    
+    @classmethod
+    def release(cls, survey_id, reserved=1):
+        """Give back reservations whose submissions failed"""
+        cls.objects.filter(survey_id=survey_id).update(reserved=Greatest(models.F('reserved') - reserved, 0))
+    
+    @classmethod
+    def recount(cls, survey_id):
+        """Rebuild the counter from the responses table, dropping stale reservations"""
+        completed = Response.objects.filter(survey_id=survey_id, is_complete=True).count()
+        cls.objects.update_or_create(survey_id=survey_id, defaults={'completed': completed, 'reserved': 0})
+        return completed
+
 class Question(TimeStampedModel):
     """Model representing a question in a survey"""
     survey = models.ForeignKey(Survey, on_delete=models.CASCADE, related_name='questions')
@@ -180,36 +254,7 @@ class Question(TimeStampedModel):
     
     def validate_answer(self, answer_data):
         """Validate an answer against this question's rules"""
-        if self.required and not answer_data:
-            return False, _("This question is required")
-        
-        if self.question_type.has_options:
-            # For option-based questions
-            if self.question_type.has_multiple_answers:
-                # Multiple selection
-                if not isinstance(answer_data, list):
-                    return False, _("Invalid answer format")
-                
-                valid_options = set(self.options.values_list('id', flat=True))
-                for option_id in answer_data:
-                    if option_id not in valid_options:
-                        return False, _("Invalid option selected")
-            else:
-                # Single selection
-                if not self.options.filter(id=answer_data).exists():
-                    return False, _("Invalid option selected")
-        else:
-            # For text-based questions
-            if self.validation_regex and not re.match(self.validation_regex, answer_data):
-                return False, self.validation_message or _("Answer format is invalid")
-            
-            if self.min_value is not None and float(answer_data) < self.min_value:
-                return False, _("Value must be at least {}").format(self.min_value)
-                
-            if self.max_value is not None and float(answer_data) > self.max_value:
-                return False, _("Value must be at most {}").format(self.max_value)
-        
-        return True, ""
+        return CompiledQuestion(self, self.options.all()).validate_answer(answer_data)
 
 class QuestionOption(TimeStampedModel):
     """Model representing an option for a question"""
@@ -245,6 +290,10 @@ class Response(TimeStampedModel):
     class Meta:
         verbose_name = _("Response")
         verbose_name_plural = _("Responses")
+        indexes = [
+            # Incremental readers (response cube) follow responses by last update
+            models.Index(fields=['survey', 'updated_at'], name='surveys_response_updated'),
+        ]
     
     def __str__(self):
         return f"Response to {self.survey.title} ({self.created_at})"
@@ -331,57 +380,278 @@ class SurveyShare(TimeStampedModel):
         return f"{self.survey.title} shared with {self.shared_with.username}"
 
 class SurveyStatistics(TimeStampedModel):
-    """Model for storing pre-calculated survey statistics"""
+    """
+    Model for storing pre-calculated survey statistics.
+    
+    Statistics are maintained incrementally: every inserted response bumps
+    total_responses, and every newly completed response applies its deltas
+    (totals, completion time, per-question and per-option answer counts)
+    once its transaction commits, with one update for all the completions
+    of a flush interval (see aggregates.py). Per-question statistics
+    cover completed responses. update() recomputes everything from the
+    responses table; the reconcile_statistics command uses it to repair drift.
+    """
     survey = models.OneToOneField(Survey, on_delete=models.CASCADE, related_name='statistics')
     total_responses = models.PositiveIntegerField(default=0)
     complete_responses = models.PositiveIntegerField(default=0)
     average_completion_time = models.DurationField(null=True, blank=True)
+    completion_time_total = models.DurationField(default=timedelta)
+    completion_time_count = models.PositiveIntegerField(default=0)
     question_stats = models.JSONField(default=dict)
+    reconciled_at = models.DateTimeField(null=True, blank=True)
     
     def __str__(self):
         return f"Statistics for {self.survey.title}"
     
-    def update(self):
-        """Update the statistics"""
-        responses = self.survey.responses.all()
-        self.total_responses = responses.count()
-        self.complete_responses = responses.filter(is_complete=True).count()
+    @property
+    def completion_rate(self):
+        """Percentage of started responses that were completed"""
+        return int(self.complete_responses / self.total_responses * 100) if self.total_responses else 0
+    
+    @staticmethod
+    def _question_entry(question, answer_count, option_counts):
+        """Statistics of one question, in the layout stored in question_stats"""
+        entry = {
+            'text': question.text,
+            'type': question.question_type.name,
+            'answer_count': answer_count,
+        }
+        if question.question_type.has_options:
+            entry['options'] = {
+                str(option.id): {
+                    'text': option.text,
+                    'count': option_counts.get(option.id, 0),
+                    'percentage': round((option_counts.get(option.id, 0) / max(1, answer_count)) * 100, 1),
+                }
+                for option in question.options.all()
+            }
+        return entry
+    
+    def compute(self):
+        """
+        Compute every statistic from the responses table.
         
-        # Calculate average completion time
-        complete_times = [r.completion_time for r in responses if r.completion_time]
-        if complete_times:
-            total_seconds = sum(t.total_seconds() for t in complete_times)
-            self.average_completion_time = timezone.timedelta(seconds=total_seconds / len(complete_times))
+        Uses a fixed number of grouped queries whatever the number of
+        questions and options. Returns a dict of field values.
+        """
+        totals = Response.objects.filter(survey_id=self.survey_id).aggregate(
+            total=Count('id'),
+            complete=Count('id', filter=Q(is_complete=True)),
+            time_total=Sum('completion_time', filter=Q(is_complete=True)),
+            time_count=Count('completion_time', filter=Q(is_complete=True)),
+        )
+        from .results import count_answers
         
-        # Calculate per-question statistics
-        question_stats = {}
-        for question in self.survey.questions.all():
-            answers = Answer.objects.filter(question=question, response__survey=self.survey)
-            
-            if question.question_type.has_options:
-                # For option-based questions, count selections
-                option_counts = {}
-                for option in question.options.all():
-                    count = option.answers.filter(response__survey=self.survey).count()
-                    option_counts[str(option.id)] = {
-                        'text': option.text,
-                        'count': count,
-                        'percentage': round((count / max(1, answers.count())) * 100, 1)
-                    }
-                
-                question_stats[str(question.id)] = {
-                    'text': question.text,
-                    'type': question.question_type.name,
-                    'answer_count': answers.count(),
-                    'options': option_counts
-                }
-            else:
-                # For text-based questions, provide basic stats
-                question_stats[str(question.id)] = {
-                    'text': question.text,
-                    'type': question.question_type.name,
-                    'answer_count': answers.count()
-                }
+        answer_counts, option_counts = count_answers(
+            Response.objects.filter(survey_id=self.survey_id, is_complete=True)
+        )
+        questions = Question.objects.filter(survey_id=self.survey_id).select_related('question_type').prefetch_related('options')
+        time_total = totals['time_total'] or timedelta()
+        return {
+            'total_responses': totals['total'],
+            'complete_responses': totals['complete'],
+            'completion_time_total': time_total,
+            'completion_time_count': totals['time_count'],
+            'average_completion_time': time_total / totals['time_count'] if totals['time_count'] else None,
+            'question_stats': {
+                str(question.id): self._question_entry(question, answer_counts.get(question.id, 0), option_counts)
+                for question in questions
+            },
+        }
+    
+    def update(self, values=None):
+        """Recompute the statistics from scratch, or store values already returned by compute()"""
+        for field, value in (values or self.compute()).items():
+            setattr(self, field, value)
+        self.reconciled_at = timezone.now()
+        self.save()
+    
+    @classmethod
+    def record_started(cls, survey_id, count=1):
+        """Count newly inserted responses once the caller's transaction commits"""
+        aggregates.record(cls.add_started, (survey_id,), [count])
+    
+    @classmethod
+    def add_started(cls, survey_id, counts):
+        cls.objects.filter(survey_id=survey_id).update(total_responses=models.F('total_responses') + sum(counts))
+    
+    @classmethod
+    def record_completions(cls, survey_id, completions):
+        """
+        Apply the deltas of newly completed responses once the caller's transaction commits.
         
-        self.question_stats = question_stats
-        self.save()
\ No newline at end of file
+        completions is a list of (response_id, completion_time) pairs.
+        """
+        aggregates.record(cls.apply_completions, (survey_id,), completions)
+    
+    @classmethod
+    def apply_completions(cls, survey_id, completions):
+        """Add completed responses to the statistics: one read of their answers, one update"""
+        answer_counts = Counter()
+        option_counts = Counter()
+        seen = set()
+        rows = Answer.objects.filter(response_id__in=[response_id for response_id, _ in completions]).values_list(
+            'id', 'question_id', 'selected_options'
+        )
+        for answer_id, question_id, option_id in rows:
+            if answer_id not in seen:
+                seen.add(answer_id)
+                answer_counts[question_id] += 1
+            if option_id is not None:
+                option_counts[question_id, option_id] += 1
+        
+        with transaction.atomic():
+            stats, created = cls.objects.select_for_update().get_or_create(survey_id=survey_id)
+            if created or stats.reconciled_at is None:
+                # Never computed yet: the full computation already includes these responses
+                stats.update()
+                return
+            
+            stats.complete_responses += len(completions)
+            times = [completion_time for _, completion_time in completions if completion_time is not None]
+            stats.completion_time_total += sum(times, timedelta())
+            stats.completion_time_count += len(times)
+            if stats.completion_time_count:
+                stats.average_completion_time = stats.completion_time_total / stats.completion_time_count
+            
+            question_stats = stats.question_stats
+            # Questions or options added since the last computation need their texts
+            unknown = {
+                question_id for question_id in answer_counts if str(question_id) not in question_stats
+            } | {
+                question_id for question_id, option_id in option_counts
+                if str(question_id) in question_stats
+                and str(option_id) not in question_stats[str(question_id)].get('options', {})
+            }
+            if unknown:
+                for question in Question.objects.filter(pk__in=list(unknown)).select_related('question_type').prefetch_related('options'):
+                    previous = question_stats.get(str(question.id), {})
+                    question_stats[str(question.id)] = cls._question_entry(
+                        question,
+                        previous.get('answer_count', 0),
+                        {int(option_id): option['count'] for option_id, option in previous.get('options', {}).items()},
+                    )
+            
+            for question_id, count in answer_counts.items():
+                entry = question_stats.get(str(question_id))
+                if entry is None:
+                    # Deleted question
+                    continue
+                entry['answer_count'] += count
+                for option_id, option in entry.get('options', {}).items():
+                    option['count'] += option_counts.get((question_id, int(option_id)), 0)
+                    option['percentage'] = round((option['count'] / max(1, entry['answer_count'])) * 100, 1)
+            
+            stats.save(update_fields=[
+                'complete_responses', 'completion_time_total', 'completion_time_count',
+                'average_completion_time', 'question_stats', 'updated_at',
+            ])
+
+class ResponseRollup(models.Model):
+    """
+    Hourly counts of started and completed responses, per survey.
+    
+    Maintained incrementally: inserting a response adds to the bucket of its
+    start time, and completing one adds to the bucket of its completion
+    time, once the writing transaction commits (see aggregates.py). Trend charts read these rows
+    instead of counting responses. The backfill_rollups command rebuilds
+    them from the responses table.
+    """
+    survey = models.ForeignKey(Survey, on_delete=models.CASCADE, related_name='rollups')
+    bucket = models.DateTimeField()
+    started = models.IntegerField(default=0)
+    completed = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('survey', 'bucket')
+    
+    def __str__(self):
+        return f"Survey {self.survey_id} at {self.bucket:%Y-%m-%d %H:00}"
+    
+    @staticmethod
+    def bucket_for(moment):
+        """Start of the hour holding a moment"""
+        return moment.replace(minute=0, second=0, microsecond=0)
+    
+    @classmethod
+    def add(cls, survey_id, bucket, started=0, completed=0):
+        """Add counts to a bucket, creating it when needed"""
+        changes = {'started': models.F('started') + started, 'completed': models.F('completed') + completed}
+        if cls.objects.filter(survey_id=survey_id, bucket=bucket).update(**changes):
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(survey_id=survey_id, bucket=bucket, started=started, completed=completed)
+        except IntegrityError:
+            # Created concurrently
+            cls.objects.filter(survey_id=survey_id, bucket=bucket).update(**changes)
+    
+    @classmethod
+    def record(cls, survey_id, moment, started=0, completed=0):
+        """Add counts to the bucket of a moment once the caller's transaction commits"""
+        aggregates.record(cls.add_counts, (survey_id, cls.bucket_for(moment)), [(started, completed)])
+    
+    @classmethod
+    def add_counts(cls, survey_id, bucket, counts):
+        """Add (started, completed) pairs to a bucket"""
+        cls.add(survey_id, bucket, sum(started for started, _ in counts), sum(completed for _, completed in counts))
+
+class TextTerm(models.Model):
+    """
+    Frequency of a term, or of a bigram, in the text answers of a question.
+    
+    Maintained incrementally with the TextPosting inverted index: when a
+    response completes, its text answers are tokenized once the writing
+    transaction commits (see text.py and aggregates.py). The rebuild_text_index command
+    rebuilds both from the answers.
+    """
+    question = models.ForeignKey(Question, on_delete=models.CASCADE, related_name='text_terms')
+    term = models.CharField(max_length=100)
+    is_bigram = models.BooleanField(default=False)
+    # Answers holding the term, and its total number of occurrences
+    answer_count = models.IntegerField(default=0)
+    occurrences = models.IntegerField(default=0)
+    
+    class Meta:
+        unique_together = ('question', 'term')
+        indexes = [
+            models.Index(fields=['question', 'is_bigram', '-answer_count'], name='surveys_textterm_top'),
+        ]
+    
+    def __str__(self):
+        return self.term
+
+class TextPosting(models.Model):
+    """Inverted index entry: a text answer holding a term"""
+    term = models.ForeignKey(TextTerm, on_delete=models.CASCADE, related_name='postings')
+    answer = models.ForeignKey(Answer, on_delete=models.CASCADE, related_name='text_postings')
+    occurrences = models.PositiveSmallIntegerField(default=1)
+    
+    class Meta:
+        unique_together = ('term', 'answer')
+
+class SurveySketch(models.Model):
+    """
+    Mergeable streaming sketches of a survey's complete responses, per day of completion.
+    
+    numeric maps the ids of rating and numeric questions to the serialized
+    NumericSketch of their answers, respondents maps 'ip_address',
+    'session_key' and 'respondent' to compressed HyperLogLog registers, and
+    text_values maps the ids of text questions to serialized FrequentValues
+    (see sketches.py). Completing a response merges it into the row of the
+    day once the writing transaction commits, with the other completions of
+    the flush interval (see aggregates.py); results merge the rows of the
+    days they cover. The rebuild_sketches command rebuilds the rows.
+    """
+    survey = models.ForeignKey(Survey, on_delete=models.CASCADE, related_name='sketches')
+    day = models.DateField()
+    numeric = models.JSONField(default=dict)
+    respondents = models.JSONField(default=dict)
+    text_values = models.JSONField(default=dict)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    class Meta:
+        unique_together = ('survey', 'day')
+    
+    def __str__(self):
+        return f"Survey {self.survey_id} on {self.day}"
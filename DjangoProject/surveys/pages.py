@@ -0,0 +1,128 @@
+"""
+Page plans for surveys answered one question per page.
+
+When a respondent starts such a survey, the ids of its questions, a shuffle
+seed and the schema version are stored once in the session, together with
+the id of the response once it exists. Every step then reads the question
+order from the plan and loads only the current question: from the cached
+schema of the plan's version, or else with a single query.
+"""
+
+import random
+
+from .models import Question, QuestionOption, QuestionType
+from .schema import CompiledQuestion, get_survey_schema, peek_survey_schema
+
+QUESTION_FIELDS = (
+    'id', 'survey_id', 'text', 'help_text', 'order', 'required', 'validation_regex',
+    'validation_message', 'min_value', 'max_value', 'conditional_logic', 'updated_at',
+)
+QUESTION_TYPE_FIELDS = ('id', 'name', 'has_options', 'has_multiple_answers', 'template_name')
+OPTION_FIELDS = ('id', 'text', 'order', 'is_default', 'extra_info')
+
+
+def _session_key(survey):
+    return f"survey_plan_{survey.pk}"
+
+
+class PagePlan:
+    """Question order of one respondent, kept as question ids and a shuffle seed"""
+
+    def __init__(self, question_ids, version, seed=None, response_id=None):
+        self.question_ids = list(question_ids)
+        self.version = version
+        self.seed = seed
+        self.response_id = response_id
+        self.order = list(self.question_ids)
+        if seed is not None:
+            random.Random(seed).shuffle(self.order)
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, question_id):
+        return question_id in self.order
+
+    def question_id(self, index):
+        return self.order[index]
+
+    def to_dict(self):
+        return {'ids': self.question_ids, 'version': self.version, 'seed': self.seed, 'response': self.response_id}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['ids'], data['version'], data['seed'], data['response'])
+
+
+def get_page_plan(request, survey):
+    """Get the respondent's plan for a survey, creating it from the schema on the first step"""
+    data = request.session.get(_session_key(survey))
+    if data is not None:
+        return PagePlan.from_dict(data)
+    schema = get_survey_schema(survey)
+    seed = random.getrandbits(32) if survey.randomize_questions else None
+    plan = PagePlan([question.id for question in schema], schema.version, seed)
+    save_page_plan(request, survey, plan)
+    return plan
+
+
+def save_page_plan(request, survey, plan):
+    request.session[_session_key(survey)] = plan.to_dict()
+
+
+def discard_page_plan(request, survey):
+    request.session.pop(_session_key(survey), None)
+
+
+def load_compiled_question(survey, question_id):
+    """
+    Compile one question of a survey, with its type and options, in a single query.
+
+    Returns None when the question does not exist or belongs to another survey.
+    """
+    rows = list(
+        Question.objects.filter(pk=question_id, survey=survey)
+        .order_by('options__order', 'options__id')
+        .values(
+            *QUESTION_FIELDS,
+            *[f'question_type__{field}' for field in QUESTION_TYPE_FIELDS],
+            *[f'options__{field}' for field in OPTION_FIELDS],
+        )
+    )
+    if not rows:
+        return None
+    question = Question(**{field: rows[0][field] for field in QUESTION_FIELDS})
+    question.question_type = QuestionType(
+        **{field: rows[0][f'question_type__{field}'] for field in QUESTION_TYPE_FIELDS}
+    )
+    options = [
+        QuestionOption(**{field: row[f'options__{field}'] for field in OPTION_FIELDS})
+        for row in rows
+        if row['options__id'] is not None
+    ]
+    return CompiledQuestion(question, options)
+
+
+def get_plan_question(survey, plan, question_id):
+    """
+    Get a compiled question of a plan.
+
+    Uses the cached schema of the version the plan was made from, so the
+    respondent keeps seeing the survey as it was when they started. Falls
+    back to loading the question alone when that version is not cached.
+    """
+    schema = peek_survey_schema(survey, plan.version)
+    if schema is not None:
+        return schema.get(question_id)
+    return load_compiled_question(survey, question_id)
+
+
+def get_plan_questions(survey, plan):
+    """
+    Compiled questions of a plan, in the plan's order.
+
+    Uses the cached schema of the plan's version, or else the current one;
+    questions deleted since the plan was made are left out.
+    """
+    schema = peek_survey_schema(survey, plan.version) or get_survey_schema(survey)
+    return [schema.get(question_id) for question_id in plan.order if schema.get(question_id) is not None]
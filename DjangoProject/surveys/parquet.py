@@ -0,0 +1,166 @@
+"""
+Parquet export of survey responses.
+
+Each question becomes a typed column: single-choice answers are
+dictionary-encoded option texts, multiple-choice answers lists of option
+texts (in option order), date questions dates, numeric text questions
+(those with a min_value or max_value) floats, and other text questions
+strings. Responses carry their id, UTC timestamps, completion time as a
+duration and respondent id.
+
+Responses are read in chunks (see exports.py) and converted to Arrow record
+batches; batches are written as row groups of SURVEY_EXPORT_ROW_GROUP_SIZE
+responses, so at most one row group is held in memory. Requires pyarrow.
+"""
+
+import math
+from collections import Counter
+from datetime import date
+
+from django.conf import settings
+
+from .exports import export_chunks
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet exports are unavailable without pyarrow
+    pa = pq = None
+
+RESPONSE_COLUMNS = ('response_id', 'created_at', 'updated_at', 'completion_time', 'respondent_id')
+
+
+def parquet_available():
+    return pa is not None
+
+
+def _column_kind(question):
+    question_type = question.question_type
+    if question_type.has_options:
+        return 'multiple' if question_type.has_multiple_answers else 'single'
+    if question_type.name == 'date':
+        return 'date'
+    if question.min_value is not None or question.max_value is not None:
+        return 'number'
+    return 'text'
+
+
+def _column_names(schema):
+    """Column name of each question: its text, with its id when the text is not unique"""
+    counts = Counter(question.text for question in schema)
+    return [
+        question.text if counts[question.text] == 1 and question.text not in RESPONSE_COLUMNS
+        else f"{question.text} ({question.id})"
+        for question in schema
+    ]
+
+
+def arrow_schema(schema):
+    """Arrow schema of the export of a compiled survey schema"""
+    types = {
+        'single': lambda: pa.dictionary(pa.int32(), pa.string()),
+        'multiple': lambda: pa.list_(pa.string()),
+        'date': pa.date32,
+        'number': pa.float64,
+        'text': pa.string,
+    }
+    fields = [
+        pa.field('response_id', pa.int64(), nullable=False),
+        pa.field('created_at', pa.timestamp('us', tz='UTC')),
+        pa.field('updated_at', pa.timestamp('us', tz='UTC')),
+        pa.field('completion_time', pa.duration('us')),
+        pa.field('respondent_id', pa.int64()),
+    ]
+    for question, name in zip(schema, _column_names(schema)):
+        fields.append(pa.field(name, types[_column_kind(question)](), metadata={'question_id': str(question.id)}))
+    return pa.schema(fields)
+
+
+def _parse_date(data):
+    try:
+        return date.fromisoformat(data)
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_number(data):
+    try:
+        number = float(data)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def _question_array(question, answers):
+    """Arrow array of the answers (None when unanswered) of a chunk to a question"""
+    kind = _column_kind(question)
+    options = question.get_options()
+    if kind == 'single':
+        positions = {option.id: position for position, option in enumerate(options)}
+        indices = [
+            min((positions[option_id] for option_id in answer[1] if option_id in positions), default=None)
+            if answer is not None else None
+            for answer in answers
+        ]
+        return pa.DictionaryArray.from_arrays(
+            pa.array(indices, pa.int32()), pa.array([option.text for option in options], pa.string())
+        )
+    if kind == 'multiple':
+        return pa.array(
+            [
+                [option.text for option in options if option.id in answer[1]] if answer is not None else None
+                for answer in answers
+            ],
+            pa.list_(pa.string()),
+        )
+    if kind == 'date':
+        return pa.array([_parse_date(answer[0]) if answer is not None else None for answer in answers], pa.date32())
+    if kind == 'number':
+        return pa.array([_parse_number(answer[0]) if answer is not None else None for answer in answers], pa.float64())
+    return pa.array([answer[0] if answer is not None else None for answer in answers], pa.string())
+
+
+def record_batch(schema, table_schema, chunk):
+    """Arrow record batch of a chunk of ExportResponse"""
+    arrays = [
+        pa.array([response.id for response in chunk], pa.int64()),
+        pa.array([response.created_at for response in chunk], pa.timestamp('us', tz='UTC')),
+        pa.array([response.updated_at for response in chunk], pa.timestamp('us', tz='UTC')),
+        pa.array([response.completion_time for response in chunk], pa.duration('us')),
+        pa.array([response.respondent_id for response in chunk], pa.int64()),
+    ]
+    for question in schema:
+        arrays.append(_question_array(question, [response.answers.get(question.id) for response in chunk]))
+    return pa.RecordBatch.from_arrays(arrays, schema=table_schema)
+
+
+def write_parquet(path, schema, responses, progress=None):
+    """
+    Write a set of responses to a Parquet file, one row group at a time.
+
+    progress, when given, is called with (responses written, total) after
+    each row group.
+    """
+    if pa is None:
+        raise RuntimeError("Parquet exports require pyarrow")
+    row_group_size = getattr(settings, 'SURVEY_EXPORT_ROW_GROUP_SIZE', 50000)
+    total = responses.count()
+    table_schema = arrow_schema(schema)
+    written = 0
+    batches = []
+    with pq.ParquetWriter(path, table_schema, compression='zstd') as writer:
+        for chunk in export_chunks(schema, responses):
+            batches.append(record_batch(schema, table_schema, chunk))
+            if sum(batch.num_rows for batch in batches) >= row_group_size:
+                table = pa.Table.from_batches(batches)
+                writer.write_table(table, row_group_size=table.num_rows)
+                written += table.num_rows
+                batches = []
+                if progress is not None:
+                    progress(written, total)
+        if batches or not written:
+            table = pa.Table.from_batches(batches, schema=table_schema)
+            writer.write_table(table, row_group_size=max(table.num_rows, 1))
+            written += table.num_rows
+    if progress is not None:
+        progress(written, total)
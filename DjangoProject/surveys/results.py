@@ -0,0 +1,193 @@
+"""
+Aggregation of survey results.
+
+Counts for a whole set of responses are computed with two grouped queries,
+whatever the number of questions and options: one GROUP BY over the
+selected-options through table for the option counts, and one over the
+answers for the per-question answer counts. The counts are then laid out
+along the survey's compiled schema, in question and option order, for the
+results page and its charts.
+
+Response trends are read from the hourly rollup table (see ResponseRollup),
+grouped to the requested granularity with one indexed query, or counted
+from a response cube when restricted to a segment.
+"""
+
+from collections import namedtuple
+from datetime import timedelta
+
+import numpy as np
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDay, TruncMonth, TruncWeek
+from django.utils import timezone
+
+from .models import Answer, ResponseRollup
+
+OptionResult = namedtuple('OptionResult', ['id', 'text', 'answer_count', 'percentage'])
+
+
+class QuestionResult:
+    """Counts of one question: answers, and selections of each option in order"""
+
+    __slots__ = ('question', 'answer_count', 'options', 'terms', 'bigrams', 'numeric', 'values')
+
+    def __init__(self, question, answer_count, options):
+        self.question = question
+        self.answer_count = answer_count
+        self.options = options
+        # Top terms and bigrams of text questions, see text.py
+        self.terms = None
+        self.bigrams = None
+        # Summary of rating and numeric questions, and frequent values of text questions, see sketches.py
+        self.numeric = None
+        self.values = None
+
+    @property
+    def id(self):
+        return self.question.id
+
+    @property
+    def has_options(self):
+        return self.question.question_type.has_options
+
+
+def count_answers(responses):
+    """
+    Count the answers of a set of responses.
+
+    responses is a Response queryset. Returns a tuple (answer_counts,
+    option_counts) of dicts mapping question ids to their number of answers,
+    and option ids to the number of answers selecting them.
+    """
+    answer_counts = dict(
+        Answer.objects.filter(response__in=responses)
+        .values_list('question_id').annotate(count=Count('id')).order_by()
+    )
+    Through = Answer.selected_options.through
+    option_counts = dict(
+        Through.objects.filter(answer__response__in=responses)
+        .values_list('questionoption_id').annotate(count=Count('id')).order_by()
+    )
+    return answer_counts, option_counts
+
+
+def aggregate_results(schema, responses):
+    """Get the QuestionResult of every question of a compiled schema, for a set of responses"""
+    return layout_results(schema, *count_answers(responses))
+
+
+def layout_results(schema, answer_counts, option_counts):
+    """Lay answer and option counts out along a compiled schema, as QuestionResults"""
+    results = []
+    for question in schema:
+        answer_count = answer_counts.get(question.id, 0)
+        options = [
+            OptionResult(
+                option.id,
+                option.text,
+                option_counts.get(option.id, 0),
+                round(option_counts.get(option.id, 0) / max(1, answer_count) * 100, 1),
+            )
+            for option in question.get_options()
+        ] if question.question_type.has_options else []
+        results.append(QuestionResult(question, answer_count, options))
+    return results
+
+
+TREND_GRANULARITIES = {
+    'hour': F('bucket'),
+    'day': TruncDay('bucket'),
+    'week': TruncWeek('bucket'),
+    'month': TruncMonth('bucket'),
+}
+
+
+def period_start(moment, granularity):
+    """Start of the period holding a moment, in the current time zone"""
+    moment = timezone.localtime(moment).replace(minute=0, second=0, microsecond=0)
+    if granularity == 'hour':
+        return moment
+    moment = moment.replace(hour=0)
+    if granularity == 'week':
+        return moment - timedelta(days=moment.weekday())
+    if granularity == 'month':
+        return moment.replace(day=1)
+    return moment
+
+
+def next_period(start, granularity):
+    if granularity == 'hour':
+        return start + timedelta(hours=1)
+    if granularity == 'week':
+        return start + timedelta(days=7)
+    if granularity == 'month':
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start + timedelta(days=1)
+
+
+def count_periods(start, end, granularity):
+    """Number of periods a trend between start and end holds, to bound requests"""
+    span = end - period_start(start, granularity)
+    if granularity == 'hour':
+        return int(span.total_seconds() // 3600) + 1
+    if granularity == 'week':
+        return span.days // 7 + 1
+    if granularity == 'month':
+        return (end.year - start.year) * 12 + end.month - start.month + 1
+    return span.days + 1
+
+
+def response_trend(survey_id, start, end, granularity='day'):
+    """
+    Count the started and completed responses of a survey per period.
+
+    Covers the periods from the one holding start to the one holding end.
+    Reads the rollup table once; periods without responses are filled with
+    zeros. Returns a list of dicts with the period's date, started and
+    completed counts.
+    """
+    period = TREND_GRANULARITIES[granularity]
+    first = period_start(start, granularity)
+    rows = (
+        ResponseRollup.objects.filter(survey_id=survey_id, bucket__gte=first, bucket__lte=end)
+        .annotate(period=period).values('period')
+        .annotate(started=Sum('started'), completed=Sum('completed'))
+        .order_by('period')
+    )
+    counts = {row['period'].timestamp(): row for row in rows}
+    label = '%Y-%m-%d %H:00' if granularity == 'hour' else '%Y-%m-%d'
+    trend = []
+    current = first
+    while current <= end:
+        row = counts.get(current.timestamp(), {})
+        trend.append({
+            'date': current.strftime(label),
+            'started': row.get('started', 0),
+            'completed': row.get('completed', 0),
+        })
+        current = next_period(current, granularity)
+    return trend
+
+
+def moments_trend(started, completed, start, end, granularity='day'):
+    """
+    Same result as response_trend, counted from arrays of moments.
+
+    started and completed are epoch timestamps of the responses of a
+    segment (see cube.py); nan moments are not counted.
+    """
+    periods = [period_start(start, granularity)]
+    while periods[-1] <= end:
+        periods.append(next_period(periods[-1], granularity))
+    edges = np.array([period.timestamp() for period in periods])
+    limit = min(edges[-1], end.timestamp() + 1e-6)
+
+    def count(moments):
+        moments = moments[(moments >= edges[0]) & (moments < limit)]
+        return np.bincount(np.searchsorted(edges, moments, side='right') - 1, minlength=len(periods) - 1)
+
+    label = '%Y-%m-%d %H:00' if granularity == 'hour' else '%Y-%m-%d'
+    return [
+        {'date': period.strftime(label), 'started': int(started_count), 'completed': int(completed_count)}
+        for period, started_count, completed_count in zip(periods, count(started), count(completed))
+    ]
@@ -0,0 +1,227 @@
+"""
+Compiled survey schemas.
+
+A schema is an immutable snapshot of a survey's questions, with their
+resolved question types, option ids and precompiled validation regexes.
+It is built once per survey version and cached both in the process and in
+the shared Django cache, so taking, saving and submitting a survey can
+validate and render answers without querying questions or options.
+"""
+
+import threading
+from collections import OrderedDict, namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.utils.translation import gettext_lazy as _
+
+from .validation import build_validator
+
+
+CompiledQuestionType = namedtuple(
+    'CompiledQuestionType', ['id', 'name', 'has_options', 'has_multiple_answers', 'template_name']
+)
+
+CompiledOption = namedtuple('CompiledOption', ['id', 'text', 'order', 'is_default', 'extra_info'])
+
+
+def _to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class CompiledQuestion:
+    """Read-only view of a question, usable wherever templates and validation expect a Question"""
+
+    def __init__(self, question, options):
+        self.id = self.pk = question.id
+        self.survey_id = question.survey_id
+        self.text = question.text
+        self.help_text = question.help_text
+        self.order = question.order
+        self.required = question.required
+        self.validation_regex = question.validation_regex
+        self.validation_message = question.validation_message
+        self.min_value = question.min_value
+        self.max_value = question.max_value
+        self.conditional_logic = question.conditional_logic
+        self.updated_at = question.updated_at
+
+        question_type = question.question_type
+        self.question_type = CompiledQuestionType(
+            question_type.id,
+            question_type.name,
+            question_type.has_options,
+            question_type.has_multiple_answers,
+            question_type.template_name,
+        )
+        self.options = tuple(
+            CompiledOption(option.id, option.text, option.order, option.is_default, option.extra_info)
+            for option in options
+        )
+        self.option_ids = frozenset(option.id for option in self.options)
+        self.validator = build_validator(self, self.options)
+
+    def __str__(self):
+        return self.text[:50]
+
+    def __repr__(self):
+        return f"<CompiledQuestion {self.id}>"
+
+    def get_options(self):
+        """Get options in the correct order"""
+        return self.options
+
+    def get_option_ids(self):
+        return self.option_ids
+
+    def validate_answer(self, answer_data):
+        """Validate an answer against this question's rules, same contract as Question.validate_answer"""
+        if not answer_data:
+            if self.required:
+                return False, _("This question is required")
+            return True, ""
+        message = self.validator(answer_data)
+        if message is not None:
+            return False, message
+        return True, ""
+
+
+class SurveySchema:
+    """Ordered, compiled questions of one version of a survey"""
+
+    def __init__(self, survey, version, questions):
+        self.survey_id = survey.pk
+        self.max_responses = survey.max_responses
+        self.version = version
+        self.questions = tuple(questions)
+        self.by_id = {question.id: question for question in self.questions}
+
+    def __len__(self):
+        return len(self.questions)
+
+    def __iter__(self):
+        return iter(self.questions)
+
+    def get(self, question_id):
+        """Get a compiled question by id, None if it is not part of this survey"""
+        return self.by_id.get(_to_int(question_id))
+
+
+_local_schemas = OrderedDict()
+_local_lock = threading.Lock()
+
+
+def _version_from_stamp(survey, stamp):
+    last_update = stamp['last_update'].timestamp() if stamp['last_update'] else 0
+    return f"{survey.updated_at.timestamp()}:{last_update}:{stamp['count']}"
+
+
+def get_schema_version(survey):
+    """
+    Compute the version of a survey's schema.
+
+    The version changes whenever the survey, or any of its questions, is
+    saved, and whenever a question is added or removed. Saving or deleting an
+    option touches its question (see signals.py).
+    """
+    stamp = survey.questions.aggregate(last_update=Max('updated_at'), count=Count('id'))
+    return _version_from_stamp(survey, stamp)
+
+
+async def aget_schema_version(survey):
+    stamp = await survey.questions.aaggregate(last_update=Max('updated_at'), count=Count('id'))
+    return _version_from_stamp(survey, stamp)
+
+
+def build_survey_schema(survey, version=None):
+    """Compile a survey's schema from the database with two queries"""
+    if version is None:
+        version = get_schema_version(survey)
+    questions = (
+        survey.questions.select_related('question_type')
+        .prefetch_related('options')
+        .order_by('order', 'id')
+    )
+    return SurveySchema(
+        survey,
+        version,
+        [CompiledQuestion(question, question.options.all()) for question in questions],
+    )
+
+
+# Bump when the pickled layout of SurveySchema changes
+SCHEMA_FORMAT = 3
+
+
+def _schema_key(survey, version):
+    return f"surveys:schema:{SCHEMA_FORMAT}:{survey.pk}:{version}"
+
+
+def _get_local_schema(key):
+    with _local_lock:
+        schema = _local_schemas.get(key)
+        if schema is not None:
+            _local_schemas.move_to_end(key)
+        return schema
+
+
+def _set_local_schema(key, schema):
+    with _local_lock:
+        _local_schemas[key] = schema
+        _local_schemas.move_to_end(key)
+        while len(_local_schemas) > getattr(settings, 'SURVEY_SCHEMA_LOCAL_CACHE_SIZE', 128):
+            _local_schemas.popitem(last=False)
+
+
+def peek_survey_schema(survey, version):
+    """Get a given version of a survey's schema from the caches, without any query, None if absent"""
+    key = _schema_key(survey, version)
+    schema = _get_local_schema(key)
+    if schema is None:
+        schema = cache.get(key)
+        if schema is not None:
+            _set_local_schema(key, schema)
+    return schema
+
+
+def get_survey_schema(survey):
+    """
+    Get the compiled schema of a survey.
+
+    Looks in the process cache first, then in the shared cache, and only
+    compiles the schema from the database when neither holds the current
+    version. Costs a single aggregate query when the schema is cached.
+    """
+    version = get_schema_version(survey)
+    key = _schema_key(survey, version)
+    schema = _get_local_schema(key)
+    if schema is not None:
+        return schema
+
+    schema = cache.get(key)
+    if schema is None:
+        schema = build_survey_schema(survey, version)
+        cache.set(key, schema, getattr(settings, 'SURVEY_SCHEMA_CACHE_TIMEOUT', 3600))
+    _set_local_schema(key, schema)
+    return schema
+
+
+async def aget_survey_schema(survey):
+    """Async counterpart of get_survey_schema"""
+    version = await aget_schema_version(survey)
+    key = _schema_key(survey, version)
+    schema = _get_local_schema(key)
+    if schema is not None:
+        return schema
+
+    schema = await cache.aget(key)
+    if schema is None:
+        schema = await sync_to_async(build_survey_schema)(survey, version)
+        await cache.aset(key, schema, getattr(settings, 'SURVEY_SCHEMA_CACHE_TIMEOUT', 3600))
+    _set_local_schema(key, schema)
+    return schema
@@ -0,0 +1,194 @@
+"""
+Segments of a survey's responses.
+
+A segment is a JSON expression over the responses, checked against the
+survey's compiled schema once, then resolved against a response cube (see
+cube.py) with AND, OR and NOT of compressed bitmaps (see bitmaps.py):
+
+    {"and": [
+        {"option": 12},
+        {"not": {"option": 31}},
+        {"completed": {"from": "2026-10-05", "to": "2026-10-11"}}
+    ]}
+
+Terms:
+    {"option": <option id>}             selected the option
+    {"answered": <question id>}         answered the question
+    {"complete": true|false}            complete, or partial, responses
+    {"respondent": "authenticated"|"anonymous"}
+    {"created": {"from": .., "to": ..}} started within the dates
+    {"completed": {"from": .., "to": ..}} completed within the dates
+    {"and": [..]}, {"or": [..]}, {"not": ..}
+
+Dates are YYYY-MM-DD in the current time zone, "to" included; either bound
+may be left out.
+"""
+
+import json
+from datetime import datetime, time as dt_time
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from django.utils.translation import gettext as _
+
+from .bitmaps import Bitmap
+
+
+class SegmentError(ValueError):
+    """Invalid segment expression"""
+
+
+def _parse_date(value, end=False):
+    try:
+        day = datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise SegmentError(_("Invalid date format. Please use YYYY-MM-DD."))
+    moment = datetime.combine(day, dt_time.max if end else dt_time.min)
+    return timezone.make_aware(moment, timezone.get_current_timezone()).timestamp()
+
+
+def _date_range(value):
+    if not isinstance(value, dict) or not set(value) <= {'from', 'to'}:
+        raise SegmentError(_("A date range takes 'from' and 'to' dates."))
+    start = _parse_date(value['from']) if value.get('from') else -np.inf
+    end = _parse_date(value['to'], end=True) if value.get('to') else np.inf
+    return start, end
+
+
+class Segment:
+    """Compiled segment expression, resolved against the cubes of its survey's schema version"""
+
+    def __init__(self, data, schema):
+        self.data = data
+        self.version = schema.version
+        option_ids = {option.id for question in schema for option in question.get_options()}
+        self._terms = 0
+        # No expression: every response
+        self.tree = self._compile(data, schema, option_ids) if data is not None else None
+
+    @property
+    def key(self):
+        """Canonical form of the expression, for cache keys"""
+        return json.dumps(self.data, sort_keys=True, separators=(',', ':'))
+
+    def _compile(self, node, schema, option_ids):
+        self._terms += 1
+        if self._terms > getattr(settings, 'SURVEY_SEGMENT_MAX_TERMS', 64):
+            raise SegmentError(_("Segment too complex."))
+        if not isinstance(node, dict) or len(node) != 1:
+            raise SegmentError(_("Each segment term must be an object with a single key."))
+        (operator, value), = node.items()
+        if operator in ('and', 'or'):
+            if not isinstance(value, list) or not value:
+                raise SegmentError(_("'{}' takes a non-empty list of terms.").format(operator))
+            return (operator, [self._compile(term, schema, option_ids) for term in value])
+        if operator == 'not':
+            return ('not', self._compile(value, schema, option_ids))
+        if operator == 'option':
+            if isinstance(value, bool) or not isinstance(value, int) or value not in option_ids:
+                raise SegmentError(_("Unknown option {}.").format(value))
+            return ('option', value)
+        if operator == 'answered':
+            if isinstance(value, bool) or not isinstance(value, int) or schema.get(value) is None:
+                raise SegmentError(_("Unknown question {}.").format(value))
+            return ('answered', value)
+        if operator == 'complete':
+            if not isinstance(value, bool):
+                raise SegmentError(_("'complete' takes true or false."))
+            return ('complete', value)
+        if operator == 'respondent':
+            if value not in ('authenticated', 'anonymous'):
+                raise SegmentError(_("'respondent' takes 'authenticated' or 'anonymous'."))
+            return ('respondent', value == 'authenticated')
+        if operator in ('created', 'completed'):
+            return (operator, _date_range(value))
+        raise SegmentError(_("Unknown segment term '{}'.").format(operator))
+
+    def resolve(self, cube, schema):
+        """Bitmap of the cube's rows in the segment"""
+        if cube.version != self.version:
+            raise SegmentError(_("The survey changed, reload the segment."))
+        if self.tree is None:
+            return Bitmap.full(len(cube))
+        return self._resolve(self.tree, cube, cube.index(schema))
+
+    def mask(self, cube, schema):
+        """Boolean array of the cube's rows in the segment"""
+        return self.resolve(cube, schema).to_mask(len(cube))
+
+    def _resolve(self, node, cube, index):
+        operator, value = node
+        if operator == 'and':
+            # Intersect the smallest bitmaps first
+            bitmaps = sorted((self._resolve(term, cube, index) for term in value), key=len)
+            result = bitmaps[0]
+            for bitmap in bitmaps[1:]:
+                if not result:
+                    break
+                result = result & bitmap
+            return result
+        if operator == 'or':
+            result = Bitmap()
+            for term in value:
+                result = result | self._resolve(term, cube, index)
+            return result
+        if operator == 'not':
+            return self._resolve(value, cube, index).invert(len(cube))
+        if operator == 'option':
+            return index.options[value]
+        if operator == 'answered':
+            return index.answered[value]
+        if operator == 'complete':
+            return index.complete if value else index.complete.invert(len(cube))
+        if operator == 'respondent':
+            authenticated = cube.columns['authenticated']
+            return Bitmap.from_mask(authenticated if value else ~authenticated)
+        start, end = value
+        created, completed = cube.moments()
+        moments = created if operator == 'created' else completed
+        return Bitmap.from_mask((moments >= start) & (moments <= end))
+
+
+def parse_segment(text, schema):
+    """Compile a segment from its JSON text, None when empty; raises SegmentError"""
+    if not text:
+        return None
+    try:
+        data = json.loads(text)
+    except ValueError:
+        raise SegmentError(_("The segment is not valid JSON."))
+    return Segment(data, schema)
+
+
+FILTER_KEYS = {'conditions', 'start', 'end', 'complete', 'respondent'}
+
+
+def filter_segment(filters, schema):
+    """
+    Compile the structured filter of the results API into a segment.
+
+    filters is a dict with optional keys: conditions, a segment expression
+    on the answers; start and end, creation dates (YYYY-MM-DD); complete,
+    true (the default) or false, or null for every response; and
+    respondent, 'authenticated' or 'anonymous'.
+    """
+    if not isinstance(filters, dict):
+        raise SegmentError(_("The filter must be an object."))
+    unknown = set(filters) - FILTER_KEYS
+    if unknown:
+        raise SegmentError(_("Unknown filter keys: {}.").format(', '.join(sorted(unknown))))
+    terms = []
+    if filters.get('conditions') is not None:
+        terms.append(filters['conditions'])
+    if filters.get('start') or filters.get('end'):
+        terms.append({'created': {
+            bound: filters[key] for bound, key in (('from', 'start'), ('to', 'end')) if filters.get(key)
+        }})
+    if filters.get('complete', True) is not None:
+        terms.append({'complete': filters.get('complete', True)})
+    if filters.get('respondent') is not None:
+        terms.append({'respondent': filters['respondent']})
+    if not terms:
+        return Segment(None, schema)
+    return Segment(terms[0] if len(terms) == 1 else {'and': terms}, schema)
@@ -0,0 +1,19 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Question, QuestionOption, Survey, SurveyCounter, SurveyStatistics
+
+
+@receiver(post_save, sender=QuestionOption)
+@receiver(post_delete, sender=QuestionOption)
+def touch_question_on_option_change(sender, instance, **kwargs):
+    """Bump the question's updated_at so compiled survey schemas get rebuilt"""
+    Question.objects.filter(pk=instance.question_id).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Survey)
+def create_survey_counter(sender, instance, created, **kwargs):
+    if created:
+        SurveyCounter.objects.get_or_create(survey=instance)
+        SurveyStatistics.objects.get_or_create(survey=instance)
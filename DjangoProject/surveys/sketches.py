@@ -0,0 +1,558 @@
+"""
+Streaming summaries of a survey's complete responses.
+
+Three kinds of mergeable sketches are folded in as responses complete:
+
+- the values of rating questions (numeric option labels) and of numeric
+  text questions (those with a min_value or max_value): count, sum, sum of
+  squares, min and max, a merging t-digest for quantiles and a fixed-bin
+  histogram;
+- the IP addresses, session keys and accounts of the respondents: one
+  HyperLogLog each, for distinct counts;
+- the values of text questions: a Count-Min sketch and the most frequent
+  values it has seen, for approximate top values.
+
+Sketches are kept per survey and day of completion (SurveySketch) and
+merged over the days a result covers, so these figures cost one small
+query whatever the number of responses, instead of COUNT(DISTINCT) and
+GROUP BY scans of the responses and answers.
+"""
+
+import base64
+import hashlib
+import math
+import zlib
+from collections import Counter, defaultdict
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import aggregates
+from .models import Answer, Question, Response, SurveySketch
+from .text import TEXT_TYPES, fold
+
+HISTOGRAM_BINS = 10
+
+# HyperLogLog registers: 2 ** 12, a relative standard error of 1.04 / 64 = 1.6 %
+HLL_PRECISION = 12
+
+# Count-Min sketch: counts overestimated by at most e / width of the total,
+# except with probability exp(-depth), i.e. 0.13 % of the total 98 % of the time
+CMS_WIDTH = 2048
+CMS_DEPTH = 4
+
+# Candidate top values kept per question and day, and longest value kept
+TOP_VALUES = 50
+VALUE_MAX_LENGTH = 200
+
+DISTINCT_KEYS = ('ip_address', 'session_key', 'respondent')
+
+
+def _to_number(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def _compression():
+    return getattr(settings, 'SURVEY_SKETCH_COMPRESSION', 100)
+
+
+def _k(q, delta):
+    """Scale function k1 of the t-digest: small centroids near the tails"""
+    return delta / (2 * math.pi) * math.asin(2 * q - 1)
+
+
+def _k_inverse(k, delta):
+    return (math.sin(min(k * 2 * math.pi / delta, math.pi / 2)) + 1) / 2
+
+
+class NumericSketch:
+    """Mergeable summary of a stream of numbers, with quantiles from a merging t-digest"""
+
+    __slots__ = ('count', 'total', 'total_sq', 'minimum', 'maximum', 'means', 'weights', 'edges', 'histogram')
+
+    def __init__(self, edges=None):
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+        self.means = np.zeros(0)
+        self.weights = np.zeros(0)
+        # Fixed histogram bins, fixed by the question (see histogram_edges)
+        self.edges = list(edges) if edges else None
+        self.histogram = [0] * (len(self.edges) - 1) if self.edges else None
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        if not len(values):
+            return
+        self.count += len(values)
+        self.total += float(values.sum())
+        self.total_sq += float((values ** 2).sum())
+        self.minimum = min(self.minimum, float(values.min()))
+        self.maximum = max(self.maximum, float(values.max()))
+        self._compress(np.concatenate([self.means, values]), np.concatenate([self.weights, np.ones(len(values))]))
+        if self.edges:
+            edges = np.asarray(self.edges)
+            inside = values[(values >= edges[0]) & (values <= edges[-1])]
+            bins = np.minimum(np.searchsorted(edges, inside, side='right') - 1, len(self.histogram) - 1)
+            self.histogram = (np.asarray(self.histogram) + np.bincount(bins, minlength=len(self.histogram))).tolist()
+
+    def merge(self, other):
+        """Fold another sketch into this one"""
+        if not other.count:
+            return
+        self.count += other.count
+        self.total += other.total
+        self.total_sq += other.total_sq
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self._compress(np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights]))
+        if self.edges and self.edges == other.edges:
+            self.histogram = [mine + theirs for mine, theirs in zip(self.histogram, other.histogram)]
+        elif self.edges:
+            # Bins changed with the question's bounds: no consistent histogram
+            self.edges = self.histogram = None
+
+    def _compress(self, means, weights):
+        """Merge centroids so that each stays within one unit of the k1 scale"""
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        delta = _compression()
+        total = weights.sum()
+        merged_means, merged_weights = [], []
+        mean, weight = means[0], weights[0]
+        before = 0.0
+        limit = total * _k_inverse(_k(0.0, delta) + 1, delta)
+        for next_mean, next_weight in zip(means[1:], weights[1:]):
+            if before + weight + next_weight <= limit:
+                mean += (next_mean - mean) * next_weight / (weight + next_weight)
+                weight += next_weight
+                continue
+            merged_means.append(mean)
+            merged_weights.append(weight)
+            before += weight
+            limit = total * _k_inverse(_k(before / total, delta) + 1, delta)
+            mean, weight = next_mean, next_weight
+        merged_means.append(mean)
+        merged_weights.append(weight)
+        self.means = np.array(merged_means)
+        self.weights = np.array(merged_weights)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    @property
+    def std(self):
+        if not self.count:
+            return None
+        return math.sqrt(max(0.0, self.total_sq / self.count - (self.total / self.count) ** 2))
+
+    def quantile(self, q):
+        """Approximate q-quantile, interpolated between centroids and the exact extremes"""
+        if not self.count:
+            return None
+        centers = np.cumsum(self.weights) - self.weights / 2
+        positions = np.concatenate([[0.0], centers, [self.count]])
+        values = np.concatenate([[self.minimum], self.means, [self.maximum]])
+        return float(np.interp(q * self.count, positions, values))
+
+    def summary(self):
+        """Figures shown on the results page"""
+        if not self.count:
+            return None
+        return {
+            'count': self.count,
+            'mean': round(self.mean, 2),
+            'std': round(self.std, 2),
+            'min': self.minimum,
+            'max': self.maximum,
+            'median': round(self.quantile(0.5), 2),
+            'p90': round(self.quantile(0.9), 2),
+            'histogram': [
+                {'low': low, 'high': high, 'count': count}
+                for low, high, count in zip(self.edges, self.edges[1:], self.histogram)
+            ] if self.edges else None,
+        }
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.total,
+            'sum_sq': self.total_sq,
+            'min': self.minimum if self.count else None,
+            'max': self.maximum if self.count else None,
+            'centroids': [[float(mean), float(weight)] for mean, weight in zip(self.means, self.weights)],
+            'edges': self.edges,
+            'histogram': self.histogram,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        sketch = cls()
+        sketch.count = data['count']
+        sketch.total = data['sum']
+        sketch.total_sq = data['sum_sq']
+        if data['count']:
+            sketch.minimum = data['min']
+            sketch.maximum = data['max']
+        centroids = np.array(data['centroids'], dtype=float).reshape(-1, 2)
+        sketch.means, sketch.weights = centroids[:, 0], centroids[:, 1]
+        sketch.edges = data['edges']
+        sketch.histogram = data['histogram']
+        return sketch
+
+
+def _pack(array):
+    """Compressed text form of an array, for the JSON fields of SurveySketch"""
+    return base64.b64encode(zlib.compress(array.tobytes())).decode('ascii')
+
+
+def _unpack(text, dtype):
+    return np.frombuffer(zlib.decompress(base64.b64decode(text)), dtype=dtype).copy()
+
+
+def _hashes(values, size=8):
+    """size-byte hashes of some strings, as an array of bytes per value"""
+    digests = b''.join(hashlib.blake2b(value.encode(), digest_size=size).digest() for value in values)
+    return np.frombuffer(digests, dtype=np.uint8).reshape(-1, size)
+
+
+class HyperLogLog:
+    """Mergeable estimate of the number of distinct strings of a stream"""
+
+    __slots__ = ('registers',)
+
+    def __init__(self, registers=None):
+        self.registers = registers if registers is not None else np.zeros(1 << HLL_PRECISION, dtype=np.uint8)
+
+    def add(self, values):
+        values = list(values)
+        if not values:
+            return
+        hashes = _hashes(values).view('<u8').ravel()
+        buckets = (hashes >> np.uint64(64 - HLL_PRECISION)).astype(np.intp)
+        rest = hashes & np.uint64((1 << (64 - HLL_PRECISION)) - 1)
+        # Position of the first set bit of the remaining bits (exact in a float64, they are 52)
+        ranks = (64 - HLL_PRECISION + 1 - np.frexp(rest.astype(float))[1]).astype(np.uint8)
+        np.maximum.at(self.registers, buckets, ranks)
+
+    def merge(self, other):
+        np.maximum(self.registers, other.registers, out=self.registers)
+
+    @property
+    def relative_error(self):
+        """Relative standard error of the estimate"""
+        return 1.04 / math.sqrt(len(self.registers))
+
+    def estimate(self):
+        m = len(self.registers)
+        raw = 0.7213 / (1 + 1.079 / m) * m * m / float(np.ldexp(1.0, -self.registers.astype(int)).sum())
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if raw <= 2.5 * m and zeros:
+            # Linear counting, more accurate for small cardinalities
+            return round(m * math.log(m / zeros))
+        return round(raw)
+
+    def summary(self):
+        """Estimate with its error at two standard errors (95 %)"""
+        estimate = self.estimate()
+        return {'estimate': estimate, 'error': math.ceil(2 * self.relative_error * estimate)}
+
+    def to_text(self):
+        return _pack(self.registers)
+
+    @classmethod
+    def from_text(cls, text):
+        return cls(_unpack(text, np.uint8))
+
+
+class FrequentValues:
+    """
+    Approximate most frequent values of a stream: a Count-Min sketch and
+    the TOP_VALUES values with the highest estimated counts seen so far.
+    """
+
+    __slots__ = ('counts', 'total', 'top')
+
+    def __init__(self, counts=None, total=0, top=None):
+        self.counts = counts if counts is not None else np.zeros((CMS_DEPTH, CMS_WIDTH), dtype=np.uint32)
+        self.total = total
+        # Candidate value -> estimated count
+        self.top = top or {}
+
+    def _cells(self, values):
+        return _hashes(values, 4 * CMS_DEPTH).view('<u4') % CMS_WIDTH
+
+    def estimate(self, values):
+        """Estimated counts of some values, never below their true counts"""
+        values = list(values)
+        if not values:
+            return []
+        return self.counts[np.arange(CMS_DEPTH), self._cells(values)].min(axis=1).tolist()
+
+    def add(self, counter):
+        """Add a Counter of values"""
+        if not counter:
+            return
+        values = list(counter)
+        np.add.at(self.counts, (np.arange(CMS_DEPTH), self._cells(values)), np.array([counter[value] for value in values], dtype=np.uint32)[:, None])
+        self.total += sum(counter.values())
+        self._keep(set(self.top) | set(values))
+
+    def merge(self, other):
+        self.counts += other.counts
+        self.total += other.total
+        self._keep(set(self.top) | set(other.top))
+
+    def _keep(self, candidates):
+        candidates = sorted(candidates)
+        ranked = sorted(zip(self.estimate(candidates), candidates), key=lambda item: (-item[0], item[1]))
+        self.top = {value: count for count, value in ranked[:TOP_VALUES]}
+
+    @property
+    def error(self):
+        """Largest overestimate of a count, except with probability exp(-CMS_DEPTH)"""
+        return math.ceil(math.e / CMS_WIDTH * self.total)
+
+    def summary(self, limit=10):
+        """Most frequent values with their counts, and the error bound of the counts"""
+        if not self.total:
+            return None
+        return {'top': list(self.top.items())[:limit], 'error': self.error, 'total': self.total}
+
+    def to_dict(self):
+        return {'counts': _pack(self.counts), 'total': self.total, 'top': [[value, count] for value, count in self.top.items()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        counts = _unpack(data['counts'], np.uint32).reshape(CMS_DEPTH, CMS_WIDTH)
+        return cls(counts, data['total'], {value: count for value, count in data['top']})
+
+
+def normalize_value(text):
+    """Text answer as counted among the frequent values: folded, single-spaced, truncated"""
+    return ' '.join(fold(text).split())[:VALUE_MAX_LENGTH]
+
+
+def histogram_edges(question_type, min_value, max_value, numbers):
+    """
+    Fixed histogram bins of a numeric question.
+
+    One bin per value for rating questions (numbers are their options'
+    values), HISTOGRAM_BINS equal bins between the bounds of numeric text
+    questions, None when they are not both set.
+    """
+    if question_type == 'rating':
+        values = sorted(set(numbers))
+        return values + [values[-1] + 1] if values else None
+    if min_value is None or max_value is None or max_value <= min_value:
+        return None
+    return np.linspace(min_value, max_value, HISTOGRAM_BINS + 1).tolist()
+
+
+def numeric_questions(survey_id):
+    """
+    Rating and numeric text questions of a survey, in one query.
+
+    Returns a dict mapping question ids to (option_values, edges):
+    option_values maps option ids to their numeric value for rating
+    questions, and is None for numeric text questions.
+    """
+    rows = Question.objects.filter(survey_id=survey_id).filter(
+        Q(question_type__name='rating')
+        | Q(question_type__has_options=False, min_value__isnull=False)
+        | Q(question_type__has_options=False, max_value__isnull=False)
+    ).exclude(question_type__name='date').values_list(
+        'id', 'question_type__name', 'min_value', 'max_value', 'options__id', 'options__text'
+    )
+    questions = {}
+    for question_id, type_name, min_value, max_value, option_id, option_text in rows:
+        entry = questions.setdefault(question_id, [type_name, min_value, max_value, {}])
+        number = _to_number(option_text)
+        if option_id is not None and number is not None:
+            entry[3][option_id] = number
+    return {
+        question_id: (
+            option_values if type_name == 'rating' else None,
+            histogram_edges(type_name, min_value, max_value, option_values.values()),
+        )
+        for question_id, (type_name, min_value, max_value, option_values) in questions.items()
+    }
+
+
+def answer_values(questions, answers):
+    """
+    Numbers of some answers, as a dict mapping question ids to lists.
+
+    answers is an iterable of (question_id, data, option_id) rows, as read
+    by the queries of this module.
+    """
+    values = defaultdict(list)
+    for question_id, data, option_id in answers:
+        option_values, _ = questions[question_id]
+        number = option_values.get(option_id) if option_values is not None else _to_number(data)
+        if number is not None:
+            values[question_id].append(number)
+    return values
+
+
+def sketch_values(questions, numeric, values):
+    """Merge lists of values into a row's serialized sketches, returns the new serialized sketches"""
+    numeric = dict(numeric)
+    for question_id, question_values in values.items():
+        previous = numeric.get(str(question_id))
+        sketch = NumericSketch.from_dict(previous) if previous else NumericSketch(questions[question_id][1])
+        sketch.add(question_values)
+        numeric[str(question_id)] = sketch.to_dict()
+    return numeric
+
+
+def text_questions(survey_id):
+    """Ids of the text questions of a survey"""
+    return list(Question.objects.filter(survey_id=survey_id, question_type__name__in=TEXT_TYPES).values_list('id', flat=True))
+
+
+def distinct_values(respondents):
+    """
+    Keys of some respondents, as a dict mapping DISTINCT_KEYS to lists.
+
+    respondents is an iterable of (ip_address, session_key, respondent_id)
+    rows; missing keys (anonymous respondents, no session) are left out.
+    """
+    values = defaultdict(list)
+    for row in respondents:
+        for key, value in zip(DISTINCT_KEYS, row):
+            if value:
+                values[key].append(str(value))
+    return values
+
+
+def sketch_respondents(respondents, values):
+    """Add the keys of distinct_values into a row's serialized HyperLogLogs, returns the new ones"""
+    respondents = dict(respondents)
+    for key, key_values in values.items():
+        sketch = HyperLogLog.from_text(respondents[key]) if key in respondents else HyperLogLog()
+        sketch.add(key_values)
+        respondents[key] = sketch.to_text()
+    return respondents
+
+
+def text_values(answers):
+    """Normalized values of text answers, as a dict mapping question ids to Counters"""
+    values = defaultdict(Counter)
+    for question_id, data in answers:
+        value = normalize_value(data or '')
+        if value:
+            values[question_id][value] += 1
+    return values
+
+
+def sketch_text_values(text_sketches, values):
+    """Add the Counters of text_values into a row's serialized FrequentValues, returns the new ones"""
+    text_sketches = dict(text_sketches)
+    for question_id, counter in values.items():
+        previous = text_sketches.get(str(question_id))
+        sketch = FrequentValues.from_dict(previous) if previous else FrequentValues()
+        sketch.add(counter)
+        text_sketches[str(question_id)] = sketch.to_dict()
+    return text_sketches
+
+
+def update_sketches(survey_id, day, response_ids):
+    """Add newly completed responses to the sketches of their day"""
+    questions = numeric_questions(survey_id)
+    text_ids = set(text_questions(survey_id))
+    numeric_answers, text_answers = [], []
+    answers = Answer.objects.filter(response_id__in=response_ids, question_id__in=[*questions, *text_ids]).values_list(
+        'question_id', 'data', 'selected_options'
+    )
+    for question_id, data, option_id in answers:
+        if question_id in questions:
+            numeric_answers.append((question_id, data, option_id))
+        else:
+            text_answers.append((question_id, data))
+    respondents = Response.objects.filter(id__in=response_ids).values_list('ip_address', 'session_key', 'respondent_id')
+    with transaction.atomic():
+        row, created = SurveySketch.objects.select_for_update().get_or_create(survey_id=survey_id, day=day)
+        row.numeric = sketch_values(questions, row.numeric, answer_values(questions, numeric_answers))
+        row.respondents = sketch_respondents(row.respondents, distinct_values(respondents))
+        row.text_values = sketch_text_values(row.text_values, text_values(text_answers))
+        row.save(update_fields=['numeric', 'respondents', 'text_values', 'updated_at'])
+
+
+def record_completions(survey_id, response_ids):
+    """Add newly completed responses to the sketches once the caller's transaction commits"""
+    response_ids = list(response_ids)
+    if response_ids:
+        aggregates.record(update_sketches, (survey_id, timezone.localdate()), response_ids)
+
+
+def day_of(moment):
+    """Local day of a moment, naive moments being local already"""
+    return timezone.localdate(moment) if timezone.is_aware(moment) else moment.date()
+
+
+def _days(survey_id, start, end):
+    rows = SurveySketch.objects.filter(survey_id=survey_id)
+    if start is not None:
+        rows = rows.filter(day__gte=day_of(start))
+    if end is not None:
+        rows = rows.filter(day__lte=day_of(end))
+    return rows
+
+
+def merged_sketches(survey_id, start=None, end=None):
+    """
+    Merge the sketches of a survey over the days from start to end (both optional).
+
+    Returns a dict mapping question ids to NumericSketch.
+    """
+    sketches = {}
+    for numeric in _days(survey_id, start, end).values_list('numeric', flat=True):
+        for question_id, data in numeric.items():
+            sketch = NumericSketch.from_dict(data)
+            if int(question_id) in sketches:
+                sketches[int(question_id)].merge(sketch)
+            else:
+                sketches[int(question_id)] = sketch
+    return sketches
+
+
+def distinct_respondents(survey_id, start=None, end=None):
+    """
+    Estimated distinct IP addresses, session keys and accounts of the
+    complete responses from start to end (both optional), to the day.
+
+    Returns a dict mapping DISTINCT_KEYS to HyperLogLog.summary() dicts.
+    """
+    merged = {key: HyperLogLog() for key in DISTINCT_KEYS}
+    for respondents in _days(survey_id, start, end).values_list('respondents', flat=True):
+        for key, data in respondents.items():
+            merged[key].merge(HyperLogLog.from_text(data))
+    return {key: sketch.summary() for key, sketch in merged.items()}
+
+
+def frequent_values(survey_id, start=None, end=None, limit=10):
+    """
+    Approximate most frequent values of the text questions of a survey, to the day.
+
+    Returns a dict mapping question ids to FrequentValues.summary() dicts.
+    """
+    merged = {}
+    for text_sketches in _days(survey_id, start, end).values_list('text_values', flat=True):
+        for question_id, data in text_sketches.items():
+            sketch = FrequentValues.from_dict(data)
+            if int(question_id) in merged:
+                merged[int(question_id)].merge(sketch)
+            else:
+                merged[int(question_id)] = sketch
+    return {question_id: sketch.summary(limit) for question_id, sketch in merged.items() if sketch.total}
@@ -0,0 +1,21 @@
+from django import template
+from django.utils.safestring import mark_safe
+
+from ..fragments import render_question
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def question_fragment(context, question, answer=None):
+    """
+    Render a question's input from its cached fragment.
+
+    Uses the fragments prefetched by the view in ``question_fragments`` when
+    present, and renders the question live when it has a prefilled answer.
+    """
+    if not answer:
+        html = (context.get('question_fragments') or {}).get(question.id)
+        if html is not None:
+            return mark_safe(html)
+    return mark_safe(render_question(question, answer))
@@ -1,3 +1,1464 @@
-from django.test import TestCase
+import csv
+import io
+import json
+import math
+import os
+import re
+import tempfile
+import uuid
+from collections import Counter
+from datetime import date, timedelta
+from unittest import mock, skipUnless
+from urllib.parse import urlencode
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.http import FileResponse, QueryDict
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import aggregates, autosave, export_cache, export_jobs, feed, writebehind
+from .bitmaps import CHUNK_SIZE, Bitmap
+from .crosstab import CrossTab, build_crosstab, chi2_sf, crosstab
+from .cube import build_cube, catch_up, evict_cube, get_cube, load_cube, save_cube
+from .ingest import ingest_submission
+from .models import (
+    Answer, Question, QuestionOption, QuestionType, Response, ResponseRollup, Survey, SurveyCounter, SurveyStatistics,
+    TextPosting, TextTerm,
+)
+from .parquet import parquet_available, write_parquet
+from .results import aggregate_results, layout_results
+from .schema import build_survey_schema, get_survey_schema
+from .segments import SegmentError, parse_segment
+from .sketches import FrequentValues, HyperLogLog, NumericSketch, merged_sketches
+from .text import extract_terms, fold, rebuild_index, search_answers, tokenize, top_terms
+from .tokens import make_response_token, read_response_token
+from .utils import export_survey_to_csv
+from .validation import validate_post
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+@override_settings(SURVEY_AGGREGATE_FLUSH_INTERVAL=0, SURVEY_WRITE_BEHIND=False)
+class SurveyTestCase(TestCase):
+    """A survey with one question of each kind: single and multiple choice, rating, text, number and date"""
+
+    @classmethod
+    def setUpTestData(cls):
+        QuestionType.get_default_types()
+        cls.user = User.objects.create_user('owner', password='secret')
+        cls.survey = Survey.objects.create(title="Survey", creator=cls.user)
+        cls.single = cls.add_question('radio', "Colour", options=['Red', 'Green', 'Blue'])
+        cls.multiple = cls.add_question('checkbox', "Pets", options=['Cat', 'Dog', 'Fish'])
+        cls.rating = cls.add_question('rating', "Score", options=['1', '2', '3', '4', '5'], required=False)
+        cls.text = cls.add_question('text', "Comment", required=False)
+        cls.number = cls.add_question('text', "Age", required=False, min_value=0, max_value=120)
+        cls.date = cls.add_question('date', "Birthday", required=False)
+
+    @classmethod
+    def add_question(cls, type_name, text, options=(), **fields):
+        question = Question.objects.create(
+            survey=cls.survey, text=text, question_type=QuestionType.objects.get(name=type_name),
+            order=Question.objects.filter(survey=cls.survey).count(), **fields,
+        )
+        for order, option in enumerate(options):
+            QuestionOption.objects.create(question=question, text=option, order=order)
+        return question
+
+    def option(self, question, text):
+        return QuestionOption.objects.get(question=question, text=text).id
+
+    def schema(self):
+        return build_survey_schema(self.survey)
+
+    def post(self, **answers):
+        """Form post of answers given by question attribute name"""
+        data = QueryDict(mutable=True)
+        data.update(QueryDict(urlencode(
+            {f'question_{getattr(self, name).id}': value for name, value in answers.items()}, doseq=True
+        )))
+        return data
+
+    def new_response(self, minutes_ago=5):
+        """Response started from a signed token, not inserted yet"""
+        return Response(survey=self.survey, created_at=timezone.now() - timedelta(minutes=minutes_ago))
+
+    def submit(self, complete=True, **answers):
+        """Ingest a submission in a new response, returns (response, errors)"""
+        response = self.new_response()
+        with self.captureOnCommitCallbacks(execute=True):
+            errors = ingest_submission(response, self.schema(), self.post(**answers), complete=complete)
+        return response, errors
+
+
+class IngestTests(SurveyTestCase):
+    def test_valid_submission_writes_answers_and_options(self):
+        response, errors = self.submit(
+            single=self.option(self.single, 'Green'),
+            multiple=[self.option(self.multiple, 'Cat'), self.option(self.multiple, 'Fish')],
+            text="Nice",
+        )
+        self.assertEqual(errors, {})
+        response.refresh_from_db()
+        self.assertTrue(response.is_complete)
+        answers = {answer.question_id: answer for answer in response.answers.all()}
+        self.assertEqual(set(answers), {self.single.id, self.multiple.id, self.text.id})
+        self.assertEqual(answers[self.text.id].data, "Nice")
+        self.assertEqual(
+            set(answers[self.multiple.id].selected_options.values_list('text', flat=True)), {'Cat', 'Fish'}
+        )
+        self.assertEqual(list(answers[self.single.id].selected_options.values_list('text', flat=True)), ['Green'])
+
+    def test_invalid_submission_writes_nothing(self):
+        response, errors = self.submit(
+            single=self.option(self.single, 'Green'),
+            multiple=[self.option(self.multiple, 'Cat')],
+            number='200',
+        )
+        self.assertEqual(set(errors), {self.number.id})
+        self.assertIsNone(response.pk)
+        self.assertFalse(Answer.objects.exists())
+
+    def test_missing_required_answers_are_all_reported(self):
+        response, errors = self.submit(text="Only a comment")
+        self.assertEqual(set(errors), {self.single.id, self.multiple.id})
+        self.assertFalse(Response.objects.exists())
+
+    def test_partial_save_keeps_the_response_incomplete(self):
+        response, errors = self.submit(
+            complete=False, single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Dog')],
+        )
+        self.assertEqual(errors, {})
+        response.refresh_from_db()
+        self.assertFalse(response.is_complete)
+
+    def test_resubmission_replaces_answers(self):
+        response, errors = self.submit(
+            single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Dog')],
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            ingest_submission(response, self.schema(), self.post(
+                single=self.option(self.single, 'Blue'), multiple=[self.option(self.multiple, 'Cat')],
+            ), complete=False)
+        self.assertEqual(response.answers.count(), 2)
+        self.assertEqual(
+            set(Answer.objects.filter(response=response).values_list('selected_options__text', flat=True)),
+            {'Blue', 'Cat'},
+        )
+
+    def test_start_time_of_the_token_is_kept(self):
+        response = self.new_response(minutes_ago=90)
+        started_at = response.created_at
+        with self.captureOnCommitCallbacks(execute=True):
+            ingest_submission(response, self.schema(), self.post(
+                single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Dog')],
+            ))
+        response.refresh_from_db()
+        self.assertEqual(response.created_at, started_at)
+        self.assertGreaterEqual(response.completion_time, timedelta(minutes=90))
+
+
+class WriteBehindTests(SurveyTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.buffer = writebehind.WriteBehindBuffer(self.directory)
+        self.addCleanup(self.buffer._journal.close)
+
+    def accept(self, **answers):
+        """Reserve a slot and journal a completed submission, as complete_submission does"""
+        response = self.new_response(minutes_ago=30)
+        cleaned, errors = validate_post(self.schema(), self.post(**answers))
+        self.assertEqual(errors, {})
+        self.assertTrue(SurveyCounter.reserve(self.survey.pk))
+        token = self.buffer.append(response, self.schema(), cleaned)
+        return response, token
+
+    def replay(self):
+        """Replay the buffer's journal as the journal of a stopped process"""
+        self.buffer._journal.close()
+        with self.captureOnCommitCallbacks(execute=True):
+            return writebehind.replay_orphan_journals(self.directory)
+
+    def counter(self):
+        return SurveyCounter.objects.values_list('completed', 'reserved').get(survey=self.survey)
+
+    def test_flush_creates_completed_responses(self):
+        response, token = self.accept(
+            single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Cat')],
+        )
+        with self.captureOnCommitCallbacks(execute=True):
+            self.buffer.flush()
+        created = Response.objects.get(resume_token=uuid.UUID(token))
+        self.assertTrue(created.is_complete)
+        self.assertEqual(created.created_at, response.created_at)
+        self.assertEqual(created.answers.count(), 2)
+        self.assertEqual(self.counter(), (1, 0))
+        self.assertEqual(self.buffer.metrics()['queue_depth'], 0)
+
+    def test_replay_is_idempotent(self):
+        self.accept(single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Cat')])
+        self.accept(single=self.option(self.single, 'Blue'), multiple=[self.option(self.multiple, 'Dog')])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.buffer.flush()
+        # Lose the offset, as a crash between the flush and its bookkeeping would
+        os.remove(self.buffer.journal_path + writebehind.OFFSET_SUFFIX)
+        self.assertEqual(self.replay(), 2)
+        self.assertEqual(Response.objects.count(), 2)
+        self.assertEqual(Answer.objects.count(), 4)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_poison_entry_is_dead_lettered_and_releases_its_slot(self):
+        self.accept(single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Cat')])
+        _, token = self.accept(single=self.option(self.single, 'Green'), multiple=[self.option(self.multiple, 'Dog')])
+        self.accept(single=self.option(self.single, 'Blue'), multiple=[self.option(self.multiple, 'Fish')])
+        # Corrupt the token of the second entry so that it can never be written
+        with open(self.buffer.journal_path, 'rb') as handle:
+            content = handle.read()
+        with open(self.buffer.journal_path, 'wb') as handle:
+            handle.write(content.replace(token.encode(), b'not-a-token'.ljust(len(token), b'-')))
+
+        with self.assertLogs('surveys.writebehind', 'ERROR'):
+            self.assertEqual(self.replay(), 2)
+        self.assertEqual(Response.objects.count(), 2)
+        self.assertEqual(self.counter(), (2, 0))
+        dead_path = self.buffer.journal_path[:-len(writebehind.JOURNAL_SUFFIX)] + writebehind.DEAD_LETTER_SUFFIX
+        with open(dead_path) as handle:
+            dead = [json.loads(line) for line in handle]
+        self.assertEqual(len(dead), 1)
+        self.assertTrue(dead[0]['token'].startswith('not-a-token'))
+        self.assertIn('error', dead[0])
+        self.assertEqual(os.listdir(self.directory), [os.path.basename(dead_path)])
+
+    def test_answers_to_deleted_options_are_dropped(self):
+        _, token = self.accept(
+            single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Cat')], text="Hello",
+        )
+        QuestionOption.objects.filter(question=self.multiple, text='Cat').delete()
+        self.text.delete()
+        with self.captureOnCommitCallbacks(execute=True), self.assertLogs('surveys.writebehind', 'WARNING'):
+            self.buffer.flush()
+        created = Response.objects.get(resume_token=uuid.UUID(token))
+        self.assertEqual(list(created.answers.values_list('question_id', flat=True)), [self.single.id])
+        self.assertEqual(self.counter(), (1, 0))
+
+    def test_metrics_count_the_journals_of_stopped_processes(self):
+        self.accept(single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Cat')])
+        self.accept(single=self.option(self.single, 'Blue'), multiple=[self.option(self.multiple, 'Dog')])
+        self.buffer._journal.close()
+        with override_settings(SURVEY_WRITE_BEHIND_DIR=self.directory):
+            metrics = writebehind.get_metrics()
+        self.assertEqual((metrics['queue_depth'], metrics['orphan_journals']), (2, 1))
+
+    def test_journals_are_replayed_at_startup_even_when_disabled(self):
+        with override_settings(SURVEY_WRITE_BEHIND_DIR=os.path.join(self.directory, 'missing')):
+            self.assertIsNone(writebehind.replay_at_startup())
+        with override_settings(SURVEY_WRITE_BEHIND_DIR=self.directory):
+            with mock.patch.object(writebehind.threading, 'Thread') as thread:
+                self.accept(single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Cat')])
+                self.buffer._journal.close()
+                writebehind.replay_at_startup()
+            thread.assert_called_once()
+            self.assertEqual(thread.call_args.kwargs['args'], (self.directory,))
+            with mock.patch.object(writebehind, 'close_old_connections'), \
+                    self.captureOnCommitCallbacks(execute=True):
+                thread.call_args.kwargs['target'](self.directory)
+        self.assertEqual(Response.objects.filter(is_complete=True).count(), 1)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_unavailable_database_keeps_entries_queued(self):
+        self.accept(single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Cat')])
+        with mock.patch.object(writebehind, 'flush_entries', side_effect=OperationalError("gone away")):
+            with self.assertLogs('surveys.writebehind', 'ERROR'):
+                self.buffer.flush()
+        metrics = self.buffer.metrics()
+        self.assertEqual((metrics['queue_depth'], metrics['failed_flushes'], metrics['dead_lettered']), (1, 1, 0))
+        self.assertEqual(self.counter(), (0, 1))
+
+
+class QuotaTests(SurveyTestCase):
+    def setUp(self):
+        Survey.objects.filter(pk=self.survey.pk).update(max_responses=2)
+        self.survey.refresh_from_db()
+
+    def counter(self):
+        return SurveyCounter.objects.values_list('completed', 'reserved').get(survey=self.survey)
+
+    def test_reservations_are_bounded_by_max_responses(self):
+        self.assertTrue(SurveyCounter.reserve(self.survey.pk, 2))
+        self.assertTrue(SurveyCounter.reserve(self.survey.pk, 2))
+        self.assertFalse(SurveyCounter.reserve(self.survey.pk, 2))
+        SurveyCounter.release(self.survey.pk)
+        self.assertTrue(SurveyCounter.reserve(self.survey.pk, 2))
+        SurveyCounter.commit(self.survey.pk, completed=2, reserved=2)
+        self.assertEqual(self.counter(), (2, 0))
+        self.assertFalse(SurveyCounter.reserve(self.survey.pk, 2))
+
+    def test_full_survey_rejects_submissions_without_writing(self):
+        answers = {'single': self.option(self.single, 'Red'), 'multiple': [self.option(self.multiple, 'Cat')]}
+        for _ in range(2):
+            response, errors = self.submit(**answers)
+            self.assertEqual(errors, {})
+        response, errors = self.submit(**answers)
+        self.assertEqual(list(errors), [None])
+        self.assertIsNone(response.pk)
+        self.assertEqual(Response.objects.count(), 2)
+        self.assertEqual(self.counter(), (2, 0))
+
+    def test_failed_write_releases_the_reservation(self):
+        with mock.patch('surveys.ingest.store_submission', side_effect=RuntimeError("disk full")):
+            with self.assertRaises(RuntimeError):
+                self.submit(single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Cat')])
+        self.assertEqual(self.counter(), (0, 0))
+        self.assertFalse(Response.objects.exists())
+
+    def test_recount_drops_stale_reservations(self):
+        self.submit(single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Cat')])
+        SurveyCounter.reserve(self.survey.pk, 2)
+        self.assertEqual(SurveyCounter.recount(self.survey.pk), 1)
+        self.assertEqual(self.counter(), (1, 0))
+
+
+class AutosaveTests(SurveyTestCase):
+    def setUp(self):
+        cache.clear()
+        self.response = Response.objects.create(survey=self.survey)
+        patcher = mock.patch.object(autosave._flusher, 'schedule')
+        self.schedule = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def save(self, **answers):
+        changes, errors = autosave.validate_patch(
+            self.schema(), {getattr(self, name).id: value for name, value in answers.items()}
+        )
+        self.assertEqual(errors, {})
+        return autosave.apply_patch(self.response, self.schema(), changes)
+
+    def stored(self):
+        return {
+            answer.question_id: (answer.data, set(answer.selected_options.values_list('text', flat=True)))
+            for answer in self.response.answers.all()
+        }
+
+    def test_validate_patch_reports_each_rejected_key(self):
+        changes, errors = autosave.validate_patch(self.schema(), {
+            self.number.id: '300', 'nope': 'x', self.single.id: '', self.text.id: ' Hi ',
+        })
+        self.assertEqual(set(errors), {str(self.number.id), 'nope'})
+        self.assertEqual(changes, {self.single.id: None, self.text.id: 'Hi'})
+
+    def test_only_differences_are_written(self):
+        cat, dog, fish = (self.option(self.multiple, text) for text in ('Cat', 'Dog', 'Fish'))
+        stats = self.save(multiple=[cat, dog], text="Hello")
+        self.assertEqual(stats, {'created': 2, 'updated': 0, 'deleted': 0, 'unchanged': 0})
+
+        stats = self.save(multiple=[cat, dog], text="Hello", single='')
+        self.assertEqual(stats, {'created': 0, 'updated': 0, 'deleted': 0, 'unchanged': 3})
+
+        stats = self.save(multiple=[dog, fish], text="Hello again")
+        self.assertEqual(stats, {'created': 0, 'updated': 2, 'deleted': 0, 'unchanged': 0})
+        self.assertEqual(self.stored(), {
+            self.multiple.id: (json.dumps([str(dog), str(fish)]), {'Dog', 'Fish'}),
+            self.text.id: ("Hello again", set()),
+        })
+
+        stats = self.save(multiple=[], text=None)
+        self.assertEqual(stats, {'created': 0, 'updated': 0, 'deleted': 2, 'unchanged': 0})
+        self.assertEqual(self.stored(), {})
+
+    def test_patches_within_the_window_are_merged(self):
+        red, blue = self.option(self.single, 'Red'), self.option(self.single, 'Blue')
+        self.assertEqual(autosave.coalesce(self.response, {self.single.id: str(red)}), {self.single.id: str(red)})
+        self.assertIsNone(autosave.coalesce(self.response, {self.text.id: "A"}))
+        self.assertIsNone(autosave.coalesce(self.response, {self.single.id: str(blue)}))
+        self.schedule.assert_called_once_with(self.response.pk, autosave._window())
+        self.assertEqual(
+            autosave.coalesce(self.response, {self.rating.id: '4'}, flush=True),
+            {self.single.id: str(blue), self.text.id: "A", self.rating.id: '4'},
+        )
+        self.assertEqual(autosave.take_pending(self.response.pk), {})
+
+    def test_pending_patches_are_written_once_flushed(self):
+        autosave.coalesce(self.response, {self.text.id: "First"})
+        autosave.coalesce(self.response, {self.text.id: "Second"})
+        stats = autosave.flush_pending(self.response.pk)
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(self.stored(), {self.text.id: ("Second", set())})
+        self.assertIsNone(autosave.flush_pending(self.response.pk))
+
+    def test_pending_patches_skip_deleted_questions(self):
+        autosave.coalesce(self.response, {self.text.id: "First"})
+        autosave.coalesce(self.response, {self.text.id: "Second", self.rating.id: '3'})
+        self.text.delete()
+        stats = autosave.flush_pending(self.response.pk)
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(list(self.stored()), [self.rating.id])
+
+    def test_pending_patches_skip_completed_responses(self):
+        autosave.apply_patch(self.response, self.schema(), autosave.coalesce(self.response, {self.text.id: "First"}))
+        autosave.coalesce(self.response, {self.text.id: "Second"})
+        Response.objects.filter(pk=self.response.pk).update(is_complete=True)
+        self.assertIsNone(autosave.flush_pending(self.response.pk))
+        self.assertEqual(self.stored(), {self.text.id: ("First", set())})
+
+    def test_locked_merges_never_take_the_lock_of_another_process(self):
+        autosave.apply_patch(self.response, self.schema(), autosave.coalesce(self.response, {self.text.id: "First"}))
+        autosave.coalesce(self.response, {self.text.id: "Queued"})
+        self.schedule.reset_mock()
+        cache.set(autosave._lock_key(self.response.pk), 'other', 60)
+        with mock.patch.object(autosave, 'LOCK_TIMEOUT', 0.05), self.assertLogs('surveys.autosave', 'WARNING'):
+            self.assertEqual(autosave.coalesce(self.response, {self.rating.id: '2'}), {self.rating.id: '2'})
+            self.assertIsNone(autosave.flush_pending(self.response.pk))
+        self.assertEqual(cache.get(autosave._lock_key(self.response.pk)), 'other')
+        self.schedule.assert_called_once_with(self.response.pk, autosave._window())
+
+        cache.delete(autosave._lock_key(self.response.pk))
+        autosave.flush_pending(self.response.pk)
+        self.assertEqual(self.stored(), {self.text.id: ("Queued", set())})
+
+    def test_rejected_submission_keeps_pending_patches(self):
+        autosave.apply_patch(self.response, self.schema(), autosave.coalesce(self.response, {self.text.id: "First"}))
+        autosave.coalesce(self.response, {self.text.id: "Second"})
+        self.client.force_login(self.user)
+        self.client.post(reverse('surveys:submit_survey', args=[self.survey.pk]), {'response_id': self.response.pk})
+        self.assertEqual(self.stored(), {self.text.id: ("Second", set())})
+        self.assertEqual(autosave.take_pending(self.response.pk), {})
+
+
+def legacy_validate_answer(question, answer_data):
+    """Question.validate_answer as it was before validation was compiled, querying the options"""
+    if question.required and not answer_data:
+        return False, "This question is required"
+    if question.question_type.has_options:
+        if question.question_type.has_multiple_answers:
+            if not isinstance(answer_data, list):
+                return False, "Invalid answer format"
+            valid_options = set(question.options.values_list('id', flat=True))
+            for option_id in answer_data:
+                if option_id not in valid_options:
+                    return False, "Invalid option selected"
+        elif not question.options.filter(id=answer_data).exists():
+            return False, "Invalid option selected"
+    else:
+        if question.validation_regex and not re.match(question.validation_regex, answer_data):
+            return False, question.validation_message or "Answer format is invalid"
+        if question.min_value is not None and float(answer_data) < question.min_value:
+            return False, "Value must be at least {}".format(question.min_value)
+        if question.max_value is not None and float(answer_data) > question.max_value:
+            return False, "Value must be at most {}".format(question.max_value)
+    return True, ""
+
+
+class ValidationTests(SurveyTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.code = cls.add_question(
+            'text', "Postcode", validation_regex=r'^\d{5}$', validation_message="Five digits", required=False,
+        )
+
+    def assertSameVerdict(self, question, value):
+        compiled = self.schema().get(question.id)
+        is_valid, message = compiled.validate_answer(value)
+        self.assertEqual((is_valid, str(message)), legacy_validate_answer(question, value), (question, value))
+
+    def test_compiled_validators_match_the_legacy_rules(self):
+        red = self.option(self.single, 'Red')
+        cat, dog = self.option(self.multiple, 'Cat'), self.option(self.multiple, 'Dog')
+        foreign = self.option(self.multiple, 'Fish')
+        cases = [
+            (self.single, red), (self.single, str(red)), (self.single, foreign), (self.single, ''),
+            (self.single, None),
+            (self.multiple, [cat, dog]), (self.multiple, [cat, red]), (self.multiple, cat), (self.multiple, []),
+            (self.rating, self.option(self.rating, '4')), (self.rating, red),
+            (self.text, "Anything"), (self.text, ''),
+            (self.number, '0'), (self.number, '120'), (self.number, '42.5'), (self.number, '-1'),
+            (self.number, '120.5'),
+            (self.code, '75011'), (self.code, '7501'), (self.code, 'abcde'),
+            (self.date, '2024-02-29'),
+        ]
+        for question, value in cases:
+            with self.subTest(question=question.text, value=value):
+                self.assertSameVerdict(question, value)
+
+    def test_post_reports_every_error_in_one_pass(self):
+        cleaned, errors = validate_post(self.schema(), self.post(
+            single='999', number='abc', date='2024-13-01', code='123', text="Kept",
+        ))
+        self.assertEqual(set(errors), {self.single.id, self.multiple.id, self.number.id, self.date.id, self.code.id})
+        self.assertEqual(str(errors[self.code.id]), "Five digits")
+        self.assertEqual(cleaned[self.text.id], "Kept")
+
+
+class CrossTabTests(SurveyTestCase):
+    def test_table_counts_each_combination_once_per_response(self):
+        ids = {text: self.option(self.single, text) for text in ('Red', 'Green', 'Blue')}
+        ids.update({text: self.option(self.multiple, text) for text in ('Cat', 'Dog', 'Fish')})
+        incidence = np.array([
+            (1, ids['Red']), (1, ids['Cat']), (1, ids['Dog']),
+            (2, ids['Red']), (2, ids['Cat']),
+            (3, ids['Blue']), (3, ids['Fish']),
+            (4, ids['Green']),
+        ])
+        schema = self.schema()
+        table = build_crosstab([schema.get(self.single.id), schema.get(self.multiple.id)], incidence)
+        self.assertEqual(table.table.tolist(), [[2, 1, 0], [0, 0, 0], [0, 0, 1]])
+        self.assertEqual(table.total, 4)
+
+    def test_crosstab_reads_stored_answers(self):
+        red, blue = self.option(self.single, 'Red'), self.option(self.single, 'Blue')
+        cat, dog = self.option(self.multiple, 'Cat'), self.option(self.multiple, 'Dog')
+        self.submit(single=red, multiple=[cat, dog])
+        self.submit(single=red, multiple=[dog])
+        self.submit(single=blue, multiple=[cat])
+        schema = self.schema()
+        table = crosstab([schema.get(self.multiple.id), schema.get(self.single.id)], Response.objects.all())
+        self.assertEqual(table.table.tolist(), [[1, 0, 1], [2, 0, 0], [0, 0, 0]])
+
+    def test_chi_square_of_a_hand_computed_table(self):
+        # Expected counts 12, 18, 28 and 42 under independence
+        table = CrossTab([], np.array([[10, 20], [30, 40]]))
+        statistic = 4 / 12 + 4 / 18 + 4 / 28 + 4 / 42
+        result = table.chi_square()
+        self.assertEqual(result['dof'], 1)
+        self.assertAlmostEqual(result['statistic'], statistic, places=4)
+        # With one degree of freedom, the p-value is erfc(sqrt(statistic / 2))
+        self.assertAlmostEqual(result['p_value'], math.erfc(math.sqrt(statistic / 2)), places=9)
+        self.assertEqual(table.row_percentages().tolist(), [[33.3, 66.7], [42.9, 57.1]])
+        self.assertEqual(table.column_percentages().tolist(), [[25.0, 33.3], [75.0, 66.7]])
+
+    def test_chi_square_ignores_empty_options(self):
+        table = CrossTab([], np.array([[10, 20, 0], [30, 40, 0], [0, 0, 0]]))
+        self.assertEqual(table.chi_square()['dof'], 1)
+        self.assertIsNone(CrossTab([], np.zeros((2, 2), dtype=int)).chi_square())
+
+    def test_chi_square_p_values_of_known_quantiles(self):
+        # 95th percentiles of the chi-square distribution
+        for dof, quantile in ((1, 3.841459), (4, 9.487729), (10, 18.307038)):
+            self.assertAlmostEqual(chi2_sf(quantile, dof), 0.05, places=6)
+
+    def test_questions_cannot_be_crossed_with_themselves(self):
+        question = self.schema().get(self.single.id)
+        with self.assertRaises(ValueError):
+            build_crosstab([question, question], np.zeros((0, 2), dtype=np.int64))
+
+
+class BitmapTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(7)
+        size = 3 * CHUNK_SIZE
+        # Dense and sparse chunks on both sides, and chunks only one side has
+        self.left_rows = np.concatenate([
+            rng.choice(CHUNK_SIZE, 20000, replace=False),
+            rng.choice(CHUNK_SIZE, 300, replace=False) + CHUNK_SIZE,
+        ])
+        self.right_rows = np.concatenate([
+            rng.choice(CHUNK_SIZE, 1000, replace=False),
+            rng.choice(CHUNK_SIZE, 9000, replace=False) + CHUNK_SIZE,
+            rng.choice(CHUNK_SIZE, 50, replace=False) + 2 * CHUNK_SIZE,
+        ])
+        self.size = size
+        self.left, self.right = Bitmap.from_rows(self.left_rows), Bitmap.from_rows(self.right_rows)
+        self.left_set, self.right_set = set(self.left_rows.tolist()), set(self.right_rows.tolist())
+
+    def assertRows(self, bitmap, rows):
+        self.assertEqual(bitmap.to_rows().tolist(), sorted(rows))
+        self.assertEqual(len(bitmap), len(rows))
+
+    def test_containers_follow_the_chunk_density(self):
+        self.assertEqual(self.left.containers[0].dtype, np.uint64)
+        self.assertEqual(self.left.containers[1].dtype, np.uint16)
+        self.assertEqual(self.right.containers[1].dtype, np.uint64)
+        self.assertRows(self.left, self.left_set)
+
+    def test_set_algebra_matches_python_sets(self):
+        self.assertRows(self.left & self.right, self.left_set & self.right_set)
+        self.assertRows(self.left | self.right, self.left_set | self.right_set)
+        self.assertRows(self.left - self.right, self.left_set - self.right_set)
+        self.assertRows(self.right - self.left, self.right_set - self.left_set)
+        self.assertRows(self.left.invert(self.size), set(range(self.size)) - self.left_set)
+
+    def test_results_are_compacted(self):
+        # Two dense chunks whose intersection is sparse come back as offsets
+        evens = Bitmap.from_rows(np.arange(0, CHUNK_SIZE, 2))
+        odds = Bitmap.from_rows(np.append(np.arange(1, CHUNK_SIZE, 2), 10))
+        self.assertEqual((evens & odds).containers[0].tolist(), [10])
+        self.assertFalse(evens - Bitmap.full(CHUNK_SIZE))
+
+    def test_masks_round_trip(self):
+        mask = self.left.to_mask(self.size)
+        self.assertEqual(int(mask.sum()), len(self.left_set))
+        self.assertRows(Bitmap.from_mask(mask), self.left_set)
+        self.assertEqual(Bitmap.full(100).to_rows().tolist(), list(range(100)))
+
+
+class CubeTests(SurveyTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(SURVEY_CUBE_DIR=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.addCleanup(evict_cube, self.survey.pk)
+        self.red, self.blue = self.option(self.single, 'Red'), self.option(self.single, 'Blue')
+        self.cat, self.dog = self.option(self.multiple, 'Cat'), self.option(self.multiple, 'Dog')
+
+    def counts(self, results):
+        return [(result.id, result.answer_count, result.options) for result in results]
+
+    def assertMatchesDatabase(self, cube, schema):
+        expected = aggregate_results(schema, Response.objects.filter(survey=self.survey, is_complete=True))
+        self.assertEqual(
+            self.counts(layout_results(schema, *cube.count_answers(schema, cube.mask()))), self.counts(expected)
+        )
+
+    def test_caught_up_cube_matches_the_database(self):
+        self.submit(single=self.red, multiple=[self.cat, self.dog], text="A")
+        pending, _ = self.submit(complete=False, single=self.blue, multiple=[self.dog])
+        schema = self.schema()
+        cube = build_cube(self.survey, schema)
+        self.assertMatchesDatabase(cube, schema)
+
+        self.submit(single=self.blue, multiple=[self.cat], rating=self.option(self.rating, '4'))
+        pending.is_complete = True
+        pending.save()
+        updated = catch_up(cube, self.survey, schema)
+        self.assertIsNotNone(updated)
+        self.assertEqual(len(updated), 3)
+        self.assertMatchesDatabase(updated, schema)
+        self.assertIs(catch_up(updated, self.survey, schema), updated)
+
+    def test_deleted_responses_force_a_rebuild(self):
+        first, _ = self.submit(single=self.red, multiple=[self.cat])
+        self.submit(single=self.blue, multiple=[self.dog])
+        schema = self.schema()
+        cube = build_cube(self.survey, schema)
+        first.delete()
+        self.assertIsNone(catch_up(cube, self.survey, schema))
+
+    def test_reloaded_cube_is_memory_mapped_with_the_same_counts(self):
+        self.submit(single=self.red, multiple=[self.cat, self.dog], text="A")
+        self.submit(single=self.blue, multiple=[self.dog])
+        schema = self.schema()
+        cube = build_cube(self.survey, schema)
+        save_cube(cube)
+        # A second save replaces the generation instead of adding one
+        save_cube(cube)
+
+        loaded = load_cube(self.survey, schema)
+        self.assertIsInstance(loaded.columns['complete'], np.memmap)
+        self.assertEqual(loaded.watermark, cube.watermark)
+        self.assertEqual(loaded.response_ids(loaded.mask()).tolist(), cube.response_ids(cube.mask()).tolist())
+        self.assertEqual(loaded.count_answers(schema, loaded.mask()), cube.count_answers(schema, cube.mask()))
+        self.assertMatchesDatabase(loaded, schema)
+
+    def test_process_cube_is_reloaded_from_disk_and_caught_up(self):
+        self.submit(single=self.red, multiple=[self.cat])
+        schema = self.schema()
+        get_cube(self.survey, schema)
+        evict_cube(self.survey.pk)
+        self.submit(single=self.blue, multiple=[self.dog])
+
+        with mock.patch('surveys.cube.build_cube') as build:
+            cube = get_cube(self.survey, schema)
+        build.assert_not_called()
+        self.assertEqual(len(cube), 2)
+        self.assertMatchesDatabase(cube, schema)
+
+    def test_schema_change_forces_a_rebuild(self):
+        self.submit(single=self.red, multiple=[self.cat])
+        schema = self.schema()
+        cube = get_cube(self.survey, schema)
+
+        question = self.add_question('text', "Anything else?")
+        changed = self.schema()
+        self.assertNotEqual(changed.version, schema.version)
+        self.assertIsNone(load_cube(self.survey, changed))
+        rebuilt = get_cube(self.survey, changed)
+        self.assertIsNot(rebuilt, cube)
+        self.assertEqual(rebuilt.version, changed.version)
+        self.assertIn(f'answered_{question.id}', rebuilt.columns)
+        self.assertMatchesDatabase(rebuilt, changed)
+        self.assertEqual(load_cube(self.survey, changed).version, changed.version)
+
+
+class TextIndexTests(SurveyTestCase):
+    def answer(self, text, complete=True):
+        """Submit a response answering the text question, returns its text answer"""
+        response, errors = self.submit(
+            complete=complete, single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Cat')],
+            text=text,
+        )
+        self.assertEqual(errors, {})
+        return response.answers.get(question=self.text)
+
+    def terms(self, question):
+        return {
+            term: (is_bigram, answer_count, occurrences)
+            for term, is_bigram, answer_count, occurrences in TextTerm.objects.filter(question=question)
+            .values_list('term', 'is_bigram', 'answer_count', 'occurrences')
+        }
+
+    def postings(self):
+        return sorted(TextPosting.objects.values_list('term__question_id', 'term__term', 'answer_id', 'occurrences'))
+
+    def test_tokenize_folds_and_drops_stop_words(self):
+        self.assertEqual(fold("Élève ÇA"), "eleve ca")
+        self.assertEqual(
+            tokenize("L'équipe est très réactive, le service-client aussi ! 2024 x"),
+            ['equipe', 'reactive', 'service-client', 'aussi'],
+        )
+        self.assertEqual(extract_terms("Great support, great support"), Counter({
+            ('great', False): 2, ('support', False): 2, ('great support', True): 2, ('support great', True): 1,
+        }))
+
+    def test_batches_sharing_terms_add_up(self):
+        first = self.answer("Great support, great price")
+        second = self.answer("Support was slow")
+        self.answer("Slow, never indexed", complete=False)
+        self.assertEqual(self.terms(self.text), {
+            'great': (False, 1, 2),
+            'support': (False, 2, 2),
+            'price': (False, 1, 1),
+            'slow': (False, 1, 1),
+            'great support': (True, 1, 1),
+            'support great': (True, 1, 1),
+            'great price': (True, 1, 1),
+            'support slow': (True, 1, 1),
+        })
+        self.assertEqual(
+            sorted(TextPosting.objects.filter(term__term='support').values_list('answer_id', flat=True)),
+            [first.pk, second.pk],
+        )
+
+    def test_top_terms_rank_by_answers_then_term(self):
+        self.comments = self.add_question('text', "Comments", required=False)
+        self.answer("Great support, great price")
+        self.answer("Support was slow")
+        self.submit(
+            single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Cat')], comments="Price",
+        )
+        # Ties are broken by term, and every question gets its own ranking
+        self.assertEqual(top_terms([self.text.id, self.comments.id], limit=3), {
+            self.text.id: [('support', 2), ('great', 1), ('price', 1)],
+            self.comments.id: [('price', 1)],
+        })
+        self.assertEqual(top_terms([self.text.id], limit=2, bigrams=True), {
+            self.text.id: [('great price', 1), ('great support', 1)],
+        })
+        self.assertEqual(top_terms([self.single.id]), {})
+
+    def test_search_intersects_terms_newest_first(self):
+        first = self.answer("Great support, great price")
+        self.answer("Support was slow")
+        third = self.answer("Great support team")
+        self.assertEqual(search_answers(self.text.id, "support GREAT"), (2, [
+            (third.pk, third.response_id, "Great support team"),
+            (first.pk, first.response_id, "Great support, great price"),
+        ]))
+        self.assertEqual(search_answers(self.text.id, "great support", limit=1, offset=1), (2, [
+            (first.pk, first.response_id, "Great support, great price"),
+        ]))
+        self.assertEqual(search_answers(self.text.id, "support")[0], 3)
+        self.assertEqual(search_answers(self.text.id, "the and"), (0, []))
+        self.assertEqual(search_answers(self.text.id, "great slow"), (0, []))
+
+    def test_rebuild_reproduces_the_incremental_index(self):
+        self.answer("Great support, great price")
+        self.answer("Support was slow")
+        self.answer("Great support team")
+        self.answer("Slow, never indexed", complete=False)
+        terms, postings = self.terms(self.text), self.postings()
+        rebuild_index([self.text.id], batch_size=2)
+        self.assertEqual(self.terms(self.text), terms)
+        self.assertEqual(self.postings(), postings)
+
+
+class ResponseTokenTests(SurveyTestCase):
+    def setUp(self):
+        self.started_at = (timezone.now() - timedelta(hours=1)).replace(microsecond=0)
+        self.token = make_response_token(self.survey, self.started_at)
+        self.url = reverse('surveys:take_survey', args=[self.survey.pk])
+
+    def test_token_round_trip(self):
+        self.assertEqual(read_response_token(self.token, self.survey), self.started_at)
+        other = Survey.objects.create(title="Other", creator=self.user)
+        self.assertIsNone(read_response_token(self.token, other))
+        self.assertIsNone(read_response_token(self.token[:-2] + 'xx', self.survey))
+        self.assertIsNone(read_response_token('', self.survey))
+
+    @override_settings(SURVEY_RESPONSE_TOKEN_MAX_AGE=-1)
+    def test_expired_token_is_ignored(self):
+        self.assertIsNone(read_response_token(self.token, self.survey))
+
+    def test_showing_the_survey_creates_no_response(self):
+        page = self.client.get(self.url)
+        self.assertEqual(page.status_code, 200)
+        self.assertFalse(Response.objects.exists())
+        self.assertIsNotNone(read_response_token(page.context['response_token'], self.survey))
+
+    def test_first_save_creates_the_response_with_the_token_start(self):
+        Survey.objects.filter(pk=self.survey.pk).update(allow_save_and_continue=True)
+        self.client.force_login(self.user)
+        url = reverse('surveys:autosave_progress', args=[self.survey.pk])
+        saved = self.client.post(url, json.dumps({
+            'response_token': self.token, 'answers': {str(self.text.id): "Draft"}, 'flush': True,
+        }), content_type='application/json').json()
+        response = Response.objects.get()
+        self.assertEqual(saved['response_id'], response.pk)
+        self.assertEqual(response.created_at, self.started_at)
+        self.assertFalse(response.is_complete)
+
+        self.client.post(url, json.dumps({
+            'response_id': response.pk, 'answers': {str(self.text.id): "Final"}, 'flush': True,
+        }), content_type='application/json')
+        self.assertEqual(Response.objects.count(), 1)
+        self.assertEqual(response.answers.get().data, "Final")
+
+    def test_submit_creates_the_complete_response_with_the_token_start(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(self.url, {
+                'response_token': self.token,
+                f'question_{self.single.id}': self.option(self.single, 'Red'),
+                f'question_{self.multiple.id}': self.option(self.multiple, 'Cat'),
+            })
+        response = Response.objects.get()
+        self.assertTrue(response.is_complete)
+        self.assertEqual(response.created_at, self.started_at)
+        rollup = ResponseRollup.objects.get(bucket=ResponseRollup.bucket_for(self.started_at))
+        self.assertEqual(rollup.started, 1)
+
+
+class CleanupResponsesTests(SurveyTestCase):
+    def setUp(self):
+        self.first_hour = ResponseRollup.bucket_for(timezone.now() - timedelta(days=30))
+        self.second_hour = self.first_hour + timedelta(hours=1)
+
+    def started(self, bucket, count):
+        """Incomplete responses without answers, started in an hour and counted in its rollup"""
+        responses = [Response.objects.create(survey=self.survey) for _ in range(count)]
+        for minute, response in enumerate(responses):
+            # created_at is set on insert
+            Response.objects.filter(pk=response.pk).update(created_at=bucket + timedelta(minutes=minute))
+        ResponseRollup.add(self.survey.pk, bucket, started=count)
+        return responses
+
+    def cleanup(self, **options):
+        Response.objects.filter(created_at__lt=timezone.now() - timedelta(days=8)).update(
+            updated_at=timezone.now() - timedelta(days=8)
+        )
+        stdout = io.StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('cleanup_responses', stdout=stdout, **options)
+        deletes = [query for query in queries if query['sql'].startswith(f'DELETE FROM {Response._meta.db_table}')]
+        return stdout.getvalue(), len(deletes)
+
+    def rollups(self):
+        return dict(ResponseRollup.objects.values_list('bucket', 'started'))
+
+    def test_abandoned_responses_are_deleted_in_batches(self):
+        self.started(self.first_hour, 3)
+        self.started(self.second_hour, 2)
+        output, batches = self.cleanup(batch_size=2)
+        self.assertIn("Deleted 5 abandoned responses", output)
+        self.assertEqual(batches, 3)
+        self.assertFalse(Response.objects.exists())
+
+    def test_started_rollups_lose_the_deleted_responses(self):
+        self.started(self.first_hour, 3)
+        self.started(self.second_hour, 2)
+        # Kept: recent, partially answered, and complete responses
+        recent = self.started(ResponseRollup.bucket_for(timezone.now()), 1)
+        partial, _ = self.submit(
+            complete=False, single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Cat')],
+        )
+        Response.objects.filter(pk=partial.pk).update(created_at=self.first_hour)
+        ResponseRollup.add(self.survey.pk, self.first_hour, started=1)
+        completed = self.started(self.second_hour, 1)[0]
+        Response.objects.filter(pk=completed.pk).update(is_complete=True)
+        rollups = self.rollups()
+
+        self.cleanup(batch_size=2)
+        self.assertEqual(set(Response.objects.values_list('pk', flat=True)), {recent[0].pk, partial.pk, completed.pk})
+        self.assertEqual(self.rollups(), {**rollups, self.first_hour: 1, self.second_hour: 1})
+
+        self.cleanup(include_partial=True)
+        self.assertFalse(Response.objects.filter(pk=partial.pk).exists())
+        self.assertEqual(self.rollups()[self.first_hour], 0)
+
+
+class SegmentTests(SurveyTestCase):
+    def assertInvalid(self, text):
+        with self.assertRaises(SegmentError):
+            parse_segment(text, self.schema())
+
+    def test_invalid_segments_are_rejected(self):
+        self.assertInvalid('{"option": ')
+        self.assertInvalid('{"option": 999999}')
+        self.assertInvalid(json.dumps({'option': True}))
+        self.assertInvalid(json.dumps({'answered': 999999}))
+        self.assertInvalid(json.dumps({'and': []}))
+        self.assertInvalid(json.dumps({'or': {'complete': True}}))
+        self.assertInvalid(json.dumps({'complete': 'yes'}))
+        self.assertInvalid(json.dumps({'respondent': 'robot'}))
+        self.assertInvalid(json.dumps({'created': {'from': '2026-13-01'}}))
+        self.assertInvalid(json.dumps({'created': {'since': '2026-01-01'}}))
+        self.assertInvalid(json.dumps({'option': 1, 'complete': True}))
+        self.assertInvalid(json.dumps({'nearby': 1}))
+        self.assertIsNone(parse_segment('', self.schema()))
+
+    @override_settings(SURVEY_SEGMENT_MAX_TERMS=4)
+    def test_segments_are_bounded(self):
+        term = {'complete': True}
+        parse_segment(json.dumps({'and': [term, term, term]}), self.schema())
+        self.assertInvalid(json.dumps({'and': [term, term, term, term]}))
+
+    def test_segment_selects_the_matching_responses(self):
+        red, blue = self.option(self.single, 'Red'), self.option(self.single, 'Blue')
+        cat, dog = self.option(self.multiple, 'Cat'), self.option(self.multiple, 'Dog')
+        first, _ = self.submit(single=red, multiple=[cat, dog], text="A")
+        second, _ = self.submit(single=red, multiple=[dog])
+        third, _ = self.submit(single=blue, multiple=[cat], text="C")
+        schema = self.schema()
+        cube = build_cube(self.survey, schema)
+        segment = parse_segment(json.dumps({'and': [
+            {'or': [{'option': red}, {'option': cat}]},
+            {'not': {'answered': self.text.id}},
+        ]}), schema)
+        self.assertEqual(cube.response_ids(segment.mask(cube, schema)).tolist(), [second.pk])
+        segment = parse_segment(json.dumps({'and': [{'option': cat}, {'complete': True}]}), schema)
+        self.assertEqual(cube.response_ids(segment.mask(cube, schema)).tolist(), [first.pk, third.pk])
+
+
+class NumericSketchTests(SimpleTestCase):
+    def setUp(self):
+        rng = np.random.default_rng(3)
+        self.values = rng.lognormal(3, 1, 100000)
+        # Streamed in small batches into two sketches, then merged
+        self.sketch, other = NumericSketch(edges=[0, 25, 50, 100, 200]), NumericSketch(edges=[0, 25, 50, 100, 200])
+        for chunk in np.array_split(self.values[:50000], 50):
+            self.sketch.add(chunk)
+        for chunk in np.array_split(self.values[50000:], 50):
+            other.add(chunk)
+        self.sketch.merge(other)
+
+    def test_moments_are_exact(self):
+        self.assertEqual(self.sketch.count, len(self.values))
+        self.assertAlmostEqual(self.sketch.mean, self.values.mean(), places=6)
+        self.assertAlmostEqual(self.sketch.std, self.values.std(), places=4)
+        self.assertEqual((self.sketch.minimum, self.sketch.maximum), (self.values.min(), self.values.max()))
+        counts, _ = np.histogram(self.values[self.values <= 200], bins=[0, 25, 50, 100, 200])
+        self.assertEqual(self.sketch.histogram, counts.tolist())
+
+    def test_quantile_rank_error(self):
+        ordered = np.sort(self.values)
+        for q in (0.001, 0.01, 0.1, 0.5, 0.9, 0.99, 0.999):
+            rank = np.searchsorted(ordered, self.sketch.quantile(q)) / len(ordered)
+            self.assertLess(abs(rank - q), 0.005, q)
+        self.assertLessEqual(len(self.sketch.means), 100)
+
+    def test_round_trip(self):
+        copy = NumericSketch.from_dict(json.loads(json.dumps(self.sketch.to_dict())))
+        self.assertEqual(copy.summary(), self.sketch.summary())
+
+    def test_merging_other_bins_drops_the_histogram(self):
+        other = NumericSketch(edges=[0, 10])
+        other.add([1, 2])
+        self.sketch.merge(other)
+        self.assertIsNone(self.sketch.summary()['histogram'])
+        self.assertIsNone(NumericSketch().summary())
+
+
+class SketchStorageTests(SurveyTestCase):
+    def test_completed_responses_are_folded_into_the_day_sketches(self):
+        required = {'single': self.option(self.single, 'Red'), 'multiple': [self.option(self.multiple, 'Cat')]}
+        for rating, number in (('2', '30'), ('4', '40'), ('5', '')):
+            answers = dict(required, rating=self.option(self.rating, rating))
+            if number:
+                answers['number'] = number
+            self.submit(**answers)
+        self.submit(complete=False, rating=self.option(self.rating, '1'), **required)
+        sketches = merged_sketches(self.survey.pk)
+        self.assertEqual(sketches[self.rating.id].count, 3)
+        self.assertAlmostEqual(sketches[self.rating.id].mean, 11 / 3)
+        self.assertEqual((sketches[self.number.id].minimum, sketches[self.number.id].maximum), (30, 40))
+        self.assertEqual(merged_sketches(self.survey.pk, end=timezone.now() - timedelta(days=1)), {})
+
+
+class CardinalitySketchTests(SimpleTestCase):
+    def test_distinct_counts_within_three_standard_errors(self):
+        for count in (100, 1000, 50000, 200000):
+            with self.subTest(count=count):
+                sketch = HyperLogLog()
+                sketch.add(f"10.0.{i}" for i in range(count))
+                sketch.add(f"10.0.{i}" for i in range(count // 2))
+                self.assertLessEqual(abs(sketch.estimate() - count), 3 * sketch.relative_error * count)
+
+    def test_merged_distinct_counts_are_the_union(self):
+        left, right = HyperLogLog(), HyperLogLog()
+        left.add(str(i) for i in range(30000))
+        right.add(str(i) for i in range(20000, 50000))
+        left.merge(HyperLogLog.from_text(right.to_text()))
+        summary = left.summary()
+        self.assertLessEqual(abs(summary['estimate'] - 50000), summary['error'])
+
+    def test_frequent_value_counts_stay_within_the_error_bound(self):
+        rng = np.random.default_rng(5)
+        stream = Counter(f"value {n}" for n in rng.zipf(1.3, 100000) if n < 100000)
+        sketch = FrequentValues()
+        halves = list(stream.items())
+        sketch.add(Counter(dict(halves[::2])))
+        other = FrequentValues()
+        other.add(Counter(dict(halves[1::2])))
+        sketch.merge(FrequentValues.from_dict(json.loads(json.dumps(other.to_dict()))))
+
+        self.assertEqual(sketch.total, sum(stream.values()))
+        values = list(stream)
+        for value, estimate in zip(values, sketch.estimate(values)):
+            self.assertGreaterEqual(estimate, stream[value])
+            self.assertLessEqual(estimate - stream[value], sketch.error)
+        top = [value for value, count in sketch.summary(limit=5)['top']]
+        self.assertEqual(top, [value for value, count in stream.most_common(5)])
+
+
+@override_settings(SURVEY_AGGREGATE_FLUSH_INTERVAL=60)
+class AggregateBufferTests(SurveyTestCase):
+    def setUp(self):
+        # A buffer of the test alone, whose thread never flushes by itself
+        for patcher in (
+            mock.patch.object(aggregates, '_buffer', aggregates.AggregateBuffer()),
+            mock.patch.object(aggregates.AggregateBuffer, '_run'),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_deltas_are_applied_once_per_key(self):
+        calls = []
+
+        def apply(*args):
+            calls.append(args)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for survey_id in (1, 2, 1, 1):
+                aggregates.record(apply, (survey_id,), [survey_id * 10])
+            aggregates.record(apply, (3,), [])
+        self.assertEqual(len(aggregates._buffer), 4)
+        self.assertEqual(calls, [])
+        aggregates.flush()
+        self.assertEqual(sorted(calls), [(1, [10, 10, 10]), (2, [20])])
+        self.assertEqual(len(aggregates._buffer), 0)
+
+    def test_statistics_are_updated_on_flush(self):
+        answers = {'single': self.option(self.single, 'Red'), 'multiple': [self.option(self.multiple, 'Cat')]}
+        for _ in range(3):
+            self.submit(**answers)
+        self.assertEqual(SurveyStatistics.objects.get(survey=self.survey).complete_responses, 0)
+        aggregates.flush()
+        stats = SurveyStatistics.objects.get(survey=self.survey)
+        self.assertEqual((stats.total_responses, stats.complete_responses), (3, 3))
+        expected = stats.compute()
+        self.assertEqual((expected['total_responses'], expected['complete_responses']), (3, 3))
+
+    def test_failing_deltas_do_not_block_the_others(self):
+        calls = []
+
+        def fail(*args):
+            raise RuntimeError("lost")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            aggregates.record(fail, (1,), [1])
+            aggregates.record(lambda *args: calls.append(args), (2,), [2])
+        with self.assertLogs('surveys.aggregates', 'ERROR'):
+            aggregates.flush()
+        self.assertEqual(calls, [(2, [2])])
+
+
+class ExportTestCase(SurveyTestCase):
+    """Three complete responses, the first answering every question"""
+
+    def setUp(self):
+        cache.clear()
+        self.responses = [
+            self.submit(
+                single=self.option(self.single, 'Green'),
+                multiple=[self.option(self.multiple, 'Fish'), self.option(self.multiple, 'Cat')],
+                rating=self.option(self.rating, '4'), text='Hello, "world"', number='42', date='2026-02-28',
+            )[0],
+            self.submit(single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Dog')])[0],
+            self.submit(single=self.option(self.single, 'Blue'), multiple=[self.option(self.multiple, 'Cat')])[0],
+        ]
+
+
+class CsvExportTests(ExportTestCase):
+    def export(self):
+        response = export_survey_to_csv(self.survey, Response.objects.filter(survey=self.survey).order_by('-id'))
+        return list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+
+    @override_settings(SURVEY_EXPORT_CHUNK_SIZE=2)
+    def test_rows_follow_the_header_in_id_order(self):
+        rows = self.export()
+        self.assertEqual(rows[0], ['Respondent ID', 'Date', "Colour", "Pets", "Score", "Comment", "Age", "Birthday"])
+        self.assertEqual([int(row[0]) for row in rows[1:]], [response.pk for response in self.responses])
+        self.assertEqual(rows[1][2:], ['Green', 'Cat, Fish', '4', 'Hello, "world"', '42', '2026-02-28'])
+        self.assertEqual(rows[2][2:], ['Red', 'Dog', '', '', '', ''])
+        created_at = Response.objects.get(pk=self.responses[0].pk).created_at
+        self.assertEqual(rows[1][1], created_at.strftime('%Y-%m-%d %H:%M:%S'))
+
+    @override_settings(SURVEY_EXPORT_CHUNK_SIZE=2)
+    def test_each_chunk_costs_two_queries(self):
+        get_survey_schema(self.survey)
+        response = export_survey_to_csv(self.survey, Response.objects.filter(survey=self.survey))
+        with self.assertNumQueries(4):
+            content = b''.join(response.streaming_content)
+        self.assertEqual(len(content.splitlines()), 4)
+
+
+@skipUnless(parquet_available(), "pyarrow is not installed")
+class ParquetExportTests(ExportTestCase):
+    def export(self, **kwargs):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'export.parquet')
+        write_parquet(path, get_survey_schema(self.survey), Response.objects.filter(survey=self.survey), **kwargs)
+        return pq.ParquetFile(path)
+
+    def test_columns_are_typed(self):
+        table = self.export().read()
+        types = {field.name: field.type for field in table.schema}
+        self.assertEqual(types['response_id'], pa.int64())
+        self.assertEqual(types['created_at'], pa.timestamp('us', tz='UTC'))
+        self.assertEqual(types['completion_time'], pa.duration('us'))
+        self.assertEqual(types["Colour"], pa.dictionary(pa.int32(), pa.string()))
+        self.assertEqual(types["Pets"], pa.list_(pa.string()))
+        self.assertEqual(types["Score"], pa.dictionary(pa.int32(), pa.string()))
+        self.assertEqual(types["Comment"], pa.string())
+        self.assertEqual(types["Age"], pa.float64())
+        self.assertEqual(types["Birthday"], pa.date32())
+        self.assertEqual(table.schema.field("Pets").metadata, {b'question_id': str(self.multiple.id).encode()})
+
+    def test_values_match_the_answers(self):
+        rows = self.export().read().to_pylist()
+        self.assertEqual([row['response_id'] for row in rows], [response.pk for response in self.responses])
+        first, second = rows[0], rows[1]
+        self.assertEqual(
+            [first[name] for name in ("Colour", "Pets", "Score", "Comment", "Age", "Birthday")],
+            ['Green', ['Cat', 'Fish'], '4', 'Hello, "world"', 42.0, date(2026, 2, 28)],
+        )
+        self.assertEqual(
+            [second[name] for name in ("Colour", "Pets", "Score", "Comment", "Age", "Birthday")],
+            ['Red', ['Dog'], None, None, None, None],
+        )
+        self.assertEqual(first['created_at'], Response.objects.get(pk=self.responses[0].pk).created_at)
+
+    @override_settings(SURVEY_EXPORT_CHUNK_SIZE=1, SURVEY_EXPORT_ROW_GROUP_SIZE=2)
+    def test_responses_are_written_in_row_groups(self):
+        progress = []
+        parquet_file = self.export(progress=lambda written, total: progress.append((written, total)))
+        self.assertEqual(parquet_file.metadata.num_row_groups, 2)
+        self.assertEqual(progress, [(2, 3), (3, 3)])
+
+    def test_duplicate_question_texts_get_their_id(self):
+        duplicate = self.add_question('text', "Comment", required=False)
+        names = self.export().schema_arrow.names
+        self.assertNotIn("Comment", names)
+        self.assertIn(f"Comment ({self.text.id})", names)
+        self.assertIn(f"Comment ({duplicate.id})", names)
+
+
+class FeedTests(SurveyTestCase):
+    def setUp(self):
+        answers = {'single': self.option(self.single, 'Red'), 'multiple': [self.option(self.multiple, 'Cat')]}
+        self.responses = [self.submit(**answers)[0] for _ in range(3)]
+        self.submit(complete=False, **answers)
+        # Settled a minute apart, an hour ago
+        self.base = timezone.now() - timedelta(hours=1)
+        for minutes, response in enumerate(self.responses):
+            Response.objects.filter(pk=response.pk).update(updated_at=self.base + timedelta(minutes=minutes))
+
+    def ids(self, lines):
+        return [json.loads(line)['id'] for line in lines.splitlines()]
+
+    def test_cursor_round_trip(self):
+        moment = timezone.now().replace(microsecond=123456)
+        self.assertEqual(feed.decode_cursor(feed.encode_cursor(moment, 42)), (moment, 42))
+        for cursor in ('', 'abc', '12-x', '1-2-3', '99999999999999999999-1', None):
+            with self.subTest(cursor=cursor), self.assertRaises(feed.CursorError):
+                feed.decode_cursor(cursor)
+
+    def test_pages_resume_after_their_cursor(self):
+        lines, cursor, has_more = feed.feed_page(self.survey.pk, limit=2)
+        self.assertEqual(self.ids(lines), [response.pk for response in self.responses[:2]])
+        self.assertTrue(has_more)
+        lines, cursor, has_more = feed.feed_page(self.survey.pk, since=cursor, limit=2)
+        self.assertEqual(self.ids(lines), [self.responses[2].pk])
+        self.assertFalse(has_more)
+        self.assertEqual(feed.feed_page(self.survey.pk, since=cursor), ('', cursor, False))
+
+        # A response changed since it was served comes back
+        Response.objects.filter(pk=self.responses[0].pk).update(updated_at=self.base + timedelta(minutes=10))
+        lines, cursor, has_more = feed.feed_page(self.survey.pk, since=cursor)
+        self.assertEqual(self.ids(lines), [self.responses[0].pk])
+
+    def test_responses_sharing_a_timestamp_are_paged_by_id(self):
+        Response.objects.filter(pk__in=[response.pk for response in self.responses]).update(updated_at=self.base)
+        served = []
+        cursor, has_more = None, True
+        while has_more:
+            lines, cursor, has_more = feed.feed_page(self.survey.pk, since=cursor, limit=1)
+            served.extend(self.ids(lines))
+        self.assertEqual(served, [response.pk for response in self.responses])
+
+    @override_settings(SURVEY_FEED_SETTLE_SECONDS=120)
+    def test_recent_updates_are_held_back_until_settled(self):
+        Response.objects.filter(pk=self.responses[1].pk).update(updated_at=timezone.now() - timedelta(seconds=30))
+        lines, cursor, has_more = feed.feed_page(self.survey.pk)
+        self.assertEqual(self.ids(lines), [self.responses[0].pk, self.responses[2].pk])
+        Response.objects.filter(pk=self.responses[1].pk).update(updated_at=timezone.now() - timedelta(seconds=150))
+        lines, cursor, has_more = feed.feed_page(self.survey.pk, since=cursor)
+        self.assertEqual(self.ids(lines), [self.responses[1].pk])
+
+    def test_lines_carry_the_answers(self):
+        line = json.loads(feed.feed_page(self.survey.pk, limit=1)[0])
+        self.assertEqual(line['survey_id'], self.survey.pk)
+        self.assertEqual(
+            [(answer['question_id'], answer['option_ids']) for answer in line['answers']],
+            [
+                (self.single.id, [self.option(self.single, 'Red')]),
+                (self.multiple.id, [self.option(self.multiple, 'Cat')]),
+            ],
+        )
+
+    def test_view_returns_the_next_cursor(self):
+        self.client.force_login(self.user)
+        url = reverse('surveys:feed', args=[self.survey.pk])
+        response = self.client.get(url, {'limit': 2})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(response['X-Feed-More'], 'true')
+        response = self.client.get(url, {'since': response['X-Feed-Cursor']})
+        self.assertEqual(self.ids(response.content.decode()), [self.responses[2].pk])
+        self.assertEqual(response['X-Feed-More'], 'false')
+        self.assertEqual(self.client.get(url, {'since': 'nope'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'since': '99999999999999999999-1'}).status_code, 400)
+
+
+class ExportCacheTests(ExportTestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings_override = override_settings(SURVEY_EXPORT_DIR=self.directory)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client.force_login(self.user)
+        self.url = reverse('surveys:export_csv', args=[self.survey.pk])
+
+    def download(self, **headers):
+        response = self.client.get(self.url, headers=headers)
+        content = b''.join(response.streaming_content) if response.streaming else response.content
+        return response, content
+
+    def test_unchanged_responses_are_served_from_the_cache(self):
+        generated, content = self.download()
+        self.assertNotIsInstance(generated, FileResponse)
+        self.assertEqual(len(os.listdir(self.directory)), 1)
+
+        cached, cached_content = self.download()
+        self.assertIsInstance(cached, FileResponse)
+        self.assertEqual(cached_content, content)
+        self.assertEqual(cached['ETag'], generated['ETag'])
+        self.assertEqual(int(cached['Content-Length']), len(content))
+
+        not_modified, _ = self.download(if_none_match=cached['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+
+    def test_completed_responses_change_the_key(self):
+        first, _ = self.download()
+        self.submit(single=self.option(self.single, 'Red'), multiple=[self.option(self.multiple, 'Cat')])
+        second, content = self.download()
+        self.assertNotIsInstance(second, FileResponse)
+        self.assertNotEqual(second['ETag'], first['ETag'])
+        self.assertEqual(len(content.decode().splitlines()), 5)
+
+    def test_interrupted_downloads_are_not_cached(self):
+        path = export_cache.cache_path('interrupted', 'csv')
+        stream = export_cache.tee(iter(['a,b\n', 'c,d\n']), path)
+        next(stream)
+        stream.close()
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertIsNone(export_cache.lookup(path))
+
+    @override_settings(SURVEY_EXPORT_CACHE_BYTES=250)
+    def test_least_recently_used_files_are_evicted(self):
+        paths = []
+        for age, name in enumerate(('old', 'middle', 'new')):
+            path = export_cache.cache_path(name, 'csv')
+            with open(path, 'wb') as handle:
+                handle.write(b'x' * 100)
+            os.utime(path, (1000 + age, 1000 + age))
+            paths.append(path)
+        # Serving the oldest file makes it the most recently used
+        export_cache.lookup(paths[0]).close()
+        abandoned = export_cache.partial_path(export_cache.cache_path('abandoned', 'csv'))
+        open(abandoned, 'wb').close()
+        os.utime(abandoned, (1000, 1000))
+
+        export_cache.evict()
+        self.assertEqual(sorted(os.listdir(self.directory)), ['new.csv', 'old.csv'])
+
+
+class ImmediateExecutor:
+    """Stands for the export pool, running each job as soon as it is submitted"""
+
+    def submit(self, function, *args):
+        function(*args)
+
+
+class ExportJobTests(ExportTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(SURVEY_EXPORT_DIR=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # Jobs run in the test's thread and transaction
+        for patcher in (
+            mock.patch.object(export_jobs, 'close_old_connections'),
+            mock.patch.object(export_jobs, '_get_executor', return_value=ImmediateExecutor()),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client.force_login(self.user)
+
+    def start(self, writer):
+        return export_jobs.start_export(
+            self.survey, get_survey_schema(self.survey), 'xlsx',
+            self.survey.responses.filter(is_complete=True), {}, writer,
+        )
+
+    def status(self, job):
+        return self.client.get(reverse('surveys:export_status', kwargs={'job_id': job['id']}))
+
+    def download(self, job):
+        return self.client.get(reverse('surveys:export_download', kwargs={'job_id': job['id']}))
+
+    @staticmethod
+    def write(path, schema, responses, progress):
+        progress(0, 2)
+        with open(path, 'wb') as stream:
+            stream.write(b'export')
+        progress(2, 2)
+
+    @staticmethod
+    def broken(path, schema, responses, progress):
+        raise ValueError("broken writer")
+
+    def test_identical_requests_share_a_job(self):
+        url = reverse('surveys:export_excel', args=[self.survey.pk])
+        with mock.patch.object(export_jobs, '_get_executor') as executor:
+            first = self.client.get(url, headers={'accept': 'application/json'})
+            second = self.client.get(url, headers={'accept': 'application/json'})
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(first.json()['id'], second.json()['id'])
+        self.assertEqual(second.json()['status'], export_jobs.QUEUED)
+        self.assertEqual(executor.return_value.submit.call_count, 1)
+
+    def test_status_reports_progress_then_download(self):
+        seen = []
+        job_id = uuid.UUID(int=1).hex
+
+        def write(path, schema, responses, progress):
+            progress(1, 3)
+            seen.append(self.status({'id': job_id}).json())
+            self.write(path, schema, responses, progress)
+
+        with mock.patch.object(export_jobs.uuid, 'uuid4', return_value=uuid.UUID(int=1)):
+            job = self.start(write)
+        self.assertEqual(job['id'], job_id)
+        self.assertEqual(
+            [(state['status'], state['done'], state['total']) for state in seen], [(export_jobs.RUNNING, 1, 3)]
+        )
+        self.assertNotIn('download_url', seen[0])
+
+        state = self.status(job).json()
+        self.assertEqual((state['status'], state['done'], state['total'], state['size']), (export_jobs.DONE, 2, 2, 6))
+        response = self.client.get(state['download_url'])
+        self.assertEqual(b''.join(response.streaming_content), b'export')
+
+        # Once written, an identical request is done from the start
+        self.assertEqual(self.start(self.broken)['status'], export_jobs.DONE)
+
+    def test_failed_and_stale_jobs_are_replaced(self):
+        with self.assertLogs('surveys.export_jobs', 'ERROR'):
+            failed = self.start(self.broken)
+        self.assertEqual(self.status(failed).json()['status'], export_jobs.FAILED)
+        self.assertEqual(os.listdir(export_cache.directory()), [])
+
+        with mock.patch.object(export_jobs, '_get_executor'):
+            stale = self.start(self.write)
+        self.assertNotEqual(stale['id'], failed['id'])
+        self.assertEqual(stale['status'], export_jobs.QUEUED)
+        with override_settings(SURVEY_EXPORT_STALE_SECONDS=-1):
+            self.assertEqual(self.status(stale).json()['status'], export_jobs.FAILED)
+            replacement = self.start(self.write)
+        self.assertNotIn(replacement['id'], (failed['id'], stale['id']))
+        self.assertEqual(self.status(replacement).json()['status'], export_jobs.DONE)
+
+    def test_jobs_are_hidden_from_users_without_results_access(self):
+        job = self.start(self.write)
+        self.client.force_login(User.objects.create_user('outsider', password='secret'))
+        self.assertEqual(self.status(job).status_code, 404)
+        self.assertEqual(self.download(job).status_code, 404)
+
+    def test_done_job_whose_file_was_evicted_is_not_found(self):
+        job = self.start(self.write)
+        os.remove(export_jobs.job_path(job))
+        self.assertEqual(self.status(job).json()['status'], export_jobs.DONE)
+        self.assertEqual(self.download(job).status_code, 404)
+
+        # The next identical request writes the file again
+        replacement = self.start(self.write)
+        self.assertNotEqual(replacement['id'], job['id'])
+        self.assertEqual(self.download(replacement).status_code, 200)
+
+
+class OneQuestionPerPageTests(SurveyTestCase):
+    def setUp(self):
+        Survey.objects.filter(pk=self.survey.pk).update(one_question_per_page=True)
+        self.client.force_login(self.user)
+        self.url = reverse('surveys:take_survey', args=[self.survey.pk])
+
+    def step(self, name, value, index):
+        question = getattr(self, name)
+        return self.client.post(self.url, {
+            'question_id': question.id, f'question_{question.id}': value, 'current_index': index,
+        })
+
+    def test_invalid_answers_stay_on_their_question(self):
+        response = self.step('number', '500', 4)
+        self.assertRedirects(response, f'{self.url}?question=4', fetch_redirect_response=False)
+        self.assertFalse(Answer.objects.exists())
+
+    def test_required_questions_are_checked_before_completing(self):
+        self.step('single', self.option(self.single, 'Red'), 0)
+        response = self.step('date', '2026-01-01', 5)
+        self.assertRedirects(response, f'{self.url}?question=1', fetch_redirect_response=False)
+        self.assertFalse(Response.objects.get().is_complete)
+
+        self.step('multiple', self.option(self.multiple, 'Cat'), 1)
+        self.step('date', '2026-01-01', 5)
+        response = Response.objects.get()
+        self.assertTrue(response.is_complete)
+        self.assertEqual(response.answers.count(), 3)
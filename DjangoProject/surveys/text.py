@@ -0,0 +1,199 @@
+"""
+Text analytics of free-text answers.
+
+When a response completes, its answers to text and textarea questions are
+tokenized in batches once the writing transaction commits (see
+aggregates.py): words folded to lower case
+without accents (as MySQL's default collation compares them), minus stop
+words, and the bigrams of consecutive words. Each batch updates the
+per-question frequency table (TextTerm) with one bulk insert and one
+update, and adds the answers to the inverted index (TextPosting). Top terms
+are then read from the frequency table, and keyword drill-down intersects
+postings, without rescanning the answers.
+"""
+
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+from django.db import transaction
+from django.db.models import Case, Count, F, Value, When, Window
+from django.db.models.functions import RowNumber
+
+from . import aggregates
+from .models import Answer, TextPosting, TextTerm
+
+TEXT_TYPES = ('text', 'textarea')
+
+TERM_MAX_LENGTH = 100
+
+
+def fold(text):
+    """Lower-case a text and strip its accents"""
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(character for character in text if not unicodedata.combining(character))
+
+
+STOP_WORDS = frozenset(fold("""
+a an and are as at be but by for from has have i in is it its me my no not of on or our so that the
+their them they this to was we were what when which who will with you your
+au aux avec ce ces dans de des du elle en et eux il ils je la le les leur lui ma mais me mes moi mon
+ne nos notre nous on ou par pas pour qu que qui sa se ses son sur ta te tes toi ton tu un une vos
+votre vous c d j l à m n s t y été est sont ai as avons avez ont très plus
+""").split())
+
+# Words, hyphenated ones kept whole; apostrophes split elisions (l'équipe -> équipe)
+_WORD = re.compile(r"[^\W\d_]+(?:-[^\W\d_]+)*")
+
+
+def tokenize(text):
+    """Folded words of a text, stop words and single letters left out"""
+    return [
+        word for word in _WORD.findall(fold(text))
+        if len(word) > 1 and word not in STOP_WORDS and len(word) <= TERM_MAX_LENGTH
+    ]
+
+
+def extract_terms(text):
+    """Count the terms and the bigrams of a text; returns a Counter of (term, is_bigram)"""
+    words = tokenize(text)
+    terms = Counter((word, False) for word in words)
+    terms.update(
+        (bigram, True) for bigram in (f"{first} {second}" for first, second in zip(words, words[1:]))
+        if len(bigram) <= TERM_MAX_LENGTH
+    )
+    return terms
+
+
+def index_answers(answers):
+    """
+    Add text answers to the frequency tables and the inverted index.
+
+    answers is an iterable of (answer_id, question_id, text). Answers must
+    not be indexed already.
+    """
+    postings = []
+    totals = defaultdict(lambda: [0, 0])
+    for answer_id, question_id, text in answers:
+        for (term, is_bigram), occurrences in extract_terms(text or '').items():
+            postings.append((question_id, term, answer_id, occurrences))
+            entry = totals[(question_id, term, is_bigram)]
+            entry[0] += 1
+            entry[1] += occurrences
+    if not postings:
+        return
+
+    with transaction.atomic():
+        TextTerm.objects.bulk_create(
+            [TextTerm(question_id=question_id, term=term, is_bigram=is_bigram) for question_id, term, is_bigram in totals],
+            ignore_conflicts=True,
+        )
+        term_ids = {
+            (question_id, term): term_id
+            for question_id, term, term_id in TextTerm.objects.filter(
+                question_id__in={question_id for question_id, _, _ in totals},
+                term__in={term for _, term, _ in totals},
+            ).values_list('question_id', 'term', 'id')
+        }
+        # Increment every term with one statement, in primary key order to avoid deadlocks
+        increments = sorted(
+            (term_ids[(question_id, term)], answer_count, occurrences)
+            for (question_id, term, _), (answer_count, occurrences) in totals.items()
+            if (question_id, term) in term_ids
+        )
+        for start in range(0, len(increments), 500):
+            batch = increments[start:start + 500]
+            TextTerm.objects.filter(pk__in=[term_id for term_id, _, _ in batch]).update(
+                answer_count=F('answer_count') + Case(
+                    *[When(pk=term_id, then=Value(count)) for term_id, count, _ in batch], default=Value(0)
+                ),
+                occurrences=F('occurrences') + Case(
+                    *[When(pk=term_id, then=Value(count)) for term_id, _, count in batch], default=Value(0)
+                ),
+            )
+        TextPosting.objects.bulk_create(
+            [
+                TextPosting(term_id=term_ids[(question_id, term)], answer_id=answer_id, occurrences=min(occurrences, 32767))
+                for question_id, term, answer_id, occurrences in postings
+                if (question_id, term) in term_ids
+            ],
+            batch_size=2000,
+            ignore_conflicts=True,
+        )
+
+
+def text_answers(**filters):
+    """Non-empty answers to text questions, as (answer_id, question_id, text) rows"""
+    return Answer.objects.filter(question__question_type__name__in=TEXT_TYPES, **filters).exclude(
+        data=''
+    ).values_list('id', 'question_id', 'data')
+
+
+def index_responses(response_ids):
+    """Index the text answers of some responses"""
+    index_answers(text_answers(response_id__in=list(response_ids)).iterator(chunk_size=2000))
+
+
+def record_completions(response_ids):
+    """Index the text answers of newly completed responses once the caller's transaction commits"""
+    response_ids = list(response_ids)
+    if response_ids:
+        aggregates.record(index_responses, (), response_ids)
+
+
+def rebuild_index(question_ids, batch_size=2000):
+    """Rebuild the frequency tables and the inverted index of some questions from their complete answers"""
+    question_ids = list(question_ids)
+    with transaction.atomic():
+        TextTerm.objects.filter(question_id__in=question_ids).delete()
+        rows = text_answers(question_id__in=question_ids, response__is_complete=True).order_by('id')
+        batch = []
+        for row in rows.iterator(chunk_size=batch_size):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                index_answers(batch)
+                batch = []
+        index_answers(batch)
+
+
+def top_terms(question_ids, limit=20, bigrams=False):
+    """
+    Most frequent terms, or bigrams, of some questions, in one query.
+
+    Returns a dict mapping question ids to lists of (term, answer_count).
+    """
+    rows = (
+        TextTerm.objects.filter(question_id__in=list(question_ids), is_bigram=bigrams, answer_count__gt=0)
+        .annotate(rank=Window(RowNumber(), partition_by=F('question_id'), order_by=[F('answer_count').desc(), F('term')]))
+        .filter(rank__lte=limit)
+        .order_by('question_id', 'rank')
+        .values_list('question_id', 'term', 'answer_count')
+    )
+    terms = defaultdict(list)
+    for question_id, term, answer_count in rows:
+        terms[question_id].append((term, answer_count))
+    return dict(terms)
+
+
+def search_answers(question_id, query, limit=50, offset=0):
+    """
+    Answers to a question holding every term of a keyword query, newest first.
+
+    Resolved from the inverted index with one grouped query, then one query
+    for the answers' texts. Returns (total, [(answer_id, response_id, text)]).
+    """
+    terms = list(dict.fromkeys(tokenize(query)))
+    if not terms:
+        return 0, []
+    matches = (
+        TextPosting.objects.filter(term__question_id=question_id, term__term__in=terms)
+        .values('answer_id').annotate(matched=Count('id')).filter(matched=len(terms))
+        .order_by('-answer_id').values_list('answer_id', flat=True)
+    )
+    total = matches.count()
+    answer_ids = list(matches[offset:offset + limit])
+    texts = {
+        answer_id: (response_id, data)
+        for answer_id, response_id, data in Answer.objects.filter(id__in=answer_ids).values_list('id', 'response_id', 'data')
+    }
+    return total, [(answer_id, *texts[answer_id]) for answer_id in answer_ids if answer_id in texts]
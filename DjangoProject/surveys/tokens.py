@@ -0,0 +1,42 @@
+"""
+Signed response tokens.
+
+Displaying a survey no longer creates a Response row. The page carries a
+signed, stateless token instead, holding the survey id and the time the
+respondent started. The row is created on the first save or submit, with
+the start time taken from the token.
+"""
+
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.core import signing
+from django.utils import timezone
+
+SALT = 'surveys.response'
+
+
+def make_response_token(survey, started_at=None):
+    """Sign a token for a respondent starting the given survey"""
+    started_at = started_at or timezone.now()
+    return signing.dumps({'s': survey.pk, 't': int(started_at.timestamp())}, salt=SALT, compress=True)
+
+
+def read_response_token(token, survey):
+    """
+    Get the start time carried by a response token.
+
+    Returns None when the token is missing, tampered with, expired, or was
+    issued for another survey.
+    """
+    if not token:
+        return None
+    try:
+        payload = signing.loads(
+            token, salt=SALT, max_age=getattr(settings, 'SURVEY_RESPONSE_TOKEN_MAX_AGE', 7 * 24 * 3600)
+        )
+    except signing.BadSignature:
+        return None
+    if payload.get('s') != survey.pk:
+        return None
+    return datetime.fromtimestamp(payload['t'], tz=dt_timezone.utc)
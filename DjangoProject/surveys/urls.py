@@ -16,8 +16,22 @@ urlpatterns = [
     
     # Nouvelles URLs pour les résultats et l'exportation
     path('<int:pk>/results/', views.survey_results, name='results'),
+    path('<int:pk>/results/trend/', views.survey_trend, name='results_trend'),
+    path('<int:pk>/results/crosstab/', views.survey_crosstab, name='results_crosstab'),
+    path('<int:pk>/results/data/', views.survey_results_data, name='results_data'),
+    path('<int:pk>/results/text/<int:question_id>/', views.survey_text_terms, name='results_text'),
     path('<int:pk>/export/csv/', views.export_survey_csv, name='export_csv'),
     path('<int:pk>/export/excel/', views.export_survey_excel, name='export_excel'),
+    path('<int:pk>/export/parquet/', views.export_survey_parquet, name='export_parquet'),
+    path('<int:pk>/feed/', views.survey_feed, name='feed'),
+    path('exports/<slug:job_id>/', views.export_status, name='export_status'),
+    path('exports/<slug:job_id>/download/', views.export_download, name='export_download'),
     path('<int:pk>/completed/', views.survey_completed, name='survey_completed'),
     path('<int:pk>/save-progress/', views.save_progress, name='save_progress'),
+    path('<int:pk>/progress/', views.autosave_progress, name='autosave_progress'),
+    
+    # Points d'entrée asynchrones (à servir via ASGI)
+    path('<int:pk>/submit-async/', views.submit_survey_async, name='submit_survey_async'),
+    path('<int:pk>/save-progress-async/', views.save_progress_async, name='save_progress_async'),
+    path('write-behind/status/', views.write_behind_status, name='write_behind_status'),
 ]
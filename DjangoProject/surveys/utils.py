@@ -1,89 +1,72 @@
 # Ajoutez ce code à votre fichier utils.py
 
 import csv
-from io import StringIO
 import xlsxwriter
-from io import BytesIO
-from django.http import HttpResponse
+from django.http import StreamingHttpResponse
 from django.utils.translation import gettext as _
 
+from . import export_cache
+from .exports import export_cells, export_chunks, export_header
+from .schema import get_survey_schema
 
-def export_survey_to_csv(survey, responses):
+
+class _Echo:
+    """Pseudo-fichier pour csv.writer: writerow renvoie la ligne au lieu de l'écrire"""
+
+    def write(self, value):
+        return value
+
+
+def export_survey_to_csv(survey, responses, cache_path=None):
     """
-    Exporte les résultats d'une enquête au format CSV.
+    Exporte les résultats d'une enquête au format CSV, en flux.
+    
+    Les réponses sont lues par tranches (voir exports.py) et les lignes
+    envoyées au fil de l'eau: la mémoire reste constante quelle que soit la
+    taille de l'enquête.
     
     Args:
         survey: L'objet Survey à exporter
         responses: QuerySet des réponses à inclure
+        cache_path: Chemin optionnel du cache des exports où enregistrer le fichier
+            une fois envoyé en entier (voir export_cache.py)
     
     Returns:
-        HttpResponse avec le contenu CSV
+        StreamingHttpResponse avec le contenu CSV
     """
-    # Créer une réponse HTTP avec le type MIME pour CSV
-    response = HttpResponse(content_type='text/csv')
+    schema = get_survey_schema(survey)
+    writer = csv.writer(_Echo())
+    
+    def rows():
+        yield writer.writerow(export_header(schema))
+        for chunk in export_chunks(schema, responses):
+            yield ''.join(
+                writer.writerow([response.id, response.created_at.strftime('%Y-%m-%d %H:%M:%S'), *export_cells(schema, response)])
+                for response in chunk
+            )
+    
+    content = rows() if cache_path is None else export_cache.tee(rows(), cache_path)
+    response = StreamingHttpResponse(content, content_type='text/csv')
     response['Content-Disposition'] = f'attachment; filename="{survey.title}_results.csv"'
-    
-    # Créer le writer CSV
-    writer = csv.writer(response)
-    
-    # Récupérer toutes les questions
-    questions = survey.get_questions()
-    
-    # Écrire l'en-tête
-    header = [_('Respondent ID'), _('Date')]
-    for question in questions:
-        header.append(question.text)
-    writer.writerow(header)
-    
-    # Écrire les données
-    for response_obj in responses:
-        row = [
-            response_obj.id,
-            response_obj.created_at.strftime('%Y-%m-%d %H:%M:%S')
-        ]
-        
-        # Traiter chaque question
-        for question in questions:
-            # Récupérer la réponse à cette question
-            try:
-                answer = response_obj.answers.get(question=question)
-                
-                # Traiter différemment selon le type de question
-                if hasattr(question.question_type, 'has_options') and question.question_type.has_options:
-                    # Pour les questions à choix unique ou multiple
-                    selected_options = answer.selected_options.all()
-                    if selected_options:
-                        row.append(", ".join([opt.text for opt in selected_options]))
-                    else:
-                        row.append("")
-                else:
-                    # Pour les questions de texte
-                    row.append(answer.text_answer or "")
-            except:
-                # Si pas de réponse à cette question
-                row.append("")
-                
-        writer.writerow(row)
-    
     return response
 
 
-def export_survey_to_excel(survey, responses):
+def write_survey_workbook(path, schema, responses, progress=None):
     """
-    Exporte les résultats d'une enquête au format Excel.
+    Écrit les résultats d'une enquête dans un classeur Excel, par tranches.
+    
+    Le classeur est écrit en mode constant_memory d'xlsxwriter: chaque ligne
+    part sur le disque dès que la suivante commence, la mémoire reste
+    constante quelle que soit la taille de l'enquête.
     
     Args:
-        survey: L'objet Survey à exporter
+        path: Chemin du fichier à écrire
+        schema: Schéma compilé de l'enquête
         responses: QuerySet des réponses à inclure
-    
-    Returns:
-        HttpResponse avec le contenu Excel
+        progress: Fonction optionnelle appelée avec (réponses écrites, total) après chaque tranche
     """
-    # Créer un buffer en mémoire
-    output = BytesIO()
-    
-    # Créer un nouveau classeur Excel et ajouter une feuille
-    workbook = xlsxwriter.Workbook(output)
+    total = responses.count()
+    workbook = xlsxwriter.Workbook(path, {'constant_memory': True, 'remove_timezone': True})
     worksheet = workbook.add_worksheet(_('Results'))
     
     # Ajouter des formats
@@ -103,56 +86,25 @@ def export_survey_to_excel(survey, responses):
         'num_format': 'yyyy-mm-dd hh:mm:ss'
     })
     
-    # Récupérer toutes les questions
-    questions = survey.get_questions()
+    # Largeur des colonnes, à fixer avant d'écrire les lignes en mode constant_memory
+    headers = export_header(schema)
+    for i, header in enumerate(headers):
+        worksheet.set_column(i, i, max(len(header) * 1.2, 15))
     
     # Écrire l'en-tête
-    headers = [_('Respondent ID'), _('Date')]
-    for question in questions:
-        headers.append(question.text)
-        
     for col, header in enumerate(headers):
         worksheet.write(0, col, header, header_format)
     
-    # Écrire les données
-    for row_idx, response_obj in enumerate(responses, start=1):
-        worksheet.write(row_idx, 0, response_obj.id, cell_format)
-        worksheet.write_datetime(row_idx, 1, response_obj.created_at, date_format)
-        
-        # Traiter chaque question
-        for col_idx, question in enumerate(questions, start=2):
-            # Récupérer la réponse à cette question
-            try:
-                answer = response_obj.answers.get(question=question)
-                
-                # Traiter différemment selon le type de question
-                if hasattr(question.question_type, 'has_options') and question.question_type.has_options:
-                    # Pour les questions à choix unique ou multiple
-                    selected_options = answer.selected_options.all()
-                    if selected_options:
-                        worksheet.write(row_idx, col_idx, ", ".join([opt.text for opt in selected_options]), cell_format)
-                    else:
-                        worksheet.write(row_idx, col_idx, "", cell_format)
-                else:
-                    # Pour les questions de texte
-                    worksheet.write(row_idx, col_idx, answer.text_answer or "", cell_format)
-            except:
-                # Si pas de réponse à cette question
-                worksheet.write(row_idx, col_idx, "", cell_format)
+    # Écrire les données, tranche par tranche
+    row_idx = 0
+    for chunk in export_chunks(schema, responses):
+        for response_obj in chunk:
+            row_idx += 1
+            worksheet.write(row_idx, 0, response_obj.id, cell_format)
+            worksheet.write_datetime(row_idx, 1, response_obj.created_at, date_format)
+            for col_idx, value in enumerate(export_cells(schema, response_obj), start=2):
+                worksheet.write_string(row_idx, col_idx, value, cell_format)
+        if progress is not None:
+            progress(row_idx, total)
     
-    # Ajuster la largeur des colonnes
-    for i, header in enumerate(headers):
-        worksheet.set_column(i, i, max(len(header) * 1.2, 15))
-    
-    # Fermer le workbook
     workbook.close()
-    
-    # Préparer la réponse HTTP
-    output.seek(0)
-    response = HttpResponse(
-        output.read(),
-        content_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    )
-    response['Content-Disposition'] = f'attachment; filename="{survey.title}_results.xlsx"'
-    
-    return response
\ No newline at end of file
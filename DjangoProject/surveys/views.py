@@ -1,5 +1,7 @@
-from django.shortcuts import render, get_object_or_404, redirect
+from django.shortcuts import render, get_object_or_404, aget_object_or_404, redirect
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
+from django.conf import settings
 from django.contrib import messages
 from django.utils.translation import gettext as _
 from django.db.models import Count, Q
@@ -8,12 +10,29 @@ from datetime import datetime, timedelta
 from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView, FormView
 from django.urls import reverse_lazy, reverse
 from django.contrib.auth.mixins import LoginRequiredMixin, UserPassesTestMixin
-from django.http import HttpResponseRedirect, JsonResponse
+from django.http import Http404, HttpResponse, HttpResponseNotModified, HttpResponseRedirect, JsonResponse
 from django.views import View
+from django.views.decorators.gzip import gzip_page
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+import hashlib
+import json
 import logging
 
-from .models import Survey, Answer, SurveyShare, Response, Question, QuestionOption
-from .utils import export_survey_to_csv, export_survey_to_excel
+from asgiref.sync import sync_to_async
+
+from .models import Survey, SurveyShare, Response, Question, SurveyStatistics
+from .utils import export_survey_to_csv, write_survey_workbook
+from .ingest import store_submission, ingest_submission, complete_response, astore_submission, missing_required
+from .validation import validate_post
+from .tokens import make_response_token, read_response_token
+from .schema import get_survey_schema, aget_survey_schema
+from .results import aggregate_results, layout_results, count_periods, response_trend, moments_trend, TREND_GRANULARITIES
+from .crosstab import crosstab
+from .cube import get_cube, response_watermark
+from .parquet import parquet_available, write_parquet
+from .segments import filter_segment, parse_segment, SegmentError
+from . import autosave, export_cache, export_jobs, feed, fragments, pages, sketches, text, writebehind
 from .forms import SurveyForm, QuestionForm, QuestionOptionFormSet, SurveyFilterForm
 
 logger = logging.getLogger(__name__)
@@ -152,26 +171,22 @@ class SurveyDetailView(LoginRequiredMixin, DetailView):
         context['can_view_results'] = can_view_results
         context['can_delete'] = can_delete
         context['questions'] = survey.get_questions()
-        context['response_count'] = survey.responses.filter(is_complete=True).count()
 
-        # Add more statistics for the detail page
-        complete_responses = survey.responses.filter(is_complete=True).count()
-        total_responses = survey.responses.count()
-        completion_rate = int((complete_responses / total_responses * 100) if total_responses > 0 else 0)
-        # Calculate average completion time using completion_time field
-        completed_responses = survey.responses.filter(is_complete=True, completion_time__isnull=False)
+        # Statistiques maintenues au fil des réponses (voir SurveyStatistics)
+        stats, created = SurveyStatistics.objects.get_or_create(survey=survey)
+        if created or stats.reconciled_at is None:
+            stats.update()
+        context['response_count'] = stats.complete_responses
         avg_completion_time = None
-        if completed_responses.exists():
-            durations = completed_responses.values_list('completion_time', flat=True)
-            total_duration = sum([d.total_seconds() for d in durations if d], 0)
-            avg_seconds = total_duration / len(durations)
-            import datetime
-            avg_completion_time = str(datetime.timedelta(seconds=int(avg_seconds)))
+        if stats.average_completion_time:
+            avg_completion_time = str(timedelta(seconds=int(stats.average_completion_time.total_seconds())))
         context['statistics'] = {
-            'complete_responses': complete_responses,
-            'completion_rate': completion_rate,
+            'complete_responses': stats.complete_responses,
+            'completion_rate': stats.completion_rate,
             'average_completion_time': avg_completion_time,
         }
+        # Répondants distincts estimés depuis les esquisses journalières (HyperLogLog)
+        context['distinct_respondents'] = sketches.distinct_respondents(survey.pk)
         return context
 
 class SurveyCreateView(LoginRequiredMixin, CreateView):
@@ -253,6 +268,26 @@ class SurveyDeleteView(LoginRequiredMixin, UserPassesTestMixin, DeleteView):
         messages.success(request, _("Survey deleted successfully"))
         return super().delete(request, *args, **kwargs)
 
+def _start_response(request, survey, respondent=None, token=None):
+    """
+    Prépare une nouvelle réponse à partir du jeton signé de la page (voir tokens.py).
+    La ligne n'est insérée qu'à la première écriture, avec l'heure de début du jeton.
+    """
+    started_at = read_response_token(token or request.POST.get('response_token'), survey)
+    return Response(
+        survey=survey,
+        respondent=respondent,
+        ip_address=request.META.get('REMOTE_ADDR'),
+        user_agent=request.META.get('HTTP_USER_AGENT', ''),
+        session_key=request.session.session_key or '',
+        created_at=started_at or timezone.now(),
+    )
+
+def _report_errors(request, errors):
+    """Affiche toutes les erreurs de validation d'une soumission, sans répéter un même message"""
+    for message in dict.fromkeys(errors.values()):
+        messages.error(request, message)
+
 class TakeSurveyView(View):
     """Vue pour répondre à une enquête"""
     template_name = 'surveys/take_survey.html'
@@ -276,7 +311,7 @@ class TakeSurveyView(View):
             return redirect('surveys:list')
         
         # Vérifier si le nombre maximal de réponses est atteint
-        if survey.max_responses and survey.responses.filter(is_complete=True).count() >= survey.max_responses:
+        if survey.is_full():
             messages.error(request, _("This survey has reached its maximum number of responses."))
             return redirect('surveys:list')
         
@@ -285,9 +320,13 @@ class TakeSurveyView(View):
             messages.error(request, _("You need to be logged in to take this survey."))
             return redirect('login')  # Assurez-vous d'avoir une vue de connexion configurée
         
-        # Créer ou récupérer une réponse en cours
+        # Récupérer une réponse en cours
         response = None
-        if request.user.is_authenticated:
+        plan = pages.get_page_plan(request, survey) if survey.one_question_per_page else None
+        if plan is not None and plan.response_id:
+            # Réponse créée lors d'une étape précédente, y compris pour un répondant anonyme
+            response = Response.objects.filter(pk=plan.response_id, survey=survey, is_complete=False).first()
+        elif request.user.is_authenticated:
             # Vérifier si l'utilisateur a déjà une réponse en cours pour cette enquête
             response = Response.objects.filter(
                 survey=survey,
@@ -295,54 +334,57 @@ class TakeSurveyView(View):
                 is_complete=False
             ).first()
 
-        # Créer une nouvelle réponse si nécessaire
-        if not response:
-            response = Response.objects.create(
-                survey=survey,
-                respondent=request.user if request.user.is_authenticated else None,  # Utilisez respondent au lieu de user
-            )
-        
-        # Obtenir les questions à afficher
-        questions = survey.get_questions()
-        if survey.randomize_questions:
-            questions = list(questions)
-            from random import shuffle
-            shuffle(questions)
+        # Sinon, la réponse ne sera créée qu'à la première sauvegarde ou soumission
+        response_token = make_response_token(survey) if response is None else ''
         
         # Gérer l'affichage d'une question à la fois si configuré
         if survey.one_question_per_page:
+            if not len(plan):
+                pages.discard_page_plan(request, survey)
+                messages.error(request, _("This survey has no questions."))
+                return redirect('surveys:list')
+
             # Obtenir le numéro de la question actuelle (par défaut, la première)
             current_question_index = int(request.GET.get('question', 0))
             
             # S'assurer que l'index est valide
-            if current_question_index >= len(questions):
+            if current_question_index >= len(plan):
                 current_question_index = 0
             
-            # Obtenir la question actuelle
-            if questions:
-                current_question = questions[current_question_index]
-                progress = (current_question_index / len(questions)) * 100 if len(questions) > 0 else 0
-                
-                return render(request, self.template_name, {
-                    'survey': survey,
-                    'question': current_question,
-                    'response': response,
-                    'current_index': current_question_index,
-                    'total_questions': len(questions),
-                    'progress': progress,
-                    'show_progress': survey.show_progress,
-                    'is_first': current_question_index == 0,
-                    'is_last': current_question_index == len(questions) - 1
-                })
-            else:
-                messages.error(request, _("This survey has no questions."))
-                return redirect('surveys:list')
+            # Charger uniquement la question actuelle, dans l'ordre du plan
+            current_question = pages.get_plan_question(survey, plan, plan.question_id(current_question_index))
+            if current_question is None:
+                # La question a été supprimée depuis le début: recommencer avec un nouveau plan
+                pages.discard_page_plan(request, survey)
+                return redirect('surveys:take_survey', pk=survey.pk)
+            progress = (current_question_index / len(plan)) * 100
+            
+            return render(request, self.template_name, {
+                'survey': survey,
+                'question': current_question,
+                'response': response,
+                'response_token': response_token,
+                'current_index': current_question_index,
+                'total_questions': len(plan),
+                'progress': progress,
+                'show_progress': survey.show_progress,
+                'is_first': current_question_index == 0,
+                'is_last': current_question_index == len(plan) - 1
+            })
         else:
+            # Obtenir les questions à afficher depuis le schéma compilé
+            questions = list(get_survey_schema(survey))
+            if survey.randomize_questions:
+                from random import shuffle
+                shuffle(questions)
+
             # Afficher toutes les questions sur une seule page
             return render(request, self.template_name, {
                 'survey': survey,
                 'questions': questions,
+                'question_fragments': fragments.prefetch_fragments(questions),
                 'response': response,
+                'response_token': response_token,
                 'show_progress': False
             })
     
@@ -358,42 +400,61 @@ class TakeSurveyView(View):
         
         # Récupérer ou créer la réponse
         response_id = request.POST.get('response_id')
+        plan = pages.get_page_plan(request, survey) if survey.one_question_per_page else None
+        if not response_id and plan is not None:
+            response_id = plan.response_id
         
         if response_id:
             response = get_object_or_404(Response, pk=response_id, survey=survey)
         else:
-            response = Response.objects.create(
-                survey=survey,
+            response = _start_response(
+                request, survey,
                 respondent=request.user if request.user.is_authenticated and not survey.allow_anonymous else None,
-                is_complete=False
             )
         
         # Traiter les réponses soumises
         if survey.one_question_per_page:
-            # Traiter une seule question
+            # Traiter une seule question, chargée seule d'après le plan
             question_id = request.POST.get('question_id')
             if question_id:
-                question = get_object_or_404(Question, pk=question_id, survey=survey)
-                self._process_question_answer(question, request.POST, response)
-                
+                try:
+                    question_id = int(question_id)
+                except ValueError:
+                    raise Http404(_("Question not found"))
+                question = pages.get_plan_question(survey, plan, question_id) if question_id in plan else None
+                if question is None:
+                    raise Http404(_("Question not found"))
                 # Déterminer la question suivante
                 current_index = int(request.POST.get('current_index', 0))
-                questions = list(survey.get_questions())
                 
-                if survey.randomize_questions:
-                    # Si les questions sont randomisées, nous devons conserver l'ordre dans la session
-                    if 'survey_questions_order' not in request.session:
-                        request.session['survey_questions_order'] = [q.id for q in questions]
-                    
-                    question_ids = request.session['survey_questions_order']
-                    questions = [get_object_or_404(Question, pk=qid) for qid in question_ids]
+                # Une réponse invalide n'est pas enregistrée: retour à la même question
+                errors = self._process_question_answer(question, request.POST, response)
+                if errors:
+                    _report_errors(request, errors)
+                    return redirect(reverse('surveys:take_survey', kwargs={'pk': survey.pk}) + f'?question={current_index}')
+
+                # Garder la réponse dans le plan pour les étapes suivantes
+                if plan.response_id != response.pk:
+                    plan.response_id = response.pk
+                    pages.save_page_plan(request, survey, plan)
                 
                 # Vérifier si c'est la dernière question
-                if current_index >= len(questions) - 1:
-                    # Compléter la réponse
-                    response.is_complete = True
-                    response.completed_at = timezone.now()
-                    response.save()
+                if current_index >= len(plan) - 1:
+                    # Toutes les questions obligatoires du plan doivent avoir une réponse enregistrée
+                    plan_questions = pages.get_plan_questions(survey, plan)
+                    missing = missing_required(response, plan_questions)
+                    if missing:
+                        _report_errors(request, missing)
+                        first_missing = plan.order.index(next(
+                            question.id for question in plan_questions if question.id in missing
+                        ))
+                        return redirect(reverse('surveys:take_survey', kwargs={'pk': survey.pk}) + f'?question={first_missing}')
+                    
+                    # Compléter la réponse dans la limite du nombre maximal de réponses
+                    if not complete_response(response, survey.max_responses):
+                        messages.error(request, _("This survey has reached its maximum number of responses."))
+                        return redirect('surveys:list')
+                    pages.discard_page_plan(request, survey)
                     
                     messages.success(request, survey.success_message or _("Thank you for completing the survey!"))
                     
@@ -407,16 +468,11 @@ class TakeSurveyView(View):
                     next_index = current_index + 1
                     return redirect(reverse('surveys:take_survey', kwargs={'pk': survey.pk}) + f'?question={next_index}')
         else:
-            # Traiter toutes les questions
-            questions = survey.get_questions()
-            
-            for question in questions:
-                self._process_question_answer(question, request.POST, response)
-            
-            # Compléter la réponse
-            response.is_complete = True
-            response.completed_at = timezone.now()
-            response.save()
+            # Traiter toutes les questions et compléter la réponse en une transaction
+            errors = ingest_submission(response, get_survey_schema(survey), request.POST)
+            if errors:
+                _report_errors(request, errors)
+                return redirect('surveys:take_survey', pk=survey.pk)
             
             messages.success(request, survey.success_message or _("Thank you for completing the survey!"))
             
@@ -432,42 +488,11 @@ class TakeSurveyView(View):
         """
         Traite la réponse à une question et la sauvegarde
         """
-        # Supprimer toute réponse existante pour cette question
-        Answer.objects.filter(question=question, response=response).delete()
-        
-        # Créer une nouvelle réponse en fonction du type de question
-        question_key = f'question_{question.id}'
-        
-        if hasattr(question.question_type, 'has_options') and question.question_type.has_options:
-            # Questions à choix (unique ou multiple)
-            if question.question_type.name in ['radio', 'dropdown']:  # Choix unique
-                option_id = post_data.get(question_key)
-                if option_id:
-                    answer = Answer.objects.create(
-                        question=question,
-                        response=response
-                    )
-                    option = QuestionOption.objects.get(pk=option_id)
-                    answer.selected_options.add(option)
-            elif question.question_type.name in ['checkbox', 'multiple_select']:  # Choix multiple
-                option_ids = post_data.getlist(question_key)
-                if option_ids:
-                    answer = Answer.objects.create(
-                        question=question,
-                        response=response
-                    )
-                    for option_id in option_ids:
-                        option = QuestionOption.objects.get(pk=option_id)
-                        answer.selected_options.add(option)
-        else:
-            # Questions textuelles
-            text_value = post_data.get(question_key, '').strip()
-            if text_value:
-                Answer.objects.create(
-                    question=question,
-                    response=response,
-                    text_answer=text_value
-                )
+        # Remplacer toute réponse existante pour cette question, seulement si elle est valide
+        cleaned, errors = validate_post([question], post_data)
+        if not errors:
+            store_submission(response, [question], cleaned, complete=False)
+        return errors
 
 class QuestionCreateView(LoginRequiredMixin, UserPassesTestMixin, CreateView):
     """Vue pour créer une nouvelle question"""
@@ -595,33 +620,25 @@ class QuestionUpdateView(LoginRequiredMixin, UserPassesTestMixin, UpdateView):
     def get_success_url(self):
         return reverse('surveys:detail', kwargs={'pk': self.survey.pk})
 
-@login_required
-def survey_results(request, pk):
-    logger.info(f"[survey_results] User: {request.user} - Survey PK: {pk}")
-    try:
-        survey = get_object_or_404(Survey, pk=pk)
-    except Exception as e:
-        messages.error(request, _(f"Erreur lors de la récupération du sondage: {e}"))
-        return redirect('surveys:list')
-    
-    # Check if user has permission to view results
-    if survey.creator != request.user:
-        # Check if user has permission via share
-        try:
-            share = SurveyShare.objects.get(
-                survey=survey,
-                shared_with=request.user,
-                can_view_results=True,
-                accepted=True
-            )
-        except SurveyShare.DoesNotExist:
-            messages.error(request, _("You don't have permission to view the results of this survey"))
-            return redirect('surveys:detail', pk=survey.pk)
-    
-    # Get questions
-    questions = survey.get_questions()
-    
-    # Apply date filters if provided
+def _cube_enabled():
+    return getattr(settings, 'SURVEY_CUBE_ENABLED', False)
+
+def _can_view_results(user, survey):
+    """Le créateur, ou un utilisateur avec un partage accepté autorisant la consultation des résultats"""
+    if survey.creator == user:
+        return True
+    return SurveyShare.objects.filter(
+        survey=survey,
+        shared_with=user,
+        can_view_results=True,
+        accepted=True
+    ).exists()
+
+def _date_filter_range(request):
+    """
+    Période (start_date, end_date) des filtres de date des résultats et des exports
+    (paramètres date_filter, start_date et end_date); lève ValueError pour une date invalide.
+    """
     date_filter = request.GET.get('date_filter', 'all')
     start_date = None
     end_date = None
@@ -659,15 +676,39 @@ def survey_results(request, pk):
             end_date = timezone.datetime(last_month_year, last_month + 1, 1, 0, 0, 0)
     elif date_filter == 'custom':
         # Parse custom date range
-        try:
-            start_date_str = request.GET.get('start_date')
-            end_date_str = request.GET.get('end_date')
-            if start_date_str:
-                start_date = datetime.strptime(start_date_str, '%Y-%m-%d').replace(tzinfo=timezone.get_current_timezone())
-            if end_date_str:
-                end_date = datetime.strptime(end_date_str, '%Y-%m-%d').replace(hour=23, minute=59, second=59, tzinfo=timezone.get_current_timezone())
-        except ValueError:
-            messages.error(request, _("Invalid date format. Please use YYYY-MM-DD."))
+        start_date_str = request.GET.get('start_date')
+        end_date_str = request.GET.get('end_date')
+        if start_date_str:
+            start_date = datetime.strptime(start_date_str, '%Y-%m-%d').replace(tzinfo=timezone.get_current_timezone())
+        if end_date_str:
+            end_date = datetime.strptime(end_date_str, '%Y-%m-%d').replace(hour=23, minute=59, second=59, tzinfo=timezone.get_current_timezone())
+    return start_date, end_date
+
+@login_required
+def survey_results(request, pk):
+    logger.info(f"[survey_results] User: {request.user} - Survey PK: {pk}")
+    try:
+        survey = get_object_or_404(Survey, pk=pk)
+    except Exception as e:
+        messages.error(request, _(f"Erreur lors de la récupération du sondage: {e}"))
+        return redirect('surveys:list')
+    
+    # Check if user has permission to view results
+    if not _can_view_results(request.user, survey):
+        messages.error(request, _("You don't have permission to view the results of this survey"))
+        return redirect('surveys:detail', pk=survey.pk)
+    
+    # Get questions
+    schema = get_survey_schema(survey)
+    questions = list(schema)
+    
+    # Apply date filters if provided
+    date_filter = request.GET.get('date_filter', 'all')
+    try:
+        start_date, end_date = _date_filter_range(request)
+    except ValueError:
+        start_date = end_date = None
+        messages.error(request, _("Invalid date format. Please use YYYY-MM-DD."))
     
     # Filter responses based on date range
     responses = survey.responses.filter(is_complete=True)
@@ -676,36 +717,59 @@ def survey_results(request, pk):
     if end_date:
         responses = responses.filter(created_at__lte=end_date)
     
-    # Calculate statistics
-    total_responses = responses.count()
-    complete_responses = responses.filter(is_complete=True).count()
-    completion_rate = int((complete_responses / total_responses * 100) if total_responses > 0 else 0)
-    
-    # Calculate answer counts for each option
-    for question in questions:
-        if hasattr(question.question_type, 'has_options') and question.question_type.has_options:
-            options = question.get_options()
-            for option in options:
-                option.answer_count = Answer.objects.filter(
-                    question=question,
-                    response__in=responses,
-                    selected_options=option
-                ).count()
-    
-    # Get response trend data (responses per day for the last 30 days)
+    # Segment optionnel (expression JSON, voir segments.py), résolu sur le cube
+    try:
+        segment = parse_segment(request.GET.get('segment'), schema)
+    except SegmentError as e:
+        messages.error(request, str(e))
+        segment = None
+    
+    # Les comptes viennent du cube en colonnes de l'enquête s'il est activé,
+    # sinon de deux requêtes groupées sur toutes les questions
+    cube = get_cube(survey, schema) if _cube_enabled() or segment is not None else None
+    if cube is not None:
+        rows = cube.mask(start=start_date, end=end_date)
+        if segment is not None:
+            rows &= segment.mask(cube, schema)
+        total_responses = int(rows.sum())
+        results = layout_results(schema, *cube.count_answers(schema, rows))
+    else:
+        total_responses = responses.count()
+        results = aggregate_results(schema, responses)
+    
+    # Termes et bigrammes les plus fréquents des questions textuelles (index de texte, toutes réponses complètes)
+    text_results = [result for result in results if result.question.question_type.name in text.TEXT_TYPES]
+    if text_results:
+        terms = text.top_terms([result.id for result in text_results], limit=15)
+        bigrams = text.top_terms([result.id for result in text_results], limit=10, bigrams=True)
+        for result in text_results:
+            result.terms = terms.get(result.id, [])
+            result.bigrams = bigrams.get(result.id, [])
+    
+    # Moyenne, quantiles et distribution des questions numériques, depuis les esquisses journalières
+    # (à la journée près pour les filtres de date; non disponibles pour un segment),
+    # ainsi que les valeurs textuelles les plus fréquentes et les répondants distincts estimés
+    distinct = None
+    if segment is None:
+        numeric = sketches.merged_sketches(survey.pk, start_date, end_date)
+        values = sketches.frequent_values(survey.pk, start_date, end_date)
+        for result in results:
+            if result.id in numeric:
+                result.numeric = numeric[result.id].summary()
+            result.values = values.get(result.id)
+        distinct = sketches.distinct_respondents(survey.pk, start_date, end_date)
+    
+    # Calculate statistics (les réponses filtrées sont toutes complètes)
+    complete_responses = total_responses
+    completion_rate = 100 if total_responses > 0 else 0
+    
+    # Get response trend data (responses per day for the last 30 days), depuis les agrégats horaires
     end_date_trend = timezone.now()
     start_date_trend = end_date_trend - timedelta(days=30)
-    trend_data = []
-    
-    current_date = start_date_trend
-    while current_date <= end_date_trend:
-        next_date = current_date + timedelta(days=1)
-        count = responses.filter(created_at__gte=current_date, created_at__lt=next_date).count()
-        trend_data.append({
-            'date': current_date.strftime('%Y-%m-%d'),
-            'count': count
-        })
-        current_date = next_date
+    trend_data = [
+        {'date': period['date'], 'count': period['completed']}
+        for period in response_trend(survey.pk, start_date_trend, end_date_trend, 'day')
+    ]
     
     # Get cross-tabulation data if requested
     cross_tab_data = None
@@ -713,46 +777,41 @@ def survey_results(request, pk):
     question2_id = request.GET.get('question2')
     
     if question1_id and question2_id and question1_id != question2_id:
-        try:
-            question1 = survey.questions.get(id=question1_id)
-            question2 = survey.questions.get(id=question2_id)
+        question1 = schema.get(question1_id)
+        question2 = schema.get(question2_id)
+        
+        # Only support cross-tabulation for questions with options
+        if (question1 is not None and question1.question_type.has_options and
+            question2 is not None and question2.question_type.has_options):
             
-            # Only support cross-tabulation for questions with options
-            if (hasattr(question1.question_type, 'has_options') and question1.question_type.has_options and
-                hasattr(question2.question_type, 'has_options') and question2.question_type.has_options):
-                
-                options1 = question1.get_options()
-                options2 = question2.get_options()
-                
-                cross_tab_data = {
-                    'question1': question1,
-                    'question2': question2,
-                    'options1': options1,
-                    'options2': options2,
-                    'data': []
-                }
-                
-                # Calculate counts for each combination
-                for option1 in options1:
-                    row_data = []
-                    for option2 in options2:
-                        # Find responses that selected both options
-                        count = Response.objects.filter(
-                            survey=survey,
-                            is_complete=True
-                        ).filter(
-                            # Utiliser Q objects pour éviter les conflits sur answers__question
-                            Q(answers__question=question1, answers__selected_options=option1) &
-                            Q(answers__question=question2, answers__selected_options=option2)
-                        ).distinct().count()
-                        row_data.append(count)
-                    cross_tab_data['data'].append(row_data)
-        except (Survey.DoesNotExist, ValueError):
+            # Table de contingence complète en un passage NumPy (sur le cube, ou après une requête)
+            if cube is not None:
+                table = cube.crosstab([question1, question2], rows)
+            else:
+                table = crosstab([question1, question2], responses)
+            options1 = question1.get_options()
+            options2 = question2.get_options()
+            data = table.table.tolist()
+            
+            cross_tab_data = {
+                'question1': question1,
+                'question2': question2,
+                'options1': options1,
+                'options2': options2,
+                'data': data,
+                'rows': [
+                    (option1, list(zip(row, percentages)))
+                    for option1, row, percentages in zip(options1, data, table.row_percentages().tolist())
+                ],
+                'chi_square': table.chi_square(),
+            }
+        else:
             messages.error(request, _("Invalid questions selected for cross-tabulation."))
     
     return render(request, 'surveys/survey_results.html', {
         'survey': survey,
         'questions': questions,
+        'results': results,
         'total_responses': total_responses,
         'complete_responses': complete_responses,
         'completion_rate': completion_rate,
@@ -760,9 +819,280 @@ def survey_results(request, pk):
         'start_date': start_date.strftime('%Y-%m-%d') if start_date else '',
         'end_date': end_date.strftime('%Y-%m-%d') if end_date else '',
         'trend_data': trend_data,
-        'cross_tab_data': cross_tab_data
+        'cross_tab_data': cross_tab_data,
+        'distinct_respondents': distinct,
+    })
+
+def _parse_day(value, end=False):
+    """Début (ou fin, si end) d'une journée AAAA-MM-JJ dans le fuseau courant; lève ValueError"""
+    day = datetime.strptime(value, '%Y-%m-%d')
+    if end:
+        day = day.replace(hour=23, minute=59, second=59)
+    return day.replace(tzinfo=timezone.get_current_timezone())
+
+def _parse_date_range(request, default_days=None):
+    """
+    Lit les paramètres GET start et end (AAAA-MM-JJ, end inclus). Sans start, la période
+    couvre les default_days derniers jours, ou n'a pas de début si default_days est None.
+    Lève ValueError si une date est invalide.
+    """
+    end = timezone.now()
+    start = end - timedelta(days=default_days) if default_days is not None else None
+    if request.GET.get('start'):
+        start = _parse_day(request.GET['start'])
+    if request.GET.get('end'):
+        end = _parse_day(request.GET['end'], end=True)
+    return start, end
+
+@login_required
+def survey_trend(request, pk):
+    """
+    API JSON: réponses commencées et complétées par période, lues dans les agrégats horaires.
+    Paramètres GET: start et end (AAAA-MM-JJ, 30 derniers jours par défaut), granularity
+    (hour, day, week ou month), segment (expression JSON optionnelle, voir segments.py:
+    la tendance est alors comptée sur le cube de réponses du segment).
+    """
+    survey = get_object_or_404(Survey, pk=pk)
+    if not _can_view_results(request.user, survey):
+        return JsonResponse({'status': 'error', 'message': _("You don't have permission to view the results of this survey")}, status=403)
+    
+    granularity = request.GET.get('granularity', 'day')
+    if granularity not in TREND_GRANULARITIES:
+        return JsonResponse({'status': 'error', 'message': _("Invalid granularity.")}, status=400)
+    
+    try:
+        start, end = _parse_date_range(request, default_days=30)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': _("Invalid date format. Please use YYYY-MM-DD.")}, status=400)
+    if start > end:
+        return JsonResponse({'status': 'error', 'message': _("End date cannot be before start date")}, status=400)
+    if count_periods(start, end, granularity) > getattr(settings, 'SURVEY_TREND_MAX_PERIODS', 2000):
+        return JsonResponse({'status': 'error', 'message': _("Too many periods, use a coarser granularity.")}, status=400)
+    
+    if request.GET.get('segment'):
+        schema = get_survey_schema(survey)
+        try:
+            segment = parse_segment(request.GET['segment'], schema)
+        except SegmentError as e:
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+        cube = get_cube(survey, schema)
+        rows = segment.mask(cube, schema)
+        started, completed = cube.moments()
+        data = moments_trend(started[rows], completed[rows], start, end, granularity)
+    else:
+        data = response_trend(survey.pk, start, end, granularity)
+    
+    return JsonResponse({
+        'status': 'success',
+        'granularity': granularity,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'data': data,
     })
 
+@login_required
+def survey_crosstab(request, pk):
+    """
+    API JSON: tableau croisé de deux questions à options ou plus, sur les réponses complètes.
+    Paramètres GET: questions (répété, dans l'ordre des axes), start et end (AAAA-MM-JJ, optionnels),
+    segment (expression JSON optionnelle, voir segments.py).
+    """
+    survey = get_object_or_404(Survey, pk=pk)
+    if not _can_view_results(request.user, survey):
+        return JsonResponse({'status': 'error', 'message': _("You don't have permission to view the results of this survey")}, status=403)
+    
+    schema = get_survey_schema(survey)
+    questions = [schema.get(question_id) for question_id in request.GET.getlist('questions')]
+    if len(questions) < 2 or any(question is None or not question.question_type.has_options for question in questions):
+        return JsonResponse({'status': 'error', 'message': _("Invalid questions selected for cross-tabulation.")}, status=400)
+    
+    try:
+        start, end = _parse_date_range(request)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': _("Invalid date format. Please use YYYY-MM-DD.")}, status=400)
+    
+    try:
+        segment = parse_segment(request.GET.get('segment'), schema)
+        if _cube_enabled() or segment is not None:
+            cube = get_cube(survey, schema)
+            rows = cube.mask(start=start, end=end)
+            if segment is not None:
+                rows &= segment.mask(cube, schema)
+            table = cube.crosstab(questions, rows)
+        else:
+            responses = survey.responses.filter(is_complete=True, created_at__lte=end)
+            if start:
+                responses = responses.filter(created_at__gte=start)
+            table = crosstab(questions, responses)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    return JsonResponse({'status': 'success', **table.as_dict()})
+
+@login_required
+def survey_text_terms(request, pk, question_id):
+    """
+    API JSON: termes et bigrammes les plus fréquents d'une question textuelle, lus dans l'index de texte.
+    Paramètres GET: limit (nombre de termes, 20 par défaut), q (mots-clés optionnels: renvoie alors les
+    réponses contenant tous les mots, des plus récentes aux plus anciennes), page.
+    """
+    survey = get_object_or_404(Survey, pk=pk)
+    if not _can_view_results(request.user, survey):
+        return JsonResponse({'status': 'error', 'message': _("You don't have permission to view the results of this survey")}, status=403)
+    question = get_survey_schema(survey).get(question_id)
+    if question is None or question.question_type.name not in text.TEXT_TYPES:
+        return JsonResponse({'status': 'error', 'message': _("Invalid question.")}, status=400)
+    
+    try:
+        limit = min(max(int(request.GET.get('limit', 20)), 1), 100)
+        page = max(int(request.GET.get('page', 1)), 1)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': _("Invalid parameters.")}, status=400)
+    
+    data = {
+        'status': 'success',
+        'question': {'id': question.id, 'text': question.text},
+        'terms': [{'term': term, 'count': count} for term, count in text.top_terms([question.id], limit).get(question.id, [])],
+        'bigrams': [{'term': term, 'count': count} for term, count in text.top_terms([question.id], limit, bigrams=True).get(question.id, [])],
+    }
+    if request.GET.get('q'):
+        page_size = getattr(settings, 'SURVEY_PAGINATION_SIZE', 10)
+        total, answers = text.search_answers(question.id, request.GET['q'], limit=page_size, offset=(page - 1) * page_size)
+        data['matches'] = {
+            'query': request.GET['q'],
+            'total': total,
+            'page': page,
+            'answers': [
+                {'id': answer_id, 'response_id': response_id, 'text': answer_text}
+                for answer_id, response_id, answer_text in answers
+            ],
+        }
+    return JsonResponse(data)
+
+def _results_payload(survey, schema, segment, questions, start, end, granularity):
+    """Comptes par option, tendance et tableau croisé éventuel du segment, calculés sur le cube"""
+    cube = get_cube(survey, schema, refresh=True)
+    rows = segment.mask(cube, schema)
+    answer_counts, option_counts = cube.count_answers(schema, rows)
+    started, completed = cube.moments()
+    return {
+        'status': 'success',
+        'total': int(rows.sum()),
+        'results': [
+            {
+                'id': result.id,
+                'text': result.question.text,
+                'type': result.question.question_type.name,
+                'answer_count': result.answer_count,
+                'options': [
+                    {'id': option.id, 'text': option.text, 'count': option.answer_count, 'percentage': option.percentage}
+                    for option in result.options
+                ],
+            }
+            for result in layout_results(schema, answer_counts, option_counts)
+        ],
+        'trend': {
+            'granularity': granularity,
+            'start': start.isoformat(),
+            'end': end.isoformat(),
+            'data': moments_trend(started[rows], completed[rows], start, end, granularity),
+        },
+        'crosstab': cube.crosstab(questions, rows).as_dict() if questions else None,
+    }
+
+@gzip_page
+@login_required
+def survey_results_data(request, pk):
+    """
+    API JSON des résultats filtrés: comptes par option, tendance et tableau croisé.
+    Paramètres GET: filter (objet JSON, voir segments.filter_segment: conditions sur les
+    réponses, start, end, complete, respondent), crosstab (identifiants de questions à
+    options, répété, optionnel) et granularity de la tendance (day par défaut).
+    Les réponses sont mises en cache par filtre et par état des réponses de l'enquête,
+    compressées et validées par ETag.
+    """
+    survey = get_object_or_404(Survey, pk=pk)
+    if not _can_view_results(request.user, survey):
+        return JsonResponse({'status': 'error', 'message': _("You don't have permission to view the results of this survey")}, status=403)
+    
+    schema = get_survey_schema(survey)
+    try:
+        filters = json.loads(request.GET.get('filter') or '{}')
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': _("The filter is not valid JSON.")}, status=400)
+    try:
+        segment = filter_segment(filters, schema)
+    except SegmentError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    
+    questions = [schema.get(question_id) for question_id in request.GET.getlist('crosstab')]
+    if len(questions) == 1 or any(question is None or not question.question_type.has_options for question in questions):
+        return JsonResponse({'status': 'error', 'message': _("Invalid questions selected for cross-tabulation.")}, status=400)
+    granularity = request.GET.get('granularity', 'day')
+    if granularity not in TREND_GRANULARITIES:
+        return JsonResponse({'status': 'error', 'message': _("Invalid granularity.")}, status=400)
+    
+    # Période de la tendance: celle du filtre, sinon les 30 derniers jours jusqu'à la fin de la journée
+    # (bornes stables sur la journée, pour que le cache serve les requêtes suivantes)
+    today = timezone.localdate()
+    try:
+        start = _parse_day(filters.get('start') or (today - timedelta(days=30)).isoformat())
+        end = _parse_day(filters.get('end') or today.isoformat(), end=True)
+    except (TypeError, ValueError):
+        return JsonResponse({'status': 'error', 'message': _("Invalid date format. Please use YYYY-MM-DD.")}, status=400)
+    if start > end:
+        return JsonResponse({'status': 'error', 'message': _("End date cannot be before start date")}, status=400)
+    if count_periods(start, end, granularity) > getattr(settings, 'SURVEY_TREND_MAX_PERIODS', 2000):
+        return JsonResponse({'status': 'error', 'message': _("Too many periods, use a coarser granularity.")}, status=400)
+    
+    # Clé de cache: filtre canonique + version du schéma + état des réponses (une requête indexée)
+    request_key = hashlib.sha1(json.dumps(
+        [segment.key, [question.id for question in questions], granularity, start.isoformat(), end.isoformat()]
+    ).encode()).hexdigest()
+    key = f"surveys:results:{survey.pk}:{schema.version}:{response_watermark(survey)}:{request_key}"
+    etag = f'"{hashlib.sha1(key.encode()).hexdigest()}"'
+    if etag in request.headers.get('If-None-Match', ''):
+        return HttpResponseNotModified(headers={'ETag': etag})
+    
+    body = cache.get(key)
+    if body is None:
+        try:
+            payload = _results_payload(survey, schema, segment, questions, start, end, granularity)
+        except ValueError as e:
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+        body = json.dumps(payload, cls=DjangoJSONEncoder)
+        cache.set(key, body, getattr(settings, 'SURVEY_RESULTS_CACHE_TIMEOUT', 300))
+    response = HttpResponse(body, content_type='application/json')
+    response['ETag'] = etag
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
+@gzip_page
+@login_required
+def survey_feed(request, pk):
+    """
+    Flux NDJSON des réponses complètes, avec leurs réponses et options choisies (voir feed.py).
+    Paramètres GET: since (curseur de la page précédente, optionnel) et limit.
+    Le curseur suivant est renvoyé dans l'en-tête X-Feed-Cursor, X-Feed-More indique
+    s'il reste des réponses à lire.
+    """
+    survey = get_object_or_404(Survey, pk=pk)
+    if not _can_view_results(request.user, survey):
+        return JsonResponse({'status': 'error', 'message': _("You don't have permission to view the results of this survey")}, status=403)
+    try:
+        limit = int(request.GET.get('limit') or 0)
+        if limit < 0:
+            raise ValueError(limit)
+        body, cursor, has_more = feed.feed_page(survey.pk, request.GET.get('since') or None, limit)
+    except ValueError:
+        return JsonResponse({'status': 'error', 'message': _("Invalid parameters.")}, status=400)
+    response = HttpResponse(body, content_type='application/x-ndjson')
+    response['X-Feed-Cursor'] = cursor or ''
+    response['X-Feed-More'] = 'true' if has_more else 'false'
+    if has_more:
+        response['Link'] = f'<{request.path}?since={cursor}>; rel="next"'
+    response['Cache-Control'] = 'private, no-cache'
+    return response
+
 @login_required
 def save_progress(request, pk):
     """
@@ -807,68 +1137,27 @@ def save_progress(request, pk):
             respondent=request.user
         )
     else:
-        # Créer une nouvelle réponse
-        response = Response.objects.create(
-            survey=survey,
-            respondent=request.user,
-            is_complete=False
-        )
-    
-    # Enregistrer les réponses soumises jusqu'à présent
-    questions_answered = []
+        # Démarrer une nouvelle réponse, insérée à la première écriture
+        response = _start_response(request, survey, respondent=request.user)
     
     # Récupérer les questions soumises (format: question_123=value)
-    for key, value in request.POST.items():
-        if key.startswith('question_') and key != 'response_id':
-            try:
-                question_id = int(key.split('_')[1])
-                question = Question.objects.get(id=question_id, survey=survey)
-                
-                # Supprimer toute réponse existante pour cette question
-                Answer.objects.filter(question=question, response=response).delete()
-                
-                # Si la question a des options (choix unique ou multiple)
-                if hasattr(question.question_type, 'has_options') and question.question_type.has_options:
-                    if question.question_type.name in ['checkbox', 'multiple_select']:
-                        # Pour les choix multiples, la valeur est une liste
-                        option_ids = request.POST.getlist(key)
-                        if option_ids:
-                            answer = Answer.objects.create(
-                                question=question,
-                                response=response
-                            )
-                            for option_id in option_ids:
-                                option = QuestionOption.objects.get(pk=option_id)
-                                answer.selected_options.add(option)
-                            questions_answered.append(question_id)
-                    else:
-                        # Pour un choix unique
-                        option_id = value
-                        if option_id:
-                            answer = Answer.objects.create(
-                                question=question,
-                                response=response
-                            )
-                            option = QuestionOption.objects.get(pk=option_id)
-                            answer.selected_options.add(option)
-                            questions_answered.append(question_id)
-                else:
-                    # Pour les questions de texte
-                    text_value = value.strip()
-                    if text_value:
-                        Answer.objects.create(
-                            question=question,
-                            response=response,
-                            text_answer=text_value
-                        )
-                        questions_answered.append(question_id)
-            except (ValueError, Question.DoesNotExist, QuestionOption.DoesNotExist):
-                # Ignorer les clés qui ne correspondent pas à des questions valides
-                pass
+    schema = get_survey_schema(survey)
+    questions = []
+    for key in request.POST:
+        if key.startswith('question_'):
+            question = schema.get(key.split('_')[1])
+            # Ignorer les clés qui ne correspondent pas à des questions valides
+            if question is not None:
+                questions.append(question)
+    
+    # Enregistrer les réponses valides soumises jusqu'à présent
+    cleaned, errors = validate_post(questions, request.POST)
+    store_submission(response, questions, cleaned, complete=False)
+    questions_answered = list(cleaned)
     
     # Mettre à jour la date de dernière modification
     response.updated_at = timezone.now()
-    response.save()
+    response.save(update_fields=['updated_at'])
     
     # Si la requête attend une réponse JSON (AJAX)
     if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
@@ -883,6 +1172,70 @@ def save_progress(request, pk):
     messages.success(request, _("Your progress has been saved. You can continue later."))
     return redirect('surveys:take_survey', pk=survey.pk)
 
+@login_required
+def autosave_progress(request, pk):
+    """
+    Sauvegarde incrémentale d'une réponse en cours, dans le style d'un PATCH.
+    Le corps JSON ne contient que les réponses modifiées, null pour effacer:
+    {"response_id": 12, "answers": {"34": "texte", "35": [7, 8], "36": null}, "flush": false}
+    Seules les différences avec l'état enregistré sont écrites, et les
+    sauvegardes rapprochées d'une même réponse sont regroupées.
+    """
+    if request.method not in ('PATCH', 'POST'):
+        return JsonResponse({'status': 'error', 'message': _("Only PATCH requests are allowed.")}, status=405)
+    
+    survey = get_object_or_404(Survey, pk=pk)
+    
+    # Vérifier si l'enquête permet de sauvegarder et continuer
+    if not survey.allow_save_and_continue:
+        return JsonResponse({
+            'status': 'error', 
+            'message': _("This survey does not allow saving progress.")
+        }, status=400)
+    
+    # Vérifier si l'enquête est active
+    closed_message = _closed_survey_message(survey, timezone.now())
+    if closed_message:
+        return JsonResponse({'status': 'error', 'message': closed_message}, status=400)
+    
+    try:
+        payload = json.loads(request.body)
+        answers = payload.get('answers', {})
+        if not isinstance(answers, dict):
+            raise ValueError
+    except (ValueError, AttributeError):
+        return JsonResponse({'status': 'error', 'message': _("Invalid JSON payload.")}, status=400)
+    
+    # Récupérer la réponse de l'utilisateur, ou la démarrer depuis le jeton de la page
+    response_id = payload.get('response_id')
+    if response_id:
+        response = get_object_or_404(Response, pk=response_id, survey=survey, respondent=request.user)
+        if response.is_complete:
+            return JsonResponse({
+                'status': 'error',
+                'message': _("This response has already been submitted.")
+            }, status=400)
+    else:
+        response = _start_response(request, survey, respondent=request.user, token=payload.get('response_token'))
+    
+    schema = get_survey_schema(survey)
+    changes, errors = autosave.validate_patch(schema, answers)
+    to_write = autosave.coalesce(response, changes, flush=bool(payload.get('flush')))
+    if to_write is None:
+        # Une sauvegarde vient d'avoir lieu, celle-ci sera écrite avec la suivante
+        return JsonResponse({'status': 'queued', 'response_id': response.pk, 'errors': errors}, status=202)
+    
+    saved = autosave.apply_patch(response, schema, to_write)
+    return JsonResponse({'status': 'success', 'response_id': response.pk, 'saved': saved, 'errors': errors})
+
+def _export_params(request):
+    """Paramètres de filtre d'un export, pour les clés du cache des exports"""
+    params = {key: request.GET.get(key, '') for key in ('date_filter', 'start_date', 'end_date')}
+    if params['date_filter'] not in ('', 'all', 'custom'):
+        # Période relative (aujourd'hui, cette semaine...): elle change avec le jour
+        params['day'] = timezone.localdate().isoformat()
+    return params
+
 @login_required
 def export_survey_csv(request, pk):
     """View for exporting survey results to CSV"""
@@ -902,13 +1255,12 @@ def export_survey_csv(request, pk):
             messages.error(request, _("You don't have permission to export the results of this survey"))
             return redirect('surveys:detail', pk=survey.pk)
     
-    # Apply date filters if provided
-    date_filter = request.GET.get('date_filter', 'all')
-    start_date = None
-    end_date = None
-    
-    # Apply the same date filtering logic as in survey_results
-    # (Code omitted for brevity - copy from survey_results)
+    # Apply date filters if provided, as in survey_results
+    try:
+        start_date, end_date = _date_filter_range(request)
+    except ValueError:
+        messages.error(request, _("Invalid date format. Please use YYYY-MM-DD."))
+        return redirect('surveys:results', pk=survey.pk)
     
     # Filter responses based on date range
     responses = survey.responses.filter(is_complete=True)
@@ -917,35 +1269,39 @@ def export_survey_csv(request, pk):
     if end_date:
         responses = responses.filter(created_at__lte=end_date)
     
-    # Use the utility function to export
-    return export_survey_to_csv(survey, responses)
+    # Servi depuis le cache disque des exports tant que les réponses complètes n'ont pas changé,
+    # sinon généré en flux et enregistré au passage
+    params = _export_params(request)
+    key = export_cache.export_key(survey, get_survey_schema(survey), 'csv', params)
+    path = export_cache.cache_path(key, 'csv')
+    cached = export_cache.lookup(path)
+    if cached is not None:
+        return export_cache.serve(request, cached, key, f"{survey.title}_results.csv", 'text/csv')
+    response = export_survey_to_csv(survey, responses, cache_path=path)
+    response['ETag'] = f'"{key}"'
+    return response
 
-@login_required
-def export_survey_excel(request, pk):
-    """View for exporting survey results to Excel"""
+# Formats des exports en tâche de fond: (fonction d'écriture, type MIME, libellé)
+EXPORT_JOB_FORMATS = {
+    'xlsx': (write_survey_workbook, 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', 'Excel'),
+    'parquet': (write_parquet, 'application/vnd.apache.parquet', 'Parquet'),
+}
+
+def _start_export_job(request, pk, export_format):
+    """Lance (ou rejoint) la tâche d'export d'une enquête au format donné, avec les filtres de date des résultats"""
     survey = get_object_or_404(Survey, pk=pk)
     
     # Check if user has permission to view results
-    if survey.creator != request.user:
-        # Check if user has permission via share
-        try:
-            share = SurveyShare.objects.get(
-                survey=survey,
-                shared_with=request.user,
-                can_view_results=True,
-                accepted=True
-            )
-        except SurveyShare.DoesNotExist:
-            messages.error(request, _("You don't have permission to export the results of this survey"))
-            return redirect('surveys:detail', pk=survey.pk)
-    
-    # Apply date filters if provided
-    date_filter = request.GET.get('date_filter', 'all')
-    start_date = None
-    end_date = None
+    if not _can_view_results(request.user, survey):
+        messages.error(request, _("You don't have permission to export the results of this survey"))
+        return redirect('surveys:detail', pk=survey.pk)
     
-    # Apply the same date filtering logic as in survey_results
-    # (Code omitted for brevity - copy from survey_results)
+    # Apply date filters if provided, as in survey_results
+    try:
+        start_date, end_date = _date_filter_range(request)
+    except ValueError:
+        messages.error(request, _("Invalid date format. Please use YYYY-MM-DD."))
+        return redirect('surveys:results', pk=survey.pk)
     
     # Filter responses based on date range
     responses = survey.responses.filter(is_complete=True)
@@ -954,8 +1310,60 @@ def export_survey_excel(request, pk):
     if end_date:
         responses = responses.filter(created_at__lte=end_date)
     
-    # Use the utility function to export
-    return export_survey_to_excel(survey, responses)
+    # Le fichier est écrit en tâche de fond; une demande identique en cours est réutilisée
+    params = _export_params(request)
+    writer, content_type, label = EXPORT_JOB_FORMATS[export_format]
+    job = export_jobs.start_export(survey, get_survey_schema(survey), export_format, responses, params, writer)
+    if 'application/json' in request.headers.get('Accept', ''):
+        return JsonResponse(_export_job_payload(job), status=202)
+    return render(request, 'surveys/export_status.html', {'survey': survey, 'job': job, 'format_label': label})
+
+@login_required
+def export_survey_excel(request, pk):
+    """View for exporting survey results to Excel, in a background job (see export_jobs.py)"""
+    return _start_export_job(request, pk, 'xlsx')
+
+@login_required
+def export_survey_parquet(request, pk):
+    """View for exporting survey results to Parquet with typed columns, in a background job (see parquet.py)"""
+    if not parquet_available():
+        messages.error(request, _("Parquet exports are not available on this server."))
+        return redirect('surveys:results', pk=pk)
+    return _start_export_job(request, pk, 'parquet')
+
+def _export_job_payload(job):
+    payload = {key: job[key] for key in ('id', 'status', 'done', 'total', 'size', 'error')}
+    payload['status_url'] = reverse('surveys:export_status', kwargs={'job_id': job['id']})
+    if job['status'] == export_jobs.DONE:
+        payload['download_url'] = reverse('surveys:export_download', kwargs={'job_id': job['id']})
+    return payload
+
+def _get_export_job(request, job_id):
+    """Tâche d'export et son enquête, si l'utilisateur peut en consulter les résultats; lève Http404 sinon"""
+    job = export_jobs.get_job(job_id)
+    if job is None:
+        raise Http404(_("Unknown or expired export."))
+    survey = get_object_or_404(Survey, pk=job['survey_id'])
+    if not _can_view_results(request.user, survey):
+        raise Http404(_("Unknown or expired export."))
+    return job, survey
+
+@login_required
+def export_status(request, job_id):
+    """État d'une tâche d'export (JSON): statut, avancement, lien de téléchargement une fois terminée"""
+    job, survey = _get_export_job(request, job_id)
+    return JsonResponse(_export_job_payload(job))
+
+@login_required
+def export_download(request, job_id):
+    """Fichier d'une tâche d'export terminée, depuis le cache disque des exports (ETag et Content-Length)"""
+    job, survey = _get_export_job(request, job_id)
+    cached = export_cache.lookup(export_jobs.job_path(job)) if job['status'] == export_jobs.DONE else None
+    if cached is None:
+        raise Http404(_("The export is not ready."))
+    return export_cache.serve(
+        request, cached, job['key'], f"{survey.title}_results.{job['format']}", EXPORT_JOB_FORMATS[job['format']][1]
+    )
 
 def survey_completed(request, pk):
     """
@@ -1033,7 +1441,7 @@ def submit_survey(request, pk):
         return redirect('surveys:list')
     
     # Vérifier si le nombre maximal de réponses est atteint
-    if survey.max_responses and survey.responses.filter(is_complete=True).count() >= survey.max_responses:
+    if survey.is_full():
         messages.error(request, _("This survey has reached its maximum number of responses."))
         return redirect('surveys:list')
     
@@ -1057,52 +1465,154 @@ def submit_survey(request, pk):
             messages.error(request, _("You are not authorized to submit this response."))
             return redirect('surveys:take_survey', pk=survey.pk)
     else:
-        # Créer une nouvelle réponse
-        response = Response.objects.create(
-            survey=survey,
+        # Démarrer une nouvelle réponse, insérée à la première écriture
+        response = _start_response(
+            request, survey,
             respondent=request.user if request.user.is_authenticated and not survey.allow_anonymous else None,
-            is_complete=False
         )
     
-    # Recueillir les questions et réponses
-    questions = survey.get_questions()
-    valid_response = True
-    error_message = None
-
-    for question in questions:
-        is_required = getattr(question, 'required', False)
-        question_key = f'question_{question.id}'
-        answer_data = None
-        # Si la question a des options
-        if hasattr(question.question_type, 'has_options') and question.question_type.has_options:
-            if question.question_type.name in ['radio', 'dropdown']:
-                answer_data = request.POST.get(question_key)
-            elif question.question_type.name in ['checkbox', 'multiple_select']:
-                answer_data = request.POST.getlist(question_key)
-        else:
-            answer_data = request.POST.get(question_key, '').strip()
-
-        # Validation obligatoire
-        if is_required and (not answer_data or (isinstance(answer_data, list) and not any(answer_data))):
-            valid_response = False
-            error_message = _("Veuillez répondre à toutes les questions obligatoires.")
-            break
-        try:
-            if answer_data:
-                response.set_answer(question, answer_data)
-        except Exception as e:
-            valid_response = False
-            error_message = str(e)
-            break
+    # Écrire les sauvegardes automatiques en attente, qu'elles survivent à une soumission refusée
+    if response.pk is not None:
+        autosave.flush_pending(response.pk)
+    
+    # Valider toute la soumission en mémoire puis l'enregistrer en une transaction
+    errors = ingest_submission(response, get_survey_schema(survey), request.POST)
 
-    # Si la réponse est valide, la marquer comme complète
-    if valid_response:
-        response.is_complete = True
-        response.completed_at = timezone.now()
-        response.save()
+    # Si la réponse est valide, elle est déjà marquée comme complète
+    if not errors:
+        autosave.discard_pending(response)
         messages.success(request, survey.success_message or _("Merci d'avoir complété ce sondage !"))
         return redirect('surveys:survey_completed', pk=survey.pk)
     # Sinon, retourner au formulaire avec les réponses déjà saisies
-    if error_message:
-        messages.error(request, error_message)
-    return redirect('surveys:take_survey', pk=survey.pk)
\ No newline at end of file
+    _report_errors(request, errors)
+    return redirect('surveys:take_survey', pk=survey.pk)
+
+
+@staff_member_required
+def write_behind_status(request):
+    """Métriques du tampon d'écriture différée de ce processus (profondeur de file, vidages)"""
+    return JsonResponse(writebehind.get_metrics())
+
+def _closed_survey_message(survey, now):
+    """Retourne le message d'erreur si l'enquête n'est pas ouverte, sinon None"""
+    if survey.start_date and survey.start_date > now:
+        return _("This survey is not open yet.")
+    if survey.end_date and survey.end_date < now:
+        return _("This survey is closed.")
+    return None
+
+@login_required
+async def submit_survey_async(request, pk):
+    """
+    Version asynchrone de submit_survey, servie par le point d'entrée ASGI.
+    La validation se fait en mémoire sur le schéma compilé, et les écritures
+    sont confiées à un pool de threads borné pour ne pas bloquer la boucle.
+    """
+    survey = await aget_object_or_404(Survey, pk=pk)
+    
+    if request.method != 'POST':
+        messages.error(request, _("Invalid request method. Please use the survey form."))
+        return redirect('surveys:take_survey', pk=survey.pk)
+    
+    # Vérifier si l'enquête est active
+    closed_message = _closed_survey_message(survey, timezone.now())
+    if closed_message:
+        messages.error(request, closed_message)
+        return redirect('surveys:list')
+    
+    # Vérifier si le nombre maximal de réponses est atteint
+    if await survey.ais_full():
+        messages.error(request, _("This survey has reached its maximum number of responses."))
+        return redirect('surveys:list')
+    
+    # Vérifier le code d'accès si défini
+    if survey.access_code and survey.access_code != request.POST.get('access_code'):
+        messages.error(request, _("Invalid access code."))
+        return redirect('surveys:take_survey', pk=survey.pk)
+    
+    # Récupérer ou créer la réponse
+    user = await request.auser()
+    response_id = request.POST.get('response_id')
+    
+    if response_id:
+        response = await aget_object_or_404(Response, pk=response_id, survey=survey)
+        # Vérifier que l'utilisateur est autorisé à soumettre cette réponse
+        if response.respondent_id and response.respondent_id != user.pk:
+            messages.error(request, _("You are not authorized to submit this response."))
+            return redirect('surveys:take_survey', pk=survey.pk)
+    else:
+        response = _start_response(
+            request, survey,
+            respondent=user if user.is_authenticated and not survey.allow_anonymous else None,
+        )
+    
+    # Écrire les sauvegardes automatiques en attente, qu'elles survivent à une soumission refusée
+    if response.pk is not None:
+        await sync_to_async(autosave.flush_pending)(response.pk)
+    
+    # Valider en mémoire, puis écrire en une transaction sur le pool d'écriture
+    schema = await aget_survey_schema(survey)
+    cleaned, errors = validate_post(schema, request.POST)
+    if errors:
+        _report_errors(request, errors)
+        return redirect('surveys:take_survey', pk=survey.pk)
+    
+    if not await astore_submission(response, schema, cleaned):
+        messages.error(request, _("This survey has reached its maximum number of responses."))
+        return redirect('surveys:list')
+    await sync_to_async(autosave.discard_pending)(response)
+    messages.success(request, survey.success_message or _("Merci d'avoir complété ce sondage !"))
+    return redirect('surveys:survey_completed', pk=survey.pk)
+
+@login_required
+async def save_progress_async(request, pk):
+    """
+    Version asynchrone de save_progress, servie par le point d'entrée ASGI.
+    Retourne toujours une réponse JSON.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'status': 'error', 'message': _("Only POST requests are allowed.")}, status=400)
+    
+    survey = await aget_object_or_404(Survey, pk=pk)
+    
+    # Vérifier si l'enquête permet de sauvegarder et continuer
+    if not survey.allow_save_and_continue:
+        return JsonResponse({
+            'status': 'error', 
+            'message': _("This survey does not allow saving progress.")
+        }, status=400)
+    
+    # Vérifier si l'enquête est active
+    closed_message = _closed_survey_message(survey, timezone.now())
+    if closed_message:
+        return JsonResponse({'status': 'error', 'message': closed_message}, status=400)
+    
+    # Récupérer ou créer la réponse
+    user = await request.auser()
+    response_id = request.POST.get('response_id')
+    
+    if response_id:
+        # Vérifier que la réponse appartient bien à l'utilisateur courant
+        response = await aget_object_or_404(Response, pk=response_id, survey=survey, respondent=user)
+    else:
+        response = _start_response(request, survey, respondent=user)
+    
+    # Récupérer les questions soumises (format: question_123=value)
+    schema = await aget_survey_schema(survey)
+    questions = []
+    for key in request.POST:
+        if key.startswith('question_'):
+            question = schema.get(key.split('_')[1])
+            if question is not None:
+                questions.append(question)
+    
+    # Enregistrer les réponses valides, la réponse reste incomplète
+    cleaned, errors = validate_post(questions, request.POST)
+    await astore_submission(response, questions, cleaned, complete=False)
+    
+    return JsonResponse({
+        'status': 'success',
+        'message': _("Your progress has been saved."),
+        'response_id': response.id,
+        'questions_answered': list(cleaned)
+    })
@@ -0,0 +1,599 @@
+"""
+Write-behind buffer for completed submissions.
+
+When SURVEY_WRITE_BEHIND is enabled, a validated submission is appended to
+an append-only journal file and acknowledged right away. A background
+thread then writes the buffered submissions to the database in batches,
+with a few bulk inserts per batch.
+
+Every process owns its own journal in SURVEY_WRITE_BEHIND_DIR and keeps it
+locked while it runs. Next to each journal, an ``.offset`` file records how
+far it has been flushed. When the application starts, journals left behind
+by dead processes are replayed from their offset and removed, in a
+background thread and whether or not write-behind is still enabled. Replaying is idempotent: new
+responses are matched on their resume token, and existing responses get
+their answers rewritten.
+
+When a batch fails, its entries are retried one by one. Entries that still
+fail for a reason other than an unavailable database are moved to a
+``.dead`` journal next to the journal, kept for inspection, and their quota
+reservations are released, so a single bad entry never blocks the queue.
+Answers to questions or options deleted since a submission was accepted
+are dropped.
+"""
+
+import atexit
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import Counter, defaultdict, deque
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, close_old_connections, transaction
+from django.db.models import Case, DateTimeField, DurationField, F, Value, When
+from django.utils import timezone
+
+from . import sketches, text
+from .ingest import answer_rows
+from .models import Answer, Question, QuestionOption, Response, ResponseRollup, SurveyCounter, SurveyStatistics
+
+try:
+    import fcntl
+except ImportError:  # Windows: journals are not shared between processes
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_SUFFIX = '.journal'
+OFFSET_SUFFIX = '.offset'
+DEAD_LETTER_SUFFIX = '.dead'
+
+# Errors of an unavailable database: the entries stay queued and are retried
+TRANSIENT_ERRORS = (OperationalError, InterfaceError)
+
+
+def is_enabled():
+    return getattr(settings, 'SURVEY_WRITE_BEHIND', False)
+
+
+def _journal_dir():
+    return getattr(settings, 'SURVEY_WRITE_BEHIND_DIR', os.path.join(settings.BASE_DIR, 'var', 'journal'))
+
+
+def _batch_size():
+    return getattr(settings, 'SURVEY_WRITE_BEHIND_BATCH_SIZE', 200)
+
+
+def _flush_interval():
+    return getattr(settings, 'SURVEY_WRITE_BEHIND_FLUSH_INTERVAL', 1.0)
+
+
+def _lock(handle):
+    """Take an exclusive lock on an open journal, False if another process holds it"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        return False
+    return True
+
+
+def _read_offset(journal_path):
+    try:
+        with open(journal_path + OFFSET_SUFFIX) as handle:
+            return int(handle.read().strip() or 0)
+    except (OSError, ValueError):
+        return 0
+
+
+def _write_offset(journal_path, offset):
+    tmp_path = journal_path + OFFSET_SUFFIX + '.tmp'
+    with open(tmp_path, 'w') as handle:
+        handle.write(str(offset))
+    os.replace(tmp_path, journal_path + OFFSET_SUFFIX)
+
+
+def _read_entries(handle, offset):
+    """
+    Read the journal entries written after offset.
+
+    Returns a list of (entry, end_offset) tuples. A torn last line, left by
+    a crash in the middle of an append, is ignored.
+    """
+    handle.seek(offset)
+    entries = []
+    for line in handle:
+        offset += len(line)
+        if not line.endswith(b'\n'):
+            break
+        try:
+            entries.append((json.loads(line), offset))
+        except ValueError:
+            logger.warning("Skipping corrupt write-behind journal entry at offset %s", offset)
+    return entries
+
+
+def _seconds(value):
+    return timedelta(seconds=value) if value is not None else None
+
+
+def _moment(value, default):
+    """Datetime of an ISO timestamp of a journal entry, default when missing"""
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _drop_deleted_answers(response_answers):
+    """Drop the answers to questions, and the selections of options, deleted since they were accepted"""
+    question_ids = {question_id for answers in response_answers.values() for question_id, data, option_ids in answers}
+    live_questions = set(Question.objects.filter(id__in=question_ids).values_list('id', flat=True))
+    live_options = set(QuestionOption.objects.filter(id__in={
+        option_id
+        for answers in response_answers.values()
+        for question_id, data, option_ids in answers
+        for option_id in option_ids
+    }).values_list('id', 'question_id'))
+    for response_id, answers in response_answers.items():
+        kept = []
+        for question_id, data, option_ids in answers:
+            live_ids = [option_id for option_id in option_ids if (option_id, question_id) in live_options]
+            if question_id not in live_questions or (option_ids and not live_ids):
+                logger.warning(
+                    "Dropping buffered answer of response %s to question %s, deleted or without its options",
+                    response_id, question_id,
+                )
+                continue
+            kept.append((question_id, data, live_ids))
+        response_answers[response_id] = kept
+
+
+def flush_entries(entries):
+    """
+    Write a batch of journal entries to the database in one transaction.
+
+    New responses are bulk created and then matched back on resume_token,
+    existing responses are marked complete with one update. Answers and
+    selected options of the whole batch use one bulk insert each. The quota
+    slots reserved when the entries were accepted are committed per survey,
+    and the newly completed responses are added to the survey statistics.
+    Created responses keep the start time of their token as created_at, and
+    the rollups count them at their start and acceptance times.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        reserved = Counter(entry['survey_id'] for entry in entries)
+        completed = Counter()
+
+        # The last submission of a response wins
+        by_response = {}
+        for entry in entries:
+            by_response[entry['response_id'] or entry['token']] = entry
+        entries = list(by_response.values())
+
+        existing_ids = set(Response.objects.filter(
+            id__in=[entry['response_id'] for entry in entries if entry['response_id']]
+        ).values_list('id', flat=True))
+
+        tokens = [uuid.UUID(entry['token']) for entry in entries if not entry['response_id']]
+        known_tokens = set(Response.objects.filter(resume_token__in=tokens).values_list('resume_token', flat=True))
+        created = [
+            Response(
+                survey_id=entry['survey_id'],
+                respondent_id=entry['respondent_id'],
+                is_complete=True,
+                ip_address=entry['ip_address'],
+                user_agent=entry['user_agent'],
+                session_key=entry['session_key'],
+                completion_time=_seconds(entry.get('completion_seconds')),
+                resume_token=uuid.UUID(entry['token']),
+            )
+            for entry in entries
+            if not entry['response_id'] and uuid.UUID(entry['token']) not in known_tokens
+        ]
+        Response.objects.bulk_create(created)
+        completed.update(response.survey_id for response in created)
+        token_ids = dict(Response.objects.filter(resume_token__in=tokens).values_list('resume_token', 'id'))
+        started_at = {
+            uuid.UUID(entry['token']): _moment(entry.get('started_at'), now)
+            for entry in entries if not entry['response_id']
+        }
+        if created:
+            # bulk_create stamps created_at with the flush time, restore the start times
+            Response.objects.filter(id__in=[token_ids[response.resume_token] for response in created]).update(
+                created_at=Case(
+                    *(When(pk=token_ids[response.resume_token], then=Value(started_at[response.resume_token]))
+                      for response in created),
+                    output_field=DateTimeField(),
+                )
+            )
+        for survey_id, count in Counter(response.survey_id for response in created).items():
+            SurveyStatistics.record_started(survey_id, count)
+        started_buckets = Counter(
+            (response.survey_id, ResponseRollup.bucket_for(started_at[response.resume_token])) for response in created
+        )
+        for (survey_id, bucket), count in started_buckets.items():
+            ResponseRollup.record(survey_id, bucket, started=count)
+
+        response_answers = {}
+        for entry in entries:
+            if entry['response_id']:
+                if entry['response_id'] not in existing_ids:
+                    logger.warning("Dropping buffered submission for deleted response %s", entry['response_id'])
+                    continue
+                response_answers[entry['response_id']] = entry['answers']
+            else:
+                response_answers[token_ids[uuid.UUID(entry['token'])]] = entry['answers']
+        _drop_deleted_answers(response_answers)
+
+        newly_completed = dict(Response.objects.filter(
+            id__in=existing_ids, is_complete=False
+        ).values_list('id', 'survey_id'))
+        completed.update(newly_completed.values())
+        completion_times = [
+            When(pk=entry['response_id'], then=Value(_seconds(entry['completion_seconds'])))
+            for entry in entries
+            if entry['response_id'] in existing_ids and entry.get('completion_seconds') is not None
+        ]
+        updates = {'is_complete': True, 'updated_at': now}
+        if completion_times:
+            updates['completion_time'] = Case(
+                *completion_times, default=F('completion_time'), output_field=DurationField()
+            )
+        Response.objects.filter(id__in=existing_ids).update(**updates)
+        for survey_id, count in reserved.items():
+            SurveyCounter.commit(survey_id, completed=completed[survey_id], reserved=count)
+
+        completions = defaultdict(list)
+        completed_buckets = Counter()
+        for entry in entries:
+            if entry['response_id']:
+                if entry['response_id'] not in newly_completed:
+                    continue
+                response_id = entry['response_id']
+            else:
+                response_id = token_ids[uuid.UUID(entry['token'])]
+                if uuid.UUID(entry['token']) in known_tokens:
+                    continue
+            completions[entry['survey_id']].append((response_id, _seconds(entry.get('completion_seconds'))))
+            completed_buckets[entry['survey_id'], ResponseRollup.bucket_for(_moment(entry.get('accepted_at'), now))] += 1
+        for (survey_id, bucket), count in completed_buckets.items():
+            ResponseRollup.record(survey_id, bucket, completed=count)
+        for survey_id, survey_completions in completions.items():
+            SurveyStatistics.record_completions(survey_id, survey_completions)
+            text.record_completions(response_id for response_id, _ in survey_completions)
+            sketches.record_completions(survey_id, [response_id for response_id, _ in survey_completions])
+        Answer.objects.filter(response_id__in=list(response_answers)).delete()
+        Answer.objects.bulk_create([
+            Answer(response_id=response_id, question_id=question_id, data=data)
+            for response_id, answers in response_answers.items()
+            for question_id, data, option_ids in answers
+        ])
+
+        answer_ids = {
+            (response_id, question_id): answer_id
+            for response_id, question_id, answer_id in Answer.objects.filter(
+                response_id__in=list(response_answers)
+            ).values_list('response_id', 'question_id', 'id')
+        }
+        Through = Answer.selected_options.through
+        Through.objects.bulk_create([
+            Through(answer_id=answer_ids[(response_id, question_id)], questionoption_id=option_id)
+            for response_id, answers in response_answers.items()
+            for question_id, data, option_ids in answers
+            for option_id in option_ids
+        ])
+
+
+def _dead_letter(journal_path, entry, error):
+    """Keep an entry that cannot be written in the dead-letter file of its journal"""
+    line = json.dumps(dict(entry, error=repr(error)), separators=(',', ':')).encode() + b'\n'
+    with open(journal_path[:-len(JOURNAL_SUFFIX)] + DEAD_LETTER_SUFFIX, 'ab') as handle:
+        handle.write(line)
+        handle.flush()
+        os.fsync(handle.fileno())
+
+
+def flush_batch(batch, journal_path):
+    """
+    Write a batch of (entry, end_offset) pairs read from a journal.
+
+    When the batch fails, its entries are written one by one, and those
+    that still fail are dead-lettered with their reservation released. An
+    unavailable database stops the batch: the error is raised when no entry
+    could be handled. Returns (handled, dead): the number of leading entries
+    written or dead-lettered, and of dead-lettered entries among them.
+    """
+    try:
+        flush_entries([entry for entry, end_offset in batch])
+        return len(batch), 0
+    except TRANSIENT_ERRORS:
+        raise
+    except Exception:
+        logger.exception("Write-behind batch of %s submissions failed, retrying them one by one", len(batch))
+    handled = dead = 0
+    for entry, end_offset in batch:
+        try:
+            flush_entries([entry])
+        except TRANSIENT_ERRORS:
+            if not handled:
+                raise
+            break
+        except Exception as e:
+            logger.exception("Moving buffered submission %s to the dead-letter journal", entry.get('token'))
+            SurveyCounter.release(entry['survey_id'])
+            _dead_letter(journal_path, entry, e)
+            dead += 1
+        handled += 1
+    return handled, dead
+
+
+class WriteBehindBuffer:
+    """Journal and queue of the submissions accepted by this process"""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pending = deque()
+        self._thread = None
+        self.appended_total = 0
+        self.flushed_total = 0
+        self.failed_flushes = 0
+        self.dead_lettered = 0
+        self.last_flush_at = None
+        self.last_error = ''
+        self._open_journal()
+
+    def _open_journal(self):
+        name = f"submissions-{os.getpid()}-{uuid.uuid4().hex[:8]}{JOURNAL_SUFFIX}"
+        self.journal_path = os.path.join(self.directory, name)
+        self._journal = open(self.journal_path, 'ab')
+        _lock(self._journal)
+        self._journal_size = 0
+
+    def start(self):
+        """Replay journals left by dead processes, then start the flusher thread"""
+        try:
+            replay_orphan_journals(self.directory, exclude=self.journal_path)
+        except Exception:
+            logger.exception("Replaying the write-behind journals of stopped processes failed")
+        self._thread = threading.Thread(target=self._run, name='survey-write-behind', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def append(self, response, questions, cleaned):
+        """
+        Journal a validated, completed submission and queue it for flushing.
+
+        The response may be unsaved (started from a signed token), in which
+        case the flusher creates it. Returns once the entry is durably
+        written to the journal.
+        """
+        questions_by_id = {question.id: question for question in questions}
+        now = timezone.now()
+        entry = {
+            'token': uuid.uuid4().hex,
+            'survey_id': response.survey_id,
+            'response_id': response.pk,
+            'respondent_id': response.respondent_id,
+            'ip_address': response.ip_address,
+            'user_agent': response.user_agent,
+            'session_key': response.session_key,
+            'started_at': response.created_at.isoformat() if response.created_at else None,
+            'completion_seconds': (now - response.created_at).total_seconds() if response.created_at else None,
+            'accepted_at': now.isoformat(),
+            'answers': [list(row) for row in answer_rows(questions_by_id, cleaned)],
+        }
+        line = json.dumps(entry, separators=(',', ':')).encode() + b'\n'
+        with self._lock:
+            self._journal.write(line)
+            self._journal.flush()
+            if getattr(settings, 'SURVEY_WRITE_BEHIND_FSYNC', True):
+                os.fsync(self._journal.fileno())
+            self._journal_size += len(line)
+            self._pending.append((entry, self._journal_size))
+            self.appended_total += 1
+            queue_depth = len(self._pending)
+        if queue_depth >= _batch_size():
+            self._wakeup.set()
+        return entry['token']
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(_flush_interval())
+            self._wakeup.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            finally:
+                close_old_connections()
+
+    def flush(self):
+        """Flush queued submissions in batches until the queue is empty or the database is unavailable"""
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        while True:
+            with self._lock:
+                batch = [self._pending[i] for i in range(min(_batch_size(), len(self._pending)))]
+            if not batch:
+                return
+            try:
+                handled, dead = flush_batch(batch, self.journal_path)
+            except Exception as e:
+                self.failed_flushes += 1
+                self.last_error = str(e)
+                logger.exception("Write-behind flush failed, %s submissions stay queued", len(self._pending))
+                return
+            with self._lock:
+                for _ in range(handled):
+                    self._pending.popleft()
+                self.flushed_total += handled - dead
+                self.dead_lettered += dead
+                if dead:
+                    self.last_error = f"{dead} submissions moved to the dead-letter journal"
+                self.last_flush_at = timezone.now()
+                _write_offset(self.journal_path, batch[handled - 1][1])
+                if not self._pending and self._journal_size > getattr(
+                        settings, 'SURVEY_WRITE_BEHIND_ROTATE_BYTES', 16 * 1024 * 1024):
+                    self._rotate()
+
+    def _rotate(self):
+        # Called with the lock held, once every journaled entry is flushed
+        old_path = self.journal_path
+        self._journal.close()
+        self._open_journal()
+        os.remove(old_path)
+        os.remove(old_path + OFFSET_SUFFIX)
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'enabled': True,
+                'queue_depth': len(self._pending),
+                'journal_path': self.journal_path,
+                'journal_bytes': self._journal_size,
+                'appended_total': self.appended_total,
+                'flushed_total': self.flushed_total,
+                'failed_flushes': self.failed_flushes,
+                'dead_lettered': self.dead_lettered,
+                'last_flush_at': self.last_flush_at.isoformat() if self.last_flush_at else None,
+                'last_error': self.last_error,
+            }
+
+
+def _replay_journal(path):
+    """Flush a stopped process's journal from its offset, returns the number of written submissions"""
+    replayed = 0
+    try:
+        handle = open(path, 'rb')
+    except FileNotFoundError:
+        # Replayed and removed by another process meanwhile
+        return 0
+    with handle:
+        if not _lock(handle) or not os.path.exists(path):
+            return 0
+        entries = _read_entries(handle, _read_offset(path))
+        start = 0
+        while start < len(entries):
+            batch = entries[start:start + _batch_size()]
+            handled, dead = flush_batch(batch, path)
+            _write_offset(path, batch[handled - 1][1])
+            start += handled
+            replayed += handled - dead
+    os.remove(path)
+    if os.path.exists(path + OFFSET_SUFFIX):
+        os.remove(path + OFFSET_SUFFIX)
+    logger.info("Replayed %s buffered submissions from %s", replayed, os.path.basename(path))
+    return replayed
+
+
+def replay_orphan_journals(directory=None, exclude=None):
+    """
+    Flush and remove the journals of processes that are no longer running.
+
+    Journals still locked by a live process are left alone, and a journal
+    that cannot be replayed (database unavailable) is kept for the next
+    attempt; errors are logged, never raised. Returns the number of
+    replayed submissions.
+    """
+    replayed = 0
+    for path in _orphan_journals(directory or _journal_dir(), exclude):
+        try:
+            replayed += _replay_journal(path)
+        except Exception:
+            logger.exception(
+                "Could not replay write-behind journal %s, it is kept for the next start", os.path.basename(path)
+            )
+    return replayed
+
+
+def _orphan_journals(directory, exclude=None):
+    if not os.path.isdir(directory):
+        return []
+    return [
+        os.path.join(directory, name)
+        for name in sorted(os.listdir(directory))
+        if name.endswith(JOURNAL_SUFFIX) and os.path.join(directory, name) != exclude
+    ]
+
+
+def orphan_backlog(directory=None, exclude=None):
+    """
+    Journals of stopped processes still on disk, and their submissions not flushed yet.
+
+    Journals locked by a running process are not counted. Returns a
+    (journals, submissions) tuple.
+    """
+    journals = submissions = 0
+    for path in _orphan_journals(directory or _journal_dir(), exclude):
+        try:
+            with open(path, 'rb') as handle:
+                if not _lock(handle):
+                    continue
+                journals += 1
+                submissions += len(_read_entries(handle, _read_offset(path)))
+        except OSError:
+            continue
+    return journals, submissions
+
+
+def _replay_in_background(directory):
+    close_old_connections()
+    try:
+        replay_orphan_journals(directory, exclude=_buffer.journal_path if _buffer is not None else None)
+    finally:
+        close_old_connections()
+
+
+def replay_at_startup():
+    """
+    Replay the journals left by stopped processes in a background thread, if there are any.
+
+    Runs whatever SURVEY_WRITE_BEHIND, so that submissions acknowledged
+    before a crash are written even once write-behind is turned off.
+    Returns the thread, None when there is nothing to replay.
+    """
+    directory = _journal_dir()
+    if not _orphan_journals(directory):
+        return None
+    thread = threading.Thread(
+        target=_replay_in_background, args=(directory,), name='survey-write-behind-replay', daemon=True
+    )
+    thread.start()
+    return thread
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_buffer():
+    """Get this process's buffer, replaying orphan journals and starting the flusher on first use"""
+    global _buffer
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = WriteBehindBuffer(_journal_dir())
+            _buffer.start()
+        return _buffer
+
+
+def get_metrics():
+    """Metrics of this process's buffer, queue_depth counting the journals left by stopped processes too"""
+    if _buffer is None:
+        metrics = {'enabled': is_enabled(), 'queue_depth': 0}
+    else:
+        metrics = _buffer.metrics()
+    journals, submissions = orphan_backlog(exclude=metrics.get('journal_path'))
+    metrics['orphan_journals'] = journals
+    metrics['queue_depth'] += submissions
+    return metrics